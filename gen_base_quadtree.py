@@ -1,76 +1,227 @@
+import os, json, math, argparse
+import numpy as np
 import fiona
-from shapely.geometry.geo import shape, mapping
-from shapely.strtree import STRtree
-from pprint import pprint
-from shapely.geometry.polygon import Polygon
-from shapely.geometry.multipolygon import MultiPolygon
-from modquadtree import get_bounds_1x1km, get_pow2_extents, Node, QuadTree, write_tile_to_shape, get_tile_size
+from shapely.geometry.geo import shape
+from shapely.ops import unary_union
+from modquadtree import build_leaf_arrays, LEAF_COLUMNS
+from quadtree import *
+from tile_writer import TileWriter, TILE_FORMATS, get_rect_geojson
+from local_pool import POOL_TYPES
 from fiona.crs import from_epsg
-import argparse
-from shapely.geometry.geo import shape, mapping
-from osgeo import ogr
 
+from datetime import datetime
+
+"""
+    Base quadtree of a whole coverage, on BASE_QUADTREE tiles
+
+    Every feature of the coverage (or their union, with --union) is decomposed
+    from the BASE_QUADTREE root into INSIDE tiles at any depth and INTERSECTS
+    leaves of {tile_size}, on a local pool. The per-feature covers are merged
+    in tile code order: tiles under an INSIDE tile are dropped, duplicates
+    kept once, and four INSIDE siblings are coarsened into their parent.
+    Searches seed from the merged tiles under the query (see get_seed_qtrees)
+    instead of from the empty BASE_QUADTREE box.
+
+    {base_qtree}.npz, rows sorted by tile_code:
+        depth, ix, iy, tile_code, node_type
+        meta_json   coverage path, features, tile_size, union, BASE_QUADTREE
+"""
 
 TILE_SIZE = 1024    #TODO: reconcile with Geotrellis tiling dimensions and units (pixels/mtr?)
-FEATURE_COUNT_LIMIT = 2000
 
+BASE_QTREE_COLUMNS = ['depth', 'ix', 'iy', 'tile_code', 'node_type']
+
+def log_time_diff(start_time, end_time, label="EXEC_TIME"):
+    time_diff = (end_time - start_time)
+    exec_time_millis = time_diff.total_seconds() * 1000
+    print(f"EXECTIME|{label}|{exec_time_millis:.2f}|milliseconds")
+
+def get_base_rootrect(tile_size):
+    """BASE_QUADTREE extents, checking {tile_size} divides it in powers of two"""
+    base_rect = get_base_rect()
+    leaf_depth = math.log2(base_rect.w / tile_size)
+    if leaf_depth != int(leaf_depth):
+        raise ValueError(f"Tile size {tile_size} is not BASE_QUADTREE width {base_rect.w} over a power of two")
+    return [base_rect.min_x, base_rect.min_y, base_rect.max_x, base_rect.max_y]
+
+def leaves_to_tiles(leaf_array):
+    """(depth, ix, iy, node_type) arrays of BASE_QUADTREE-rooted modquadtree leaves"""
+    base_rect = get_base_rect()
+    leaf_w = leaf_array[:, 2] - leaf_array[:, 0]
+    depth = leaf_array[:, 4].astype(np.uint8)
+    ix = np.floor((leaf_array[:, 0] - base_rect.min_x) / leaf_w + 0.5).astype(np.int64)
+    iy = np.floor((leaf_array[:, 1] - base_rect.min_y) / leaf_w + 0.5).astype(np.int64)
+    return depth, ix, iy, leaf_array[:, 5].astype(np.int8)
+
+def coarsen_inside(depth, ix, iy, node_type):
+    """Replace every four INSIDE siblings by their INSIDE parent, bottom up"""
+    for child_depth in range(int(depth.max(initial=0)), 0, -1):
+        child_sel = (node_type == QuadTreeNodeType.INSIDE) & (depth == child_depth)
+        parent_ix, parent_iy = ix[child_sel] >> 1, iy[child_sel] >> 1
+        parent_code = get_tile_code(np.full(len(parent_ix), child_depth - 1, dtype=np.uint8), parent_ix, parent_iy)
+        unique_code, first_idx, counts = np.unique(parent_code, return_index=True, return_counts=True)
+        full_idx = first_idx[counts == 4]
+        if len(full_idx) == 0:
+            continue
+        drop_sel = np.zeros(len(depth), dtype=bool)
+        drop_sel[np.flatnonzero(child_sel)[np.isin(parent_code, unique_code[counts == 4])]] = True
+        depth = np.concatenate([depth[~drop_sel], np.full(len(full_idx), child_depth - 1, dtype=np.uint8)])
+        ix = np.concatenate([ix[~drop_sel], parent_ix[full_idx]])
+        iy = np.concatenate([iy[~drop_sel], parent_iy[full_idx]])
+        node_type = np.concatenate([node_type[~drop_sel], np.full(len(full_idx), QuadTreeNodeType.INSIDE, dtype=np.int8)])
+    return depth, ix, iy, node_type
+
+def merge_tiles(depth, ix, iy, node_type):
+    """
+    Merge overlapping tile covers into one, rows sorted by tile code
+    Returns a dict of BASE_QTREE_COLUMNS arrays"""
+    tile_code = get_tile_code(depth, ix, iy)
+    # Larger tiles first at the same code, INSIDE before INTERSECTS
+    sort_order = np.lexsort((node_type, depth, tile_code))
+    depth, ix, iy, node_type, tile_code = depth[sort_order], ix[sort_order], iy[sort_order], node_type[sort_order], tile_code[sort_order]
+
+    # Tiles nest or are disjoint, so a tile starting before the end of an
+    # earlier INSIDE tile lies within it
+    inside_end = np.where(node_type == QuadTreeNodeType.INSIDE, tile_code + tile_code_span(depth), np.uint64(0))
+    covered_end = np.concatenate([np.zeros(1, dtype=np.uint64), np.maximum.accumulate(inside_end)[:-1]])
+    keep = tile_code >= covered_end
+    # Duplicate INTERSECTS leaves of neighbouring features
+    keep[1:] &= ~((tile_code[1:] == tile_code[:-1]) & (depth[1:] == depth[:-1]))
+
+    depth, ix, iy, node_type = coarsen_inside(depth[keep], ix[keep], iy[keep], node_type[keep])
+    tile_code = get_tile_code(depth, ix, iy)
+    sort_order = np.argsort(tile_code, kind='stable')
+    return { 'depth': depth[sort_order], 'ix': ix[sort_order], 'iy': iy[sort_order],
+             'tile_code': tile_code[sort_order], 'node_type': node_type[sort_order] }
+
+def build_base_quadtree(geom_list, tile_size=TILE_SIZE, local_workers=1, pool_type="process"):
+    """Merged BASE_QUADTREE cover of every geometry of {geom_list}"""
+    rootrect = get_base_rootrect(tile_size)
+    leaf_array_list = build_leaf_arrays(geom_list, tile_size, local_workers=local_workers,
+                                        pool_type=pool_type, rootrect=rootrect)
+    leaf_array = np.concatenate(leaf_array_list) if leaf_array_list else np.empty((0, len(LEAF_COLUMNS)))
+    print(f"Feature leaves: {len(leaf_array)}")
+    return merge_tiles(*leaves_to_tiles(leaf_array))
+
+def save_base_quadtree(base_qtree_path, base_qtree, meta):
+    with open(base_qtree_path, 'wb') as base_qtree_fh:
+        np.savez(base_qtree_fh, meta_json=np.array(json.dumps(meta)),
+                 **{ column: base_qtree[column] for column in BASE_QTREE_COLUMNS })
+
+def load_base_quadtree(base_qtree_path):
+    with np.load(base_qtree_path) as base_qtree_npz:
+        base_qtree = { column: base_qtree_npz[column] for column in BASE_QTREE_COLUMNS }
+        base_qtree['meta'] = json.loads(str(base_qtree_npz['meta_json']))
+    if base_qtree['meta']['base_quadtree'] != local_config.BASE_QUADTREE:
+        raise ValueError(f"Base quadtree [{base_qtree_path}] was built on another BASE_QUADTREE")
+    return base_qtree
+
+def get_seed_tiles(base_qtree, query_bounds):
+    """(depth, ix, iy) of the base tiles under {query_bounds}, in tile code order"""
+    base_rect = get_base_rect()
+    tile_w = base_rect.w / (np.uint64(1) << base_qtree['depth'].astype(np.uint64)).astype(np.float64)
+    tile_h = base_rect.h / (np.uint64(1) << base_qtree['depth'].astype(np.uint64)).astype(np.float64)
+    tile_min_x = base_rect.min_x + base_qtree['ix'] * tile_w
+    tile_min_y = base_rect.min_y + base_qtree['iy'] * tile_h
+    min_x, min_y, max_x, max_y = query_bounds
+    seed_sel = (tile_min_x <= max_x) & (tile_min_x + tile_w >= min_x) & (tile_min_y <= max_y) & (tile_min_y + tile_h >= min_y)
+
+    return [ (int(depth), int(ix), int(iy)) for depth, ix, iy
+             in zip(base_qtree['depth'][seed_sel], base_qtree['ix'][seed_sel], base_qtree['iy'][seed_sel]) ]
+
+def get_seed_qtrees(base_qtree, query_bounds):
+    """
+    QuadTree nodes of the base tiles under {query_bounds}, in tile code
+    order, to start rec_tile_search() from instead of the BASE_QUADTREE root
+    #NOTE: query parts outside the coverage get no tiles, see
+    get_uncovered_area(), and INSIDE query tiles are split at base tile
+    boundaries, so a seeded search returns more, smaller tiles"""
+    return [ QuadTree(tile_rect(depth, ix, iy), None, depth=depth)
+             for depth, ix, iy in get_seed_tiles(base_qtree, query_bounds) ]
+
+def get_uncovered_area(geom, seed_qtrees):
+    """Area of {geom} outside the tiles of {seed_qtrees}, which a seeded search drops"""
+    if not seed_qtrees:
+        return geom.area
+    return geom.difference(unary_union([ seed_qtree.boundary.to_shapely_poly() for seed_qtree in seed_qtrees ])).area
+
+def log_uncovered_area(geom, seed_qtrees, label="BASE_QTREE-UNCOVERED"):
+    uncovered_area = get_uncovered_area(geom, seed_qtrees)
+    print(f"AREA|{label}|{uncovered_area:.2f}|square_meters")
+    if uncovered_area > 0:
+        print(f"WARNING: {uncovered_area / geom.area:.2%} of the query is outside the base quadtree coverage and gets no tiles")
+    return uncovered_area
+
+def write_rect_to_shp(rect, shp_fh, properties_dict):
+    shp_fh.write({
+            'geometry': get_rect_geojson(rect.min_x, rect.min_y, rect.max_x, rect.max_y),
+            'properties': properties_dict,
+        })
+
+def write_base_quadtree(out_path, base_qtree, tile_format="shp"):
+    out_shp_schema = {
+            'geometry': 'Polygon',
+            'properties': dict([('TYPE', 'int:2'), ('DEPTH', 'int:5'), ('IX', 'int:10'), ('IY', 'int:10'),
+                ('MIN_X', 'float:19'), ('MIN_Y', 'float:19'),
+                ('MAX_X', 'float:19'), ('MAX_Y', 'float:19')])
+            }
+    with TileWriter(out_path, out_shp_schema, tile_format, crs=from_epsg(32651)) as output_shp_fh:
+        for depth, ix, iy, node_type in zip(base_qtree['depth'], base_qtree['ix'], base_qtree['iy'], base_qtree['node_type']):
+            rect = tile_rect(int(depth), int(ix), int(iy))
+            write_rect_to_shp(rect, output_shp_fh, {
+                "TYPE" : int(node_type), "DEPTH" : int(depth), "IX" : int(ix), "IY" : int(iy),
+                "MIN_X" : rect.min_x, "MIN_Y" : rect.min_y,
+                "MAX_X" : rect.max_x, "MAX_Y" : rect.max_y
+            })
 
 if __name__ == '__main__':
 
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(description="Build the base quadtree of a whole coverage shapefile",
+                                     epilog="Example: gen_base_quadtree.py coverage.shp coverage_qtree.shp --local_workers 8")
     parser.add_argument("input_shp")
     parser.add_argument("output_shp")
+    parser.add_argument("--base_qtree", help="Output base quadtree npz, defaults to {output_shp} with .npz")
+    parser.add_argument("--tile_size", type=float, default=TILE_SIZE, help="Leaf tile size, BASE_QUADTREE width over a power of two")
+    parser.add_argument("--union", action="store_true", help="Decompose the union footprint instead of merging per-feature covers")
+    parser.add_argument("--feature_limit", type=int, default=0, help="Only the first features, 0 for all")
+    parser.add_argument("--local_workers", type=int, default=1, help="Pool workers building per-feature covers")
+    parser.add_argument("--pool_type", choices=POOL_TYPES, default="process")
+    parser.add_argument("--tile_format", choices=list(TILE_FORMATS), default="shp",
+                        help="Format of the {output_shp} tiles, its extension follows the format")
     args = parser.parse_args()
 
-    #Read CRS via GDAL osgeo library
-
-    # infile = ogr.Open(args.input_shp)
-    # layer = infile.GetLayer()
-    # extent = layer.GetExtent()
-    # # crs
-    # spatialRef = layer.GetSpatialRef()
-    # print(f"CRS: {spatialRef.ExportToWkt()}")
-    # print(f"Extents: {extent}")
-
-    #Transfer Variables
-    pow2_bounds = None
-
     with fiona.open(args.input_shp, 'r', 'ESRI Shapefile') as input_shp_fh:
         print(f"CRS: {input_shp_fh.crs}")
         print(f"Features #: {str(len(input_shp_fh))}")
-        
-        count=0
+        geom_list = []
         for data_feature in input_shp_fh:
-            if count > FEATURE_COUNT_LIMIT:
-                break 
-            pprint(data_feature['properties'])
-        
-            #get feature geometry
-            df_geom = shape(data_feature['geometry'])
-            print(f"Shapefile Geom bounds: {df_geom.bounds}")
-
-            pow2_bounds = get_pow2_extents(get_bounds_1x1km(df_geom.bounds), TILE_SIZE)
-            print(f"Bounds^2: {str(pow2_bounds)}")
+            if args.feature_limit and len(geom_list) >= args.feature_limit:
+                break
+            if data_feature['geometry'] is not None:
+                geom_list.append(shape(data_feature['geometry']))
 
     """
         Gen QuadTree
     """
-    rootrect = list(pow2_bounds)
-    rootnode = Node(None, rootrect)
-    tree = QuadTree(rootnode, TILE_SIZE, df_geom)
-    print(f"Leaves: {str(len(tree.leaves))}")
-    
+    start_time = datetime.now()
+    feature_count = len(geom_list)
+    if args.union:
+        geom_list = [ unary_union(geom_list) ]
+    base_qtree = build_base_quadtree(geom_list, args.tile_size, args.local_workers, args.pool_type)
+    log_time_diff(start_time, datetime.now(), label="BASE_QTREE-BUILD")
+    node_type_counts = np.bincount(base_qtree['node_type'], minlength=3)
+    print(f"Base tiles: {len(base_qtree['tile_code'])} ({node_type_counts[QuadTreeNodeType.INSIDE]} INSIDE,"
+          f" {node_type_counts[QuadTreeNodeType.INTERSECTS]} INTERSECTS)")
 
-    out_shp_schema = {
-            'geometry': 'Polygon',
-            'properties': dict([('EN_REF', 'str:254'), ('TYPE', 'int:1'),('MINX', 'float:19'), ('MINY', 'float:19'), ('MAXX', 'float:19'), ('MAXY', 'float:19')])
-            }
-    with fiona.open(args.output_shp, 'w','ESRI Shapefile', out_shp_schema, crs=from_epsg(32651), ) as output_shp_fh:
-        min_x, min_y, max_x, max_y = pow2_bounds
-        write_tile_to_shape((min_x, min_y, max_x, max_y), output_shp_fh, TILE_SIZE, Node.ROOT)
-        for child in rootnode.children:
-            print(f"{child.rect}")
-            min_x, min_y, max_x, max_y = child.rect
-            write_tile_to_shape((min_x, min_y, max_x, max_y), output_shp_fh, TILE_SIZE, Node.ROOT)
-        
-    
+    meta = {
+        'coverage': os.path.abspath(args.input_shp),
+        'features': feature_count,
+        'tile_size': args.tile_size,
+        'union': args.union,
+        'base_quadtree': local_config.BASE_QUADTREE,
+        'created': datetime.now().isoformat(),
+    }
+    base_qtree_path = args.base_qtree or f"{os.path.splitext(args.output_shp)[0]}.npz"
+    save_base_quadtree(base_qtree_path, base_qtree, meta)
+    write_base_quadtree(args.output_shp, base_qtree, args.tile_format)
+    print(f"Base quadtree: {base_qtree_path}")
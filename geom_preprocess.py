@@ -0,0 +1,86 @@
+import os, hashlib
+
+from shapely import wkb
+from shapely.geometry import Polygon, MultiPolygon
+from shapely.geometry.polygon import orient
+
+"""
+    Geometry preprocessing shared by the drivers
+
+    Coverage and query geometries are validated, repaired (buffer(0)), oriented
+    (CCW exteriors) and optionally simplified once, instead of being repaired
+    again inside every per-tile loop. With a cache directory, the prepared WKB
+    is stored under the SHA-1 of the input WKB and the preprocessing options,
+    so repeated runs over the same features skip the work entirely.
+"""
+
+# Simplification tolerance as a fraction of the target tile size,
+# e.g. 1m for 4096m tiles
+SIMPLIFY_TOLERANCE_RATIO = 1.0 / 4096
+
+def get_simplify_tolerance(tile_size):
+    return tile_size * SIMPLIFY_TOLERANCE_RATIO
+
+def repair_geometry(geom):
+    if geom.is_valid:
+        return geom
+    return geom.buffer(0)
+
+def orient_geometry(geom):
+    if isinstance(geom, Polygon):
+        return orient(geom, sign=1.0)
+    elif isinstance(geom, MultiPolygon):
+        return MultiPolygon([ orient(part, sign=1.0) for part in geom.geoms ])
+    return geom
+
+def preprocess_geometry(geom, simplify_tolerance=0.0):
+    geom = repair_geometry(geom)
+    if simplify_tolerance > 0:
+        geom = repair_geometry(geom.simplify(simplify_tolerance, preserve_topology=True))
+    return orient_geometry(geom)
+
+class GeometryCache:
+    """Content-addressed WKB cache of preprocessed geometries"""
+
+    def __init__(self, cache_dir, simplify_tolerance=0.0):
+        self.cache_dir = cache_dir
+        self.simplify_tolerance = simplify_tolerance
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_key(self, geom_wkb):
+        geom_hash = hashlib.sha1(geom_wkb)
+        geom_hash.update(f"simplify={self.simplify_tolerance!r}".encode())
+        return geom_hash.hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.wkb")
+
+    def prepare(self, geom):
+        key = self.get_key(geom.wkb)
+        cache_path = self.get_path(key)
+        if os.path.exists(cache_path):
+            self.hits += 1
+            with open(cache_path, 'rb') as cache_fh:
+                return wkb.loads(cache_fh.read())
+
+        self.misses += 1
+        prepared_geom = preprocess_geometry(geom, self.simplify_tolerance)
+
+        # Write then rename, ranks sharing the cache may race on the same key
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as cache_fh:
+            cache_fh.write(prepared_geom.wkb)
+        os.replace(tmp_path, cache_path)
+        return prepared_geom
+
+    def __str__(self):
+        return f"GeometryCache[{self.cache_dir}] hits={self.hits} misses={self.misses}"
+
+def prepare_geometry(geom, geom_cache=None, simplify_tolerance=0.0):
+    """Preprocess {geom}, through {geom_cache} if given"""
+    if geom_cache is not None:
+        return geom_cache.prepare(geom)
+    return preprocess_geometry(geom, simplify_tolerance)
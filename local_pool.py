@@ -0,0 +1,51 @@
+import resource, multiprocessing
+import concurrent.futures
+from collections import defaultdict
+
+"""
+    Node-local fan-out for MPI ranks
+
+    With one rank per node, a rank hands its chunk to a local process pool (or
+    a thread pool, for work that releases the GIL) instead of needing one rank
+    per core, each paying for its own interpreter, imports and MPI buffers.
+"""
+
+POOL_TYPES = ["process", "thread"]
+
+def map_local(func, arg_list, local_workers=1, pool_type="process", chunksize=1):
+    """
+    Apply {func} to every argument tuple of {arg_list}, in order
+    Runs inline when {local_workers} <= 1"""
+    if local_workers <= 1 or len(arg_list) <= 1:
+        return [ func(*func_args) for func_args in arg_list ]
+
+    if pool_type == "thread":
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=local_workers)
+    else:
+        # NOTE: fork, so children never re-import the MPI driver (and re-init MPI)
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=local_workers,
+                                                          mp_context=multiprocessing.get_context("fork"))
+    with executor:
+        return list(executor.map(func, *zip(*arg_list), chunksize=chunksize))
+
+def get_chunksize(num_items, local_workers, chunks_per_worker=4):
+    return max(1, num_items // (max(1, local_workers) * chunks_per_worker))
+
+def get_rank_memory_mb(local_workers=1):
+    """
+    Peak resident memory of this rank and its pool children, in MB
+    #NOTE: the OS only reports the largest child, so children are counted as
+    {local_workers} times that, an upper bound"""
+    self_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return (self_kb + children_kb * max(1, local_workers)) / 1024
+
+def log_node_memory(cluster_comm, cluster_rank, node_name, local_workers=1):
+    """Gather peak memory of every rank and print the total per node on root"""
+    rank_memory_list = cluster_comm.gather((node_name, get_rank_memory_mb(local_workers)), root=0)
+    if cluster_rank == 0:
+        node_memory_dict = defaultdict(float)
+        for rank_node_name, rank_memory_mb in rank_memory_list:
+            node_memory_dict[rank_node_name] += rank_memory_mb
+        for rank_node_name, node_memory_mb in sorted(node_memory_dict.items()):
+            print(f"R[{cluster_rank}]>MEMORY|{rank_node_name}|{node_memory_mb:.2f}|megabytes")
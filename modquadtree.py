@@ -8,14 +8,21 @@ import fiona
 import math
 import sys
 import time
+import numpy as np
 from shapely.geometry.geo import mapping, shape
 from shapely.geometry.polygon import Polygon
 from shapely.geometry.multipolygon import MultiPolygon
 from shapely.geometry.linestring import LineString
 from shapely.geometry.point import Point
-from shapely.ops import cascaded_union
+from shapely import wkb
+from shapely.geometry import box
+from shapely.prepared import prep
 from fiona.crs import from_epsg
 
+from local_pool import map_local
+from quadtree import QuadTreeNodeType
+from tile_writer import get_rect_geojson
+
 global TILE_SIZE
 TILE_SIZE = 100
     
@@ -23,24 +30,28 @@ class Node():
     ROOT = 0
     BRANCH = 1
     LEAF = 2
-    minsize = 1   # Set by QuadTree
+    minsize = 1   # Default for root nodes, set per tree by QuadTree
     #_______________________________________________________
     # In the case of a root node "parent" will be None. The
     # "rect" lists the minx,minz,maxx,maxz of the rectangle
-    # represented by the node.
-    def __init__(self, parent, rect):
+    # represented by the node. Children inherit "minsize".
+    def __init__(self, parent, rect, minsize=None):
         self.parent = parent
         self.children = [None,None,None,None]
         if parent == None:
             self.depth = 0
+            self.minsize = minsize if minsize is not None else Node.minsize
         else:
             self.depth = parent.depth + 1
+            self.minsize = minsize if minsize is not None else parent.minsize
         self.rect = rect
+        # INSIDE or INTERSECTS the reference geometry, set by the parent
+        self.node_type = QuadTreeNodeType.INTERSECTS
         #print("NODE RECT: "+str(rect)+" DEPTH: "+str(self.depth))
         x0,z0,x1,z1 = rect
         if self.parent == None:
             self.type = Node.ROOT
-        elif (x1 - x0) <= Node.minsize:
+        elif (x1 - x0) <= self.minsize:
             self.mark_as_leaf()
         else:
             self.type = Node.BRANCH
@@ -50,9 +61,15 @@ class Node():
     #_______________________________________________________
     # Recursively subdivides a rectangle. Division occurs 
     # ONLY if the rectangle spans a "feature of interest".
-    def subdivide(self, ref_geom):
+    # Children are tested with prepared predicates: a child
+    # contained by "ref_geom" is a full INSIDE leaf, one that
+    # only intersects it is INTERSECTS and is divided further.
+    # No intersection geometry is built, see get_intersection.
+    def subdivide(self, ref_geom, prepared_geom=None):
         if self.type == Node.LEAF:
             return
+        if prepared_geom is None:
+            prepared_geom = prep(ref_geom)
         x0,z0,x1,z1 = self.rect
         h = (x1 - x0)/2
         
@@ -67,24 +84,23 @@ class Node():
         rects.append( (x0 + h, z0 + h, x1, z1) )
         rects.append( (x0 + h, z0, x1, z0 + h) )
         for n in range(len(rects)):
-            #Spanning check
-            #~ span = self.spans_feature(rects[n], ref_shp)
-            #~ print("DEPTH: "+str(self.depth) + " N-SON: "+str(n) + " SPAN: " + str(span))
-            #~ if span == True:
-                #~ #Creates node
-                #~ self.children[n] = self.getinstance(rects[n])
-                #~ #Subdivides node
-                #~ self.children[n].subdivide(ref_shp) # << recursion
-            
-            #
-            poly_int = self.get_intersection_geometry(rects[n], ref_geom)
-            if poly_int:
-                self.children[n] = self.getinstance(rects[n])
-                if not is_square(poly_int):
-                    self.children[n].subdivide(ref_geom) # << recursion
-                else:   #Mark full squares as leaves
-                    self.children[n].mark_as_leaf()
-            
+            tile = box(*rects[n])
+            if not prepared_geom.intersects(tile):
+                continue
+            self.children[n] = self.getinstance(rects[n])
+            if prepared_geom.contains(tile):   #Mark full squares as leaves
+                self.children[n].node_type = QuadTreeNodeType.INSIDE
+                self.children[n].mark_as_leaf()
+            else:
+                self.children[n].subdivide(ref_geom, prepared_geom) # << recursion
+
+    #_______________________________________________________
+    # Part of "ref_geom" within the node, built on demand.
+    def get_intersection(self, ref_geom):
+        if self.node_type == QuadTreeNodeType.INSIDE:
+            return box(*self.rect)
+        return self.get_intersection_geometry(self.rect, ref_geom)
+
     #_______________________________________________________
     # A utility proc that returns True if the coordinates of
     # a point are within the bounding box of the node.
@@ -146,19 +162,22 @@ class Node():
         
 
 #===========================================================            
+# Leaf columns of QuadTree.leaf_array
+LEAF_COLUMNS = ["min_x", "min_y", "max_x", "max_y", "depth", "node_type"]
+
 class QuadTree():
-    maxdepth = 1 # the "depth" of the tree
-    
-    leaves = []
-    allnodes = []
     #_______________________________________________________
-    def __init__(self, rootnode, minrect, ref_geom, out_shp_file=None):
+    # All state is per tree, so trees can be built concurrently.
+    # With "keep_nodes" False only the compact "leaf_array" is
+    # kept, and the nodes can be freed with the root node.
+    def __init__(self, rootnode, minrect, ref_geom, out_shp_file=None, keep_nodes=True):
         print("MINRECT: " + str(minrect))
-        QuadTree.maxdepth = 1 # the "depth" of the tree
-        QuadTree.leaves = []
-        QuadTree.allnodes = []
+        self.maxdepth = 1 # the "depth" of the tree
+        self.leaves = []
+        self.allnodes = []
+        self.keep_nodes = keep_nodes
         
-        Node.minsize = minrect
+        rootnode.minsize = minrect
         self.shp_file = out_shp_file
         
         #Timer
@@ -184,6 +203,9 @@ class QuadTree():
     
     def get_leaf_nodes(self):
         return list(self.leaves)
+
+    def get_leaf_array(self):
+        return self.leaf_array
     #_______________________________________________________
     # Sets children of 'node' to None if they do not have any
     # LEAF nodes.       
@@ -203,20 +225,46 @@ class QuadTree():
         return leafcount
     #_______________________________________________________
     # Appends all nodes to a "generic" list, but only LEAF 
-    # nodes are appended to the list of leaves.
+    # nodes are appended to the list of leaves. Depth first,
+    # parents before children, on an explicit stack.
     def traverse(self, node, shp_handler=None):
-        if shp_handler is not None:
-            #print("Writing {0}".format(node.rect))
-            #if node.type == Node.LEAF:
-            write_tile_to_shape(node.rect, shp_handler, TILE_SIZE, node.type) 
-        QuadTree.allnodes.append(node)
-        if node.type == Node.LEAF:
-            QuadTree.leaves.append(node)
-            if node.depth > QuadTree.maxdepth:
-                QuadTree.maxdepth = node.depth
-        for child in node.children:
-            if child != None:
-                self.traverse(child, shp_handler) # << recursion
+        leaf_rows = []
+        node_stack = [node]
+        while node_stack:
+            node = node_stack.pop()
+            if shp_handler is not None:
+                #print("Writing {0}".format(node.rect))
+                #if node.type == Node.LEAF:
+                write_tile_to_shape(node.rect, shp_handler, TILE_SIZE, node.type) 
+            if self.keep_nodes:
+                self.allnodes.append(node)
+            if node.type == Node.LEAF:
+                if self.keep_nodes:
+                    self.leaves.append(node)
+                leaf_rows.append((*node.rect, node.depth, int(node.node_type)))
+                if node.depth > self.maxdepth:
+                    self.maxdepth = node.depth
+            for child in reversed(node.children):
+                if child != None:
+                    node_stack.append(child)
+        self.leaf_array = np.array(leaf_rows, dtype=np.float64).reshape(-1, len(LEAF_COLUMNS))
+
+#===========================================================
+def build_leaf_array(geom_wkb, tile_size, rootrect=None):
+    """
+    Leaves of the quadtree of one geometry, as a LEAF_COLUMNS array
+    The root is the power-of-two cover of the geometry, or {rootrect}.
+    #NOTE: takes and returns only picklable values, for process pools"""
+    ref_geom = wkb.loads(geom_wkb)
+    if rootrect is None:
+        rootrect = list(get_pow2_extents(get_bounds_1x1km(ref_geom.bounds), tile_size))
+    tree = QuadTree(Node(None, list(rootrect)), tile_size, ref_geom, keep_nodes=False)
+    return tree.get_leaf_array()
+
+def build_leaf_arrays(geom_list, tile_size, local_workers=1, pool_type="process", rootrect=None):
+    """Leaf arrays of the quadtrees of every geometry of {geom_list}, in order"""
+    return map_local(build_leaf_array, [ (geom.wkb, tile_size, rootrect) for geom in geom_list ],
+                     local_workers=local_workers, pool_type=pool_type)
 
 def get_georefs(rect, tile_size):
     min_x, min_y, max_x, max_y = get_bounds_1x1km(rect)
@@ -230,17 +278,18 @@ def get_georefs(rect, tile_size):
             pass
     
 def is_square(test_geom):
-    if isinstance(test_geom, Polygon):
-        if len(test_geom.exterior.coords) is 5:
+    if isinstance(test_geom, Polygon) and not test_geom.interiors:
+        if len(test_geom.exterior.coords) == 5:
             x_pts, y_pts = test_geom.exterior.coords.xy
-            perimeter = zip(x_pts, y_pts)
+            perimeter = list(zip(x_pts, y_pts))
             len_sides = []
-            for i in range(len(perimeter)):
-                len_sides.append(Point(perimeter[i]).distance(Point(perimeter[i-1])))
-            len_sides.remove(0.0)
-            if len(set(len_sides)) <= 1:
+            for i in range(1, len(perimeter)):
+                len_sides.append(math.hypot(perimeter[i][0] - perimeter[i-1][0], perimeter[i][1] - perimeter[i-1][1]))
+            # Equal sides and the area of its envelope, so not a rhombus
+            if len(set(len_sides)) <= 1 and test_geom.area == test_geom.envelope.area:
                 #print(">>> SQUARE: "+ str(perimeter)+ " | SIDES: " + str(len_sides))
                 return True
+    return False
     
                 
 def write_tile_to_shape(tile_extents,shp_file, tile_size, node_type):
@@ -252,7 +301,7 @@ def write_tile_to_shape(tile_extents,shp_file, tile_size, node_type):
     gridref = "E{0}N{1}".format(min_x / tile_size, max_y / tile_size,)
     shp_file.write({
                 #'geometry': mapping(Polygon([tile_ulp, tile_dlp, tile_drp, tile_urp])),
-                'geometry': mapping(Polygon([tile_ulp, tile_dlp, tile_drp, tile_urp])),
+                'geometry': get_rect_geojson(min_x, min_y, max_x, max_y),
                 'properties': {'EN_REF': gridref,
                                'TYPE' : node_type,
                                'MINX' : min_x,
@@ -197,3 +197,61 @@ class QuadTree:
     
     def intersects_shapely_geom(self, shapely_geom):
         return self.boundary.to_shapely_poly().intersects(shapely_geom)
+
+    def tile_address(self):
+        return get_tile_address(self.boundary)
+
+"""
+    Tile addressing on BASE_QUADTREE
+    A tile is addressed by (depth, ix, iy), where ix grows eastward and iy
+    grows northward from the BASE_QUADTREE origin. Its tile code is the
+    Z-order (Morton) code of its south-west descendant at QTREE_MAX_DEPTH, so
+    every descendant of a tile has a code in [code, code + tile_code_span(depth))
+"""
+QTREE_MAX_DEPTH = 21
+
+def get_base_rect():
+    return Rect.from_extents(local_config.BASE_QUADTREE["min_x"],
+                             local_config.BASE_QUADTREE["min_y"],
+                             local_config.BASE_QUADTREE["max_x"],
+                             local_config.BASE_QUADTREE["max_y"])
+
+def get_tile_address(rect):
+    """Return the (depth, ix, iy) of {rect} within BASE_QUADTREE"""
+    base_w = local_config.BASE_QUADTREE["max_x"] - local_config.BASE_QUADTREE["min_x"]
+    depth = int(round(math.log2(base_w / rect.w)))
+    ix = int(math.floor((rect.min_x - local_config.BASE_QUADTREE["min_x"]) / rect.w + 0.5))
+    iy = int(math.floor((rect.min_y - local_config.BASE_QUADTREE["min_y"]) / rect.h + 0.5))
+    return depth, ix, iy
+
+def tile_rect(depth, ix, iy):
+    """Inverse of get_tile_address()"""
+    w = (local_config.BASE_QUADTREE["max_x"] - local_config.BASE_QUADTREE["min_x"]) / (1 << depth)
+    h = (local_config.BASE_QUADTREE["max_y"] - local_config.BASE_QUADTREE["min_y"]) / (1 << depth)
+    min_x = local_config.BASE_QUADTREE["min_x"] + ix * w
+    min_y = local_config.BASE_QUADTREE["min_y"] + iy * h
+    return Rect.from_extents(min_x, min_y, min_x + w, min_y + h)
+
+def _spread_bits(v):
+    # Works on python ints and numpy uint64 arrays alike
+    v = (v | (v << 16)) & 0x0000FFFF0000FFFF
+    v = (v | (v << 8))  & 0x00FF00FF00FF00FF
+    v = (v | (v << 4))  & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v << 2))  & 0x3333333333333333
+    v = (v | (v << 1))  & 0x5555555555555555
+    return v
+
+def get_tile_code(depth, ix, iy):
+    """Return the tile code of (depth, ix, iy); accepts numpy arrays"""
+    if isinstance(ix, np.ndarray):
+        shift = (QTREE_MAX_DEPTH - np.asarray(depth, dtype=np.uint64)) * np.uint64(2)
+        ix = ix.astype(np.uint64)
+        iy = iy.astype(np.uint64)
+        return (_spread_bits(ix) | (_spread_bits(iy) << np.uint64(1))) << shift
+    return (_spread_bits(ix) | (_spread_bits(iy) << 1)) << (2 * (QTREE_MAX_DEPTH - depth))
+
+def tile_code_span(depth):
+    """Number of QTREE_MAX_DEPTH codes covered by a tile at {depth}"""
+    if isinstance(depth, np.ndarray):
+        return np.uint64(1) << ((QTREE_MAX_DEPTH - depth.astype(np.uint64)) * np.uint64(2))
+    return 1 << (2 * (QTREE_MAX_DEPTH - depth))
@@ -9,8 +9,13 @@ from shapely.ops import unary_union
 import rtree.index
 from quadtree import *
 from quadtree_index_worker import *
+from quadtree_index_store import *
+from quadtree_tile_lookup import build_tile_lookup
+from local_pool import *
+from geom_preprocess import *
+from gen_base_quadtree import load_base_quadtree, get_seed_tiles
 
-import itertools, argparse, random
+import itertools, argparse, random, os
 import local_config
 
 from pprint import pprint
@@ -48,11 +53,27 @@ if __name__ == "__main__":
     parser.add_argument("cov_shp", help="Coverage shapefile")
     parser.add_argument("cov_out_dir", help="Coverage output directory")
     parser.add_argument("tile_size", type=int, help="Minimmum tile size in UTM51N")
+    parser.add_argument("--with_wkb", action="store_true", help="Also store clipped tile geometries as WKB")
+    parser.add_argument("--clip_mode", choices=["eager", "lazy"], default="eager",
+                        help="Clip INTERSECTS tiles while indexing, or leave them to quadtree_tile_clip on demand")
+    parser.add_argument("--build_lookup", action="store_true", help="Build the tile->feature lookup after indexing")
+    parser.add_argument("--incremental", action="store_true", help="Only index features added or changed since the last manifest")
+    parser.add_argument("--balance", choices=["shuffle", "lpt"], default="shuffle",
+                        help="Split features by count after a shuffle, or by LPT over a vertex/bbox cost model")
+    parser.add_argument("--parallel_ingest", action="store_true", help="Each worker reads its own feature range from cov_shp (must be on a shared filesystem, e.g. /mnt/mpi_repo)")
+    parser.add_argument("--geom_cache_dir", help="Cache directory for preprocessed geometries")
+    parser.add_argument("--simplify", action="store_true", help="Simplify geometries with a tolerance tied to the tile size")
+    parser.add_argument("--base_qtree", help="Base quadtree npz from gen_base_quadtree.py to seed feature decompositions from")
+    parser.add_argument("--local_workers", type=int, default=1, help="Local pool workers per rank (use with one rank per node)")
+    parser.add_argument("--local_pool", choices=POOL_TYPES, default="process", help="Local pool type")
 #    parser.add_argument("raster_dir", help="Directory for rasters to pair with features in coverage shapefile")
     args = parser.parse_args()
+    if args.with_wkb and args.clip_mode == "lazy":
+        parser.error("--with_wkb needs --clip_mode eager")
     
     ROOT_coverage_output_dir = args.cov_out_dir
     CLUS_tile_size = args.tile_size
+    CLUS_simplify_tolerance = get_simplify_tolerance(CLUS_tile_size) if args.simplify else 0.0
     
     cluster_comm = MPI.COMM_WORLD
     cluster_size = cluster_comm.Get_size()
@@ -62,23 +83,130 @@ if __name__ == "__main__":
     print('cluster_size=%d, cluster_rank=%d, node:[%s]' % (cluster_size, cluster_rank, node_name))
 
     ROOT_coverage_scatter_list = []
+    ROOT_coverage_count = 0
+    ROOT_deleted_keys = []
+    ROOT_feature_records = dict()
+    CLUS_generation = 0
+    CLUS_prev_features = None
     if cluster_rank == 0:
+        os.makedirs(ROOT_coverage_output_dir, exist_ok=True)
+        ROOT_prev_manifest = read_manifest_if_exists(ROOT_coverage_output_dir) if args.incremental else None
+        if ROOT_prev_manifest is not None and not is_incremental_manifest(ROOT_prev_manifest):
+            log_to_cluster(cluster_rank, f"Previous manifest has no {INDEX_FEATURE_KEY} feature keys, re-indexing all features")
+            ROOT_prev_manifest = None
+        elif ROOT_prev_manifest is not None and ROOT_prev_manifest['tile_size'] != CLUS_tile_size:
+            log_to_cluster(cluster_rank, f"Tile size changed from {ROOT_prev_manifest['tile_size']}, re-indexing all features")
+            ROOT_prev_manifest = None
+        elif args.incremental and ROOT_prev_manifest is None:
+            log_to_cluster(cluster_rank, f"No previous manifest found, indexing all features")
+        if ROOT_prev_manifest is not None:
+            CLUS_generation = ROOT_prev_manifest.get('generation', 0) + 1
+
         with fiona.open(args.cov_shp) as cov_sh:
             # preserve the schema of the original shapefile, including the crs
             cov_meta = cov_sh.meta
-            
-            # Split list to scatter_list on (cluster_size) nodes, including root
-            cov_list = list(cov_sh)
-            random.shuffle(cov_list)
-            ROOT_coverage_scatter_list = [[]] + split_by_mod(cluster_worker_size, cov_list)
+            ROOT_coverage_count = len(cov_sh)
             log_to_cluster(cluster_rank, f"Coverage records: {len(cov_sh)}")
-            log_to_cluster(cluster_rank, f"Scatter list len: {len(ROOT_coverage_scatter_list)}")
-            
-            for sublist in ROOT_coverage_scatter_list:
-                print(len(sublist))
 
-    CLUS_coverage_scatter_list = cluster_comm.scatter(ROOT_coverage_scatter_list, root=0)
-    if cluster_rank > 0:
+            if args.parallel_ingest:
+                # Workers read their own ranges, root only sends the feature count
+                if ROOT_prev_manifest is not None:
+                    CLUS_prev_features = ROOT_prev_manifest['features']
+            else:
+                # Split list to scatter_list on (cluster_size) nodes, including root
+                start_time = datetime.now()
+                cov_list = list(cov_sh)
+                log_time_diff(cluster_rank, start_time, datetime.now(),label="INDEX-READ_FEATURES")
+
+                start_time = datetime.now()
+                ROOT_feature_records = get_feature_records(cov_list)
+                log_time_diff(cluster_rank, start_time, datetime.now(),label="INDEX-HASH_FEATURES")
+                if ROOT_prev_manifest is not None:
+                    ROOT_changed_keys, ROOT_deleted_keys = get_index_delta(ROOT_prev_manifest['features'], ROOT_feature_records)
+                    ROOT_changed_keys = set(ROOT_changed_keys)
+                    cov_list = [ feature for feature in cov_list if get_feature_key(feature) in ROOT_changed_keys ]
+                if args.balance == "lpt":
+                    start_time = datetime.now()
+                    ROOT_cost_list = [ get_feature_cost(shape(feature["geometry"]), CLUS_tile_size) for feature in cov_list ]
+                    ROOT_bin_list, ROOT_bin_loads = assign_lpt(ROOT_cost_list, cluster_worker_size)
+                    ROOT_coverage_scatter_list = [[]] + [ [ cov_list[idx] for idx in bin_items ] for bin_items in ROOT_bin_list ]
+                    log_time_diff(cluster_rank, start_time, datetime.now(),label="INDEX-LPT_ASSIGN")
+                    log_balance("INDEX-PREDICTED_COST", ROOT_bin_loads)
+                else:
+                    random.shuffle(cov_list)
+                    ROOT_coverage_scatter_list = [[]] + split_by_mod(cluster_worker_size, cov_list)
+                log_to_cluster(cluster_rank, f"Scatter list len: {len(ROOT_coverage_scatter_list)}")
+                
+                for sublist in ROOT_coverage_scatter_list:
+                    print(len(sublist))
+
+    CLUS_generation = cluster_comm.bcast(CLUS_generation, root=0)
+    CLUS_base_qtree = None
+    if args.base_qtree:
+        if cluster_rank == 0:
+            CLUS_base_qtree = load_base_quadtree(args.base_qtree)
+            if CLUS_base_qtree['meta']['tile_size'] < CLUS_tile_size:
+                log_to_cluster(cluster_rank, f"Base quadtree tiles ({CLUS_base_qtree['meta']['tile_size']}) are finer than {CLUS_tile_size}, not seeding")
+                CLUS_base_qtree = None
+        CLUS_base_qtree = cluster_comm.bcast(CLUS_base_qtree, root=0)
+    if args.parallel_ingest:
+        CLUS_coverage_count = cluster_comm.bcast(ROOT_coverage_count, root=0)
+        CLUS_prev_features = cluster_comm.bcast(CLUS_prev_features, root=0)
+        CLUS_coverage_scatter_list = []
+        if cluster_rank > 0:
+            start_time = datetime.now()
+            ft_range = split_by_mod(cluster_worker_size, range(CLUS_coverage_count))[cluster_rank-1]
+            with fiona.open(args.cov_shp) as cov_sh:
+                CLUS_coverage_scatter_list = [ feature for _, feature in cov_sh.items(ft_range.start, ft_range.stop) ]
+            log_to_cluster(cluster_rank, f"Read features [{ft_range.start}, {ft_range.stop})")
+            log_time_diff(cluster_rank, start_time, datetime.now(),label="INDEX-READ_FEATURES")
+
+            start_time = datetime.now()
+            CLUS_feature_records = get_feature_records(CLUS_coverage_scatter_list)
+            if CLUS_prev_features is not None:
+                CLUS_changed_keys, _ = get_index_delta(CLUS_prev_features, CLUS_feature_records)
+                CLUS_changed_keys = set(CLUS_changed_keys)
+                CLUS_coverage_scatter_list = [ feature for feature in CLUS_coverage_scatter_list if get_feature_key(feature) in CLUS_changed_keys ]
+            log_time_diff(cluster_rank, start_time, datetime.now(),label="INDEX-HASH_FEATURES")
+        else:
+            CLUS_feature_records = dict()
+
+        # Root needs every worker's keys to find deleted features and shifted FIDs
+        ROOT_feature_records_list = cluster_comm.gather(CLUS_feature_records, root=0)
+        if cluster_rank == 0:
+            ROOT_feature_records = merge_feature_records(ROOT_feature_records_list)
+            if ROOT_prev_manifest is not None:
+                _, ROOT_deleted_keys = get_index_delta(ROOT_prev_manifest['features'], ROOT_feature_records)
+
+        if args.balance == "lpt":
+            # Gather costs of each worker's range, then re-read the LPT assignment by FID (stable within this run)
+            CLUS_cost_list = [ (int(feature["id"]), get_feature_cost(shape(feature["geometry"]), CLUS_tile_size))
+                               for feature in CLUS_coverage_scatter_list ]
+            ROOT_cost_lists = cluster_comm.gather(CLUS_cost_list, root=0)
+            ROOT_assign_list = None
+            if cluster_rank == 0:
+                start_time = datetime.now()
+                ROOT_cost_list = list(itertools.chain.from_iterable(ROOT_cost_lists))
+                ROOT_bin_list, ROOT_bin_loads = assign_lpt([ ft_cost for _, ft_cost in ROOT_cost_list ], cluster_worker_size)
+                ROOT_assign_list = [[]] + [ [ ROOT_cost_list[idx][0] for idx in bin_items ] for bin_items in ROOT_bin_list ]
+                log_time_diff(cluster_rank, start_time, datetime.now(),label="INDEX-LPT_ASSIGN")
+                log_balance("INDEX-PREDICTED_COST", ROOT_bin_loads)
+
+            CLUS_assigned_ids = cluster_comm.scatter(ROOT_assign_list, root=0)
+            if cluster_rank > 0:
+                start_time = datetime.now()
+                CLUS_read_features = { int(feature["id"]): feature for feature in CLUS_coverage_scatter_list }
+                with fiona.open(args.cov_shp) as cov_sh:
+                    CLUS_coverage_scatter_list = [ CLUS_read_features[ft_id] if ft_id in CLUS_read_features else cov_sh[ft_id]
+                                                   for ft_id in CLUS_assigned_ids ]
+                log_time_diff(cluster_rank, start_time, datetime.now(),label="INDEX-READ_ASSIGNED")
+    else:
+        CLUS_coverage_scatter_list = cluster_comm.scatter(ROOT_coverage_scatter_list, root=0)
+
+    if cluster_rank == 0 and CLUS_generation > 0:
+        log_to_cluster(cluster_rank, f"Incremental generation {CLUS_generation}: {len(ROOT_deleted_keys)} deleted")
+    CLUS_part_info = None
+    if cluster_rank > 0 and CLUS_coverage_scatter_list:
         log_to_cluster(cluster_rank, f"Received scatter_list: {len(CLUS_coverage_scatter_list)}")
 
         min_x = local_config.BASE_QUADTREE["min_x"]
@@ -98,17 +226,29 @@ if __name__ == "__main__":
 
         
         #pprint(count_feature_points(CLUS_coverage_scatter_list))
+        CLUS_work_start_time = datetime.now()
+        start_time = datetime.now()
+        CLUS_geom_cache = GeometryCache(args.geom_cache_dir, CLUS_simplify_tolerance) if args.geom_cache_dir else None
+        ft_geom_list = [ prepare_geometry(shape(feature["geometry"]), CLUS_geom_cache, CLUS_simplify_tolerance)
+                         for feature in CLUS_coverage_scatter_list ]
+        log_time_diff(cluster_rank, start_time, datetime.now(),label="INDEX-PREPARE_GEOMETRY")
+        if CLUS_geom_cache is not None:
+            log_to_cluster(cluster_rank, str(CLUS_geom_cache))
+
         start_time = datetime.now()
+        chunksize = get_chunksize(len(ft_geom_list), args.local_workers)
+        if CLUS_base_qtree is not None:
+            ft_seed_lists = [ get_seed_tiles(CLUS_base_qtree, ft_geom.bounds) for ft_geom in ft_geom_list ]
+        else:
+            ft_seed_lists = [ None ] * len(ft_geom_list)
+        ft_qtile_lists = map_local(decompose_feature_geom,
+                                   [ (ft_geom, CLUS_tile_size, ft_seed_list) for ft_geom, ft_seed_list in zip(ft_geom_list, ft_seed_lists) ],
+                                   args.local_workers, args.local_pool, chunksize)
+
         feature_qtree_dict = dict()
         for ft_idx, feature in enumerate(CLUS_coverage_scatter_list):
-            
-            ft_geom = shape(feature["geometry"])
             ft_prop = feature["properties"]
-            qtree_root = QuadTree(root_bbox, None)
-            
-            qtile_accumulator = []
-
-            rec_qtree_decompose(qtree_root, ft_geom, qtile_accumulator, qtile_length_limit=CLUS_tile_size)
+            qtile_accumulator = ft_qtile_lists[ft_idx]
             ft_qtree_info = {  
                 'block_name': ft_prop["BLOCK_NAME"],
                 # 'qtree_tiles': [ qt.depth for qt in qtile_accumulator],
@@ -117,39 +257,104 @@ if __name__ == "__main__":
             log_to_cluster(cluster_rank, f"Feature quadtree info: {ft_qtree_info}")
             feature_qtree_dict[ft_idx] = {
                 'ft_idx': ft_idx,
-                'ft_geom': ft_geom,
+                'ft_id': int(feature["id"]),
+                'ft_key': get_feature_key(feature),
+                'ft_geom': ft_geom_list[ft_idx],
                 'block_name': ft_prop["BLOCK_NAME"],
                 'qtree_tiles': qtile_accumulator,
             }
         log_time_diff(cluster_rank, start_time, datetime.now(),label="INDEX-QUADTREE_DECOMPOSE")
 
-        start_time = datetime.now()
-        for key, ft_qtree in feature_qtree_dict.items():
-            intersected_tiles = []
-            for qtree_tile in ft_qtree["qtree_tiles"]:
-                if qtree_tile.node_type == QuadTreeNodeType.INTERSECTS:
-                    if ft_qtree["ft_geom"].is_valid:
-                        intersected_tiles.append(qtree_tile.boundary.to_shapely_poly().intersection(ft_qtree["ft_geom"]))
-                    else:
-                        intersected_tiles.append(qtree_tile.boundary.to_shapely_poly().intersection(ft_qtree["ft_geom"].buffer(0)))
-
-                else:
-                    intersected_tiles.append(qtree_tile.boundary.to_shapely_poly())
-            ft_qtree['intersected_tiles'] = intersected_tiles
-            # log_to_cluster(cluster_rank, f"[{ft_qtree['block_name']}] Q tiles: {len(ft_qtree['qtree_tiles'])}")
-            # log_to_cluster(cluster_rank, f"[{ft_qtree['block_name']}] I tiles: {len(ft_qtree['intersected_tiles'])}")
-            num_qtree_tiles = len(ft_qtree['qtree_tiles'])
-            num_inter_tiles = len(ft_qtree['intersected_tiles'])
-            if num_qtree_tiles != num_inter_tiles:
-                log_to_cluster(cluster_rank, f"[{ft_qtree['block_name']}] Mismatch found! Q:{num_qtree_tiles} vs I:{num_inter_tiles}")
+        if args.clip_mode == "eager":
+            start_time = datetime.now()
+            ft_intersected_lists = map_local(intersect_feature_tiles,
+                                             [ (ft_qtree["ft_geom"], ft_qtree["qtree_tiles"]) for ft_qtree in feature_qtree_dict.values() ],
+                                             args.local_workers, args.local_pool, chunksize)
+            for ft_qtree, intersected_tiles in zip(feature_qtree_dict.values(), ft_intersected_lists):
+                ft_qtree['intersected_tiles'] = intersected_tiles
+                # log_to_cluster(cluster_rank, f"[{ft_qtree['block_name']}] Q tiles: {len(ft_qtree['qtree_tiles'])}")
+                # log_to_cluster(cluster_rank, f"[{ft_qtree['block_name']}] I tiles: {len(ft_qtree['intersected_tiles'])}")
+                num_qtree_tiles = len(ft_qtree['qtree_tiles'])
+                num_inter_tiles = len(ft_qtree['intersected_tiles'])
+                if num_qtree_tiles != num_inter_tiles:
+                    log_to_cluster(cluster_rank, f"[{ft_qtree['block_name']}] Mismatch found! Q:{num_qtree_tiles} vs I:{num_inter_tiles}")
             
             
                     
-        log_time_diff(cluster_rank, start_time, datetime.now(),label="INDEX-QUADTREE_GET_TILE_INTERSECT")
+            log_time_diff(cluster_rank, start_time, datetime.now(),label="INDEX-QUADTREE_GET_TILE_INTERSECT")
+
+        CLUS_work_millis = (datetime.now() - CLUS_work_start_time).total_seconds() * 1000
+
+        #NOTE: Persist this rank's feature covers
+        start_time = datetime.now()
+        cover_columns = build_cover_columns(feature_qtree_dict.values(), with_wkb=args.with_wkb)
+        part_name = write_cover_part(ROOT_coverage_output_dir, cluster_rank, cover_columns, CLUS_generation)
+        CLUS_part_info = {
+            'rank': cluster_rank,
+            'generation': CLUS_generation,
+            'node': node_name,
+            'file': part_name,
+            'features': len(feature_qtree_dict),
+            'tiles': len(cover_columns['ft_id']),
+            'work_millis': round(CLUS_work_millis, 2),
+            'ft_keys': [ ft_qtree['ft_key'] for ft_qtree in feature_qtree_dict.values() ],
+        }
+        log_to_cluster(cluster_rank, f"Wrote {CLUS_part_info['tiles']} tile covers to [{part_name}]")
+        log_time_diff(cluster_rank, start_time, datetime.now(),label="INDEX-WRITE_PART")
+
+    #NOTE: Gather part info and write manifest on root
+    ROOT_part_list = cluster_comm.gather(CLUS_part_info, root=0)
+    if cluster_rank == 0:
+        ROOT_part_list = [ part_info for part_info in ROOT_part_list if part_info is not None ]
+
+        # Scheduling quality over all workers, idle ones included
+        ROOT_rank_millis = [ part_info['work_millis'] for part_info in ROOT_part_list ]
+        log_balance("INDEX-RANK_TIME", ROOT_rank_millis + [ 0.0 ] * (cluster_worker_size - len(ROOT_rank_millis)))
+
+        # Point every indexed feature at this generation's parts
+        ROOT_feature_dict = dict()
+        ROOT_tombstones = dict()
+        if ROOT_prev_manifest is not None:
+            ROOT_feature_dict = ROOT_prev_manifest['features']
+            ROOT_tombstones = ROOT_prev_manifest.get('tombstones', {})
+            for ft_key in ROOT_deleted_keys:
+                del ROOT_feature_dict[ft_key]
+                ROOT_tombstones[ft_key] = CLUS_generation
+            # Unchanged features keep their covers, but may have a new FID
+            for ft_key, ft_info in ROOT_feature_dict.items():
+                ft_info['ft_id'] = ROOT_feature_records[ft_key][0]
+        for part_info in ROOT_part_list:
+            for ft_key in part_info.pop('ft_keys'):
+                ft_id, ft_hash = ROOT_feature_records[ft_key]
+                ROOT_feature_dict[ft_key] = {'ft_id': ft_id, 'part_ft_id': ft_id, 'hash': ft_hash, 'generation': CLUS_generation}
+                ROOT_tombstones.pop(ft_key, None)
+
+        # Keep only parts that still hold live covers
+        if ROOT_prev_manifest is not None:
+            ROOT_live_generations = set(ft_info['generation'] for ft_info in ROOT_feature_dict.values())
+            for part_info in ROOT_prev_manifest['parts']:
+                if part_info.get('generation', 0) in ROOT_live_generations:
+                    ROOT_part_list.append(part_info)
+                else:
+                    log_to_cluster(cluster_rank, f"Removing dead part [{part_info['file']}]")
+                    os.remove(os.path.join(ROOT_coverage_output_dir, part_info['file']))
+            ROOT_part_list.sort(key=lambda part_info: (part_info.get('generation', 0), part_info['rank']))
+
+        write_manifest(ROOT_coverage_output_dir, args.cov_shp, CLUS_tile_size, ROOT_coverage_count,
+                       ROOT_part_list, ROOT_feature_dict, generation=CLUS_generation,
+                       tombstones=ROOT_tombstones, with_wkb=args.with_wkb)
+        log_to_cluster(cluster_rank, f"Wrote manifest for {len(ROOT_part_list)} parts to [{ROOT_coverage_output_dir}]")
+
+        if args.build_lookup:
+            start_time = datetime.now()
+            build_tile_lookup(ROOT_coverage_output_dir)
+            log_time_diff(cluster_rank, start_time, datetime.now(),label="INDEX-BUILD_LOOKUP")
 
     
         
 
         
         
-    
\ No newline at end of file
+    
+    #NOTE: Report peak memory per node
+    log_node_memory(cluster_comm, cluster_rank, node_name, args.local_workers)
@@ -0,0 +1,195 @@
+import os, json, hashlib
+import numpy as np
+
+from quadtree import *
+from shapely.geometry import shape
+
+from datetime import datetime
+
+"""
+    Persisted coverage index written by quadtree_index_mpi.py
+
+    {cov_out_dir}/manifest.json               written by rank 0, lists the parts
+    {cov_out_dir}/cov_index_gNNNN_rNNNN.npz   one columnar part per worker rank
+                                              and index generation
+
+    Each part holds one row per (feature, quadtree tile) pair:
+        ft_id       int64   feature index in the coverage shapefile when indexed
+        tile_code   uint64  see quadtree.get_tile_code()
+        depth       uint8
+        ix, iy      uint32
+        node_type   uint8   QuadTreeNodeType
+    and, if written with WKB, the clipped tile geometries as one byte buffer:
+        wkb         uint8   concatenated WKB
+        wkb_offsets int64   row i is wkb[wkb_offsets[i]:wkb_offsets[i+1]]
+
+    The manifest also maps every live feature, by its stable BLOCK_NAME key,
+    to its current ft_id, content hash, and the generation whose parts hold
+    its covers under 'part_ft_id' (the ft_id it had when indexed). FIDs shift
+    when a block is deleted or the shapefile is rewritten, so an incremental
+    run matches features by key: only added or changed features are indexed
+    into a new generation; rows of older generations for those features, and
+    of deleted (tombstoned) features, are dead.
+"""
+
+INDEX_MANIFEST_NAME = "manifest.json"
+INDEX_MANIFEST_VERSION = 2
+INDEX_FEATURE_KEY = "BLOCK_NAME"
+
+def get_part_name(rank, generation=0):
+    return f"cov_index_g{generation:04d}_r{rank:04d}.npz"
+
+def get_feature_hash(feature):
+    """Content hash of a coverage feature's geometry and properties"""
+    feature_hash = hashlib.sha1(shape(feature["geometry"]).wkb)
+    feature_hash.update(json.dumps(dict(feature["properties"]), sort_keys=True, default=str).encode())
+    return feature_hash.hexdigest()
+
+def get_feature_key(feature):
+    """Stable key of a coverage feature, unlike its FID"""
+    return str(feature["properties"][INDEX_FEATURE_KEY])
+
+def get_feature_records(feature_list):
+    """{ft_key: (ft_id, hash)} of the features of {feature_list}"""
+    feature_records = dict()
+    for feature in feature_list:
+        ft_key = get_feature_key(feature)
+        if ft_key in feature_records:
+            raise ValueError(f"Duplicate {INDEX_FEATURE_KEY} [{ft_key}] in coverage")
+        feature_records[ft_key] = (int(feature["id"]), get_feature_hash(feature))
+    return feature_records
+
+def merge_feature_records(feature_records_list):
+    """Merge the {ft_key: (ft_id, hash)} of several workers, raising on duplicate keys"""
+    feature_records = dict()
+    for worker_records in feature_records_list:
+        for ft_key, ft_record in worker_records.items():
+            if ft_key in feature_records:
+                raise ValueError(f"Duplicate {INDEX_FEATURE_KEY} [{ft_key}] in coverage")
+            feature_records[ft_key] = ft_record
+    return feature_records
+
+def is_incremental_manifest(manifest):
+    """Whether {manifest} keys its features by INDEX_FEATURE_KEY, i.e. can seed an incremental run"""
+    return (manifest.get('version', 0) >= INDEX_MANIFEST_VERSION and 'features' in manifest
+            and manifest.get('feature_key') == INDEX_FEATURE_KEY)
+
+def get_index_delta(prev_features, feature_records):
+    """
+    Compare {feature_records} ({ft_key: (ft_id, hash)}) against the
+    features of a previous manifest
+    Returns (added or changed ft_keys, deleted ft_keys)"""
+    changed_keys = [ ft_key for ft_key, (_, ft_hash) in feature_records.items()
+                     if ft_key not in prev_features or prev_features[ft_key]['hash'] != ft_hash ]
+    deleted_keys = [ ft_key for ft_key in prev_features if ft_key not in feature_records ]
+    return changed_keys, deleted_keys
+
+def get_live_features(manifest):
+    """
+    {generation: (part_ft_ids, ft_ids)} of the live features, sorted by the
+    ft_id their covers were written with"""
+    generation_lists = dict()
+    for ft_info in manifest['features'].values():
+        generation_lists.setdefault(ft_info['generation'], []).append((ft_info['part_ft_id'], ft_info['ft_id']))
+    live_features = dict()
+    for generation, id_list in generation_lists.items():
+        id_array = np.array(sorted(id_list), dtype=np.int64).reshape(-1, 2)
+        live_features[generation] = (id_array[:, 0], id_array[:, 1])
+    return live_features
+
+def get_live_rows(live_features, part_info, part):
+    """
+    Boolean mask of the rows of {part} that are still live, and the current
+    ft_id of every row (-1 where dead)"""
+    part_ft_ids = part['ft_id']
+    live_rows = np.zeros(len(part_ft_ids), dtype=bool)
+    ft_ids = np.full(len(part_ft_ids), -1, dtype=np.int64)
+    generation = part_info.get('generation', 0)
+    if generation not in live_features or len(part_ft_ids) == 0:
+        return live_rows, ft_ids
+    live_part_ids, live_ft_ids = live_features[generation]
+    pos = np.minimum(np.searchsorted(live_part_ids, part_ft_ids), len(live_part_ids) - 1)
+    live_rows = live_part_ids[pos] == part_ft_ids
+    ft_ids[live_rows] = live_ft_ids[pos[live_rows]]
+    return live_rows, ft_ids
+
+def get_feature_hashes_by_id(manifest):
+    """{ft_id: hash} of the live features of {manifest}"""
+    return { ft_info['ft_id']: ft_info['hash'] for ft_info in manifest['features'].values() }
+
+def build_cover_columns(feature_covers, with_wkb=False):
+    """
+    Flatten per-feature covers into index columns
+    #NOTE: each item of {feature_covers} is a dict with 'ft_id' and 'qtree_tiles',
+    and 'intersected_tiles' (aligned with 'qtree_tiles') if {with_wkb}"""
+    ft_ids, depths, ixs, iys, node_types = [], [], [], [], []
+    wkb_list = []
+    for ft_cover in feature_covers:
+        for tile_idx, qtree_tile in enumerate(ft_cover["qtree_tiles"]):
+            depth, ix, iy = qtree_tile.tile_address()
+            ft_ids.append(ft_cover["ft_id"])
+            depths.append(depth)
+            ixs.append(ix)
+            iys.append(iy)
+            node_types.append(int(qtree_tile.node_type))
+            if with_wkb:
+                wkb_list.append(ft_cover["intersected_tiles"][tile_idx].wkb)
+
+    columns = {
+        'ft_id':     np.array(ft_ids, dtype=np.int64),
+        'depth':     np.array(depths, dtype=np.uint8),
+        'ix':        np.array(ixs, dtype=np.uint32),
+        'iy':        np.array(iys, dtype=np.uint32),
+        'node_type': np.array(node_types, dtype=np.uint8),
+    }
+    columns['tile_code'] = get_tile_code(columns['depth'], columns['ix'], columns['iy'])
+
+    if with_wkb:
+        wkb_offsets = np.zeros(len(wkb_list) + 1, dtype=np.int64)
+        wkb_offsets[1:] = np.cumsum([len(wkb) for wkb in wkb_list])
+        columns['wkb'] = np.frombuffer(b"".join(wkb_list), dtype=np.uint8)
+        columns['wkb_offsets'] = wkb_offsets
+
+    return columns
+
+def write_cover_part(out_dir, rank, columns, generation=0):
+    part_name = get_part_name(rank, generation)
+    np.savez(os.path.join(out_dir, part_name), **columns)
+    return part_name
+
+def read_cover_part(out_dir, part_name):
+    with np.load(os.path.join(out_dir, part_name)) as part:
+        return { key: part[key] for key in part.files }
+
+def get_part_wkb(columns, row):
+    return columns['wkb'][columns['wkb_offsets'][row]:columns['wkb_offsets'][row+1]].tobytes()
+
+def write_manifest(out_dir, cov_shp, tile_size, feature_count, part_list, feature_dict,
+                   generation=0, tombstones=None, with_wkb=False):
+    manifest = {
+        'version': INDEX_MANIFEST_VERSION,
+        'created': datetime.now().isoformat(),
+        'cov_shp': os.path.abspath(cov_shp),
+        'tile_size': tile_size,
+        'base_quadtree': local_config.BASE_QUADTREE,
+        'max_depth': QTREE_MAX_DEPTH,
+        'feature_count': feature_count,
+        'generation': generation,
+        'with_wkb': with_wkb,
+        'parts': part_list,
+        'feature_key': INDEX_FEATURE_KEY,
+        'features': feature_dict,
+        'tombstones': tombstones if tombstones is not None else {},
+    }
+    with open(os.path.join(out_dir, INDEX_MANIFEST_NAME), 'w') as manifest_fh:
+        json.dump(manifest, manifest_fh, indent=2)
+    return manifest
+
+def read_manifest(out_dir):
+    with open(os.path.join(out_dir, INDEX_MANIFEST_NAME)) as manifest_fh:
+        return json.load(manifest_fh)
+
+def read_manifest_if_exists(out_dir):
+    if not os.path.exists(os.path.join(out_dir, INDEX_MANIFEST_NAME)):
+        return None
+    return read_manifest(out_dir)
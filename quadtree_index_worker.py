@@ -6,8 +6,9 @@ from shapely.ops import unary_union
 
 import rtree.index
 from quadtree import *
+from gen_base_quadtree import get_uncovered_area
 
-import itertools, argparse, random
+import itertools, argparse, random, heapq
 import local_config
 
 from pprint import pprint
@@ -23,7 +24,7 @@ def extract_poly_coords(geom):
     elif geom.type == 'MultiPolygon':
         exterior_coords = []
         interior_coords = []
-        for part in geom:
+        for part in geom.geoms:
             epc = extract_poly_coords(part)  # Recursive call
             exterior_coords += epc['exterior_coords']
             interior_coords += epc['interior_coords']
@@ -32,18 +33,63 @@ def extract_poly_coords(geom):
     return {'exterior_coords': exterior_coords,
             'interior_coords': interior_coords}
 
+def count_poly_vertices(geom):
+    """Return (exterior, interior) vertex counts, read off the coordinate arrays"""
+    if geom.geom_type == 'Polygon':
+        parts = [geom]
+    elif geom.geom_type == 'MultiPolygon':
+        parts = geom.geoms
+    else:
+        raise ValueError('Unhandled geometry type: ' + repr(geom.geom_type))
+    exterior_count = 0
+    interior_count = 0
+    for part in parts:
+        exterior_count += len(part.exterior.coords)
+        interior_count += sum(len(interior.coords) for interior in part.interiors)
+    return exterior_count, interior_count
+
 def count_feature_points(feature_list):
     point_count_dict_aggr = dict()
     for feature in feature_list:
         feat_geom = shape(feature["geometry"])
-        point_count_dict = extract_poly_coords(feat_geom)
+        exterior_count, interior_count = count_poly_vertices(feat_geom)
         point_count_dict_aggr[feature["properties"]["BLOCK_NAME"]] = {  
-            'exterior_coords': len(point_count_dict['exterior_coords']),
-            'interior_coords': len(point_count_dict['interior_coords']),
+            'exterior_coords': exterior_count,
+            'interior_coords': interior_count,
             'block_name': feature["properties"]["BLOCK_NAME"]}
 
     return point_count_dict_aggr
 
+def get_feature_cost(geom, tile_size=local_config.TILE_SIZE):
+    """
+    Cheap decomposition cost model: vertex count times bbox area in tiles
+    #NOTE: only used to balance ranks, not a time estimate"""
+    exterior_count, interior_count = count_poly_vertices(geom)
+    min_x, min_y, max_x, max_y = geom.bounds
+    bbox_tiles = max(1.0, (max_x - min_x) * (max_y - min_y) / (tile_size * tile_size))
+    return (exterior_count + interior_count) * bbox_tiles
+
+def assign_lpt(cost_list, num_bins):
+    """
+    Longest-processing-time-first assignment of items to {num_bins} bins
+    Returns (list of item index lists, list of bin loads)"""
+    bin_list = [ [] for _ in range(num_bins) ]
+    bin_loads = [ 0.0 ] * num_bins
+    bin_heap = [ (0.0, bin_idx) for bin_idx in range(num_bins) ]
+    for item_idx in sorted(range(len(cost_list)), key=lambda idx: cost_list[idx], reverse=True):
+        bin_load, bin_idx = heapq.heappop(bin_heap)
+        bin_list[bin_idx].append(item_idx)
+        bin_loads[bin_idx] = bin_load + cost_list[item_idx]
+        heapq.heappush(bin_heap, (bin_loads[bin_idx], bin_idx))
+    return bin_list, bin_loads
+
+def log_balance(label, load_list):
+    """Print max/mean of per-rank loads, 1.0 being perfectly balanced"""
+    mean_load = sum(load_list) / max(1, len(load_list))
+    max_load = max(load_list, default=0.0)
+    balance = max_load / mean_load if mean_load > 0 else 1.0
+    print(f"BALANCE|{label}|{balance:.3f}|max={max_load:.2f}|mean={mean_load:.2f}")
+
 def decompose_to_quadtree(feat_geom, tile_size):
     min_x = local_config.BASE_QUADTREE["min_x"]
     min_y = local_config.BASE_QUADTREE["min_y"]
@@ -99,6 +145,7 @@ def rec_qtree_decompose(qtree, geom, qtile_acc, qtile_length_limit=1024):
         return
 
     elif (qtree.boundary.to_shapely_poly().within(geom)):
+        qtree.node_type = QuadTreeNodeType.INSIDE
         qtile_acc.append(qtree)
         return
 
@@ -116,4 +163,39 @@ def rec_qtree_decompose(qtree, geom, qtile_acc, qtile_length_limit=1024):
         
         if qtree.sw.intersects_shapely_geom(geom):
             rec_qtree_decompose(qtree.sw, geom, qtile_acc, qtile_length_limit)
-        
\ No newline at end of file
+        
+
+def decompose_feature_geom(geom, qtile_length_limit=1024, seed_tiles=None):
+    """
+    Decompose {geom} from the BASE_QUADTREE root, or from the base quadtree
+    tiles {seed_tiles} when they cover it, returning detached leaf tiles"""
+    root_list = [ QuadTree(get_base_rect(), None) ]
+    if seed_tiles:
+        seed_list = [ QuadTree(tile_rect(*seed_tile), None, depth=seed_tile[0]) for seed_tile in seed_tiles ]
+        seed_list = [ seed_qtree for seed_qtree in seed_list if seed_qtree.intersects_shapely_geom(geom) ]
+        # Features added since the base quadtree was built may lie outside it
+        if get_uncovered_area(geom, seed_list) <= geom.area * 1e-9:
+            root_list = seed_list
+
+    qtile_acc = []
+    for root_qtree in root_list:
+        rec_qtree_decompose(root_qtree, geom, qtile_acc, qtile_length_limit)
+
+    # Drop parent links so tiles pickle without the whole tree
+    for qtree_tile in qtile_acc:
+        qtree_tile.parent = None
+    return qtile_acc
+
+def intersect_feature_tiles(geom, qtree_tiles):
+    """Clip INTERSECTS tiles to {geom}; INSIDE tiles are kept whole"""
+    # Repair once per feature, not once per tile
+    if not geom.is_valid:
+        geom = geom.buffer(0)
+
+    intersected_tiles = []
+    for qtree_tile in qtree_tiles:
+        if qtree_tile.node_type == QuadTreeNodeType.INTERSECTS:
+            intersected_tiles.append(qtree_tile.boundary.to_shapely_poly().intersection(geom))
+        else:
+            intersected_tiles.append(qtree_tile.boundary.to_shapely_poly())
+    return intersected_tiles
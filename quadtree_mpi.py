@@ -11,6 +11,7 @@ from quadtree import *
 
 import itertools, argparse, random
 import local_config
+from geom_preprocess import *
 
 from pprint import pprint
 from datetime import datetime
@@ -42,6 +43,8 @@ if __name__ == "__main__":
 
     parser.add_argument("cov_shp", help="Coverage shapefile")
     parser.add_argument("query_shp", help="Query shapefile")
+    parser.add_argument("--geom_cache_dir", help="Cache directory for preprocessed geometries")
+    parser.add_argument("--simplify", action="store_true", help="Simplify geometries with a tolerance tied to the tile size")
     args = parser.parse_args()
 
     cluster_comm = MPI.COMM_WORLD
@@ -59,7 +62,9 @@ if __name__ == "__main__":
             CLUS_query_feat_dict = dict(next(iter(query_sh)))
 
     CLUS_query_feat_dict         = cluster_comm.bcast(CLUS_query_feat_dict, root=0)
-    CLUS_query_shp_geom          = shape(CLUS_query_feat_dict['geometry'])
+    CLUS_simplify_tolerance      = get_simplify_tolerance(local_config.TILE_SIZE) if args.simplify else 0.0
+    CLUS_geom_cache              = GeometryCache(args.geom_cache_dir, CLUS_simplify_tolerance) if args.geom_cache_dir else None
+    CLUS_query_shp_geom          = prepare_geometry(shape(CLUS_query_feat_dict['geometry']), CLUS_geom_cache, CLUS_simplify_tolerance)
     CLUS_query_shp_geom_boundary = Rect.from_extents(*CLUS_query_shp_geom.bounds)
 
     if cluster_rank != 0:
@@ -10,6 +10,10 @@ import rtree.index
 
 import itertools, argparse, random
 
+import local_config
+from local_pool import *
+from geom_preprocess import *
+
 from pprint import pprint
 from datetime import datetime
 from itertools import islice
@@ -30,6 +34,14 @@ def log_time_diff(start_time, end_time, label="EXEC_TIME"):
     exec_time_millis = time_diff.total_seconds() * 1000
     print(f"EXECTIME|{label}|{exec_time_millis}|milliseconds")
 
+def intersect_feature_chunk(query_geom, feature_chunk, geom_cache=None, simplify_tolerance=0.0):
+    intersect_list = []
+    for idx, feature in feature_chunk:
+        feat_geom = prepare_geometry(shape(feature['geometry']), geom_cache, simplify_tolerance)
+        if query_geom.intersects(feat_geom):
+            intersect_list.append(idx)
+    return intersect_list
+
 # comm = MPI.COMM_WORLD
 # my_rank = cluster_comm.Get_rank()
 # num_procs = cluster_comm.Get_size()
@@ -40,8 +52,15 @@ if __name__ == "__main__":
 
     parser.add_argument("cov_shp", help="Coverage shapefile")
     parser.add_argument("query_shp", help="Query shapefile")
+    parser.add_argument("--geom_cache_dir", help="Cache directory for preprocessed geometries")
+    parser.add_argument("--simplify", action="store_true", help="Simplify geometries with a tolerance tied to the tile size")
+    parser.add_argument("--local_workers", type=int, default=1, help="Local pool workers per rank (use with one rank per node)")
+    parser.add_argument("--local_pool", choices=POOL_TYPES, default="process", help="Local pool type")
     args = parser.parse_args()
 
+    CLUS_simplify_tolerance = get_simplify_tolerance(local_config.TILE_SIZE) if args.simplify else 0.0
+    CLUS_geom_cache = GeometryCache(args.geom_cache_dir, CLUS_simplify_tolerance) if args.geom_cache_dir else None
+
     cluster_comm = MPI.COMM_WORLD
     cluster_size = cluster_comm.Get_size()
     cluster_worker_size = cluster_size-1
@@ -114,7 +133,7 @@ if __name__ == "__main__":
             print(f"R[{cluster_rank}] Finished indexing")
             log_time_diff(start_time, datetime.now(),label="INDEX_TREE") if cluster_rank==0 else None
             
-            query_geom = shape(query_feat_dict['geometry'])
+            query_geom = prepare_geometry(shape(query_feat_dict['geometry']), CLUS_geom_cache, CLUS_simplify_tolerance)
             query_rtree_res = list(rtree_idx.intersection(query_geom.bounds))
             print(f"R[{cluster_rank}] BBOX query result: (len={len(query_rtree_res)}) {query_rtree_res}")
             
@@ -139,13 +158,13 @@ if __name__ == "__main__":
     if cluster_rank != 0: #Distribute workload to workers only
         start_time = datetime.now() if cluster_rank == 0 else None
         intersect_list = []
-        query_geom = shape(query_feat_dict['geometry'])
-        for idx, feature in scatter_list:
-            feat_geom = shape(feature['geometry'])
-            feat_dict = feature['properties']
-            if query_geom.intersects(feat_geom):
-                # intersect_list.append(feat_dict['UID'])
-                intersect_list.append(idx)
+        query_geom = prepare_geometry(shape(query_feat_dict['geometry']), CLUS_geom_cache, CLUS_simplify_tolerance)
+        # Fan the chunk out to the local pool; runs inline with one local worker
+        chunk_list = split_by_mod(max(1, args.local_workers), scatter_list)
+        for chunk_intersect_list in map_local(intersect_feature_chunk,
+                                              [ (query_geom, chunk, CLUS_geom_cache, CLUS_simplify_tolerance) for chunk in chunk_list ],
+                                              args.local_workers, args.local_pool):
+            intersect_list.extend(chunk_intersect_list)
         print(f"R[{cluster_rank}] Query results:  {len(intersect_list)} -- {intersect_list}")
     
     #NOTE: Gather results
@@ -156,6 +175,9 @@ if __name__ == "__main__":
     
 
     log_time_diff(start_time, datetime.now(),label="COMM_INTERSECT_GATHER") if cluster_rank==0 else None
+
+    #NOTE: Report peak memory per node
+    log_node_memory(cluster_comm, cluster_rank, node_name, args.local_workers)
     
     MPI.Finalize
 
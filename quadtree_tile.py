@@ -1,18 +1,22 @@
 from quadtree import *
 import tile_raster
+from tile_writer import TileWriter, TILE_FORMATS, get_rect_geojson
 import os, sys
-import gdal, gdalconst
+from osgeo import gdal, gdalconst
+
+from datetime import datetime
+
+def log_time_diff(start_time, end_time, label="EXEC_TIME"):
+    time_diff = (end_time - start_time)
+    exec_time_millis = time_diff.total_seconds() * 1000
+    print(f"EXECTIME|{label}|{exec_time_millis:.2f}|milliseconds")
 
 def write_rect_to_shp(rect, shp_fh, properties_dict):
     """
     Write a {rect} into {shp_fg}
     #NOTE: {properties_dict} must adhere to schema of {shp_fh}"""
-    tile_nw = (rect.min_x, rect.max_y)
-    tile_sw = (rect.min_x, rect.min_y)
-    tile_se = (rect.max_x, rect.min_y)
-    tile_ne = (rect.max_x, rect.max_y)
     shp_fh.write({
-            'geometry': mapping(Polygon([tile_nw, tile_sw, tile_se, tile_ne])),
+            'geometry': get_rect_geojson(rect.min_x, rect.min_y, rect.max_x, rect.max_y),
             'properties': properties_dict,
         })
 
@@ -148,8 +152,14 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--query_shp", help="Output shapefile")
     parser.add_argument("--out_shp", help="Output shapefile")
+    parser.add_argument("--tile_format", choices=list(TILE_FORMATS), default="shp",
+                        help="Format of the --out_shp tiles, its extension follows the format")
     parser.add_argument("--in_raster", help="Input raster")
     parser.add_argument("--out_raster_dir", help="Input raster")
+    parser.add_argument("--engine", choices=["tiles", "vsimem"], default="tiles",
+                        help="tiles: search tiles only, vsimem: also clip --in_raster in one multithreaded GDAL warp,"
+                             " the pixels of quadtree_tile_rio.py --writer direct --exact_windows")
+    parser.add_argument("--num_threads", default="ALL_CPUS", help="GDAL warper and writer threads of the vsimem engine")
     args = parser.parse_args()
 
     
@@ -193,7 +203,7 @@ if __name__ == "__main__":
         print(f"QUERY BOUNDS: {shp_poly.bounds}")
         shp_poly_boundary = Rect.from_extents(*shp_poly.bounds)
         
-        with fiona.open(args.out_shp, 'w','ESRI Shapefile', out_shp_schema, crs=from_epsg(32651), ) as output_shp_fh:
+        with TileWriter(args.out_shp, out_shp_schema, args.tile_format, crs=from_epsg(32651)) as output_shp_fh:
             base_qt_dict = {
                 "TYPE" : 0,
                 "DEPTH" : 0,
@@ -223,6 +233,18 @@ if __name__ == "__main__":
         
     print(f"ACCUMULATED QTILES: {len(qtile_acc)}")
 
+    if args.engine == "vsimem":
+        # Same query and output name as quadtree_tile_rio.py, for benchmarking
+        with fiona.open(args.query_shp, 'r', 'ESRI Shapefile') as query_shp_fh:
+            query_wkt_list = [ shape(feature['geometry']).wkt for feature in query_shp_fh ]
+            query_bounds = query_shp_fh.bounds
+            query_prj = query_shp_fh.crs_wkt
+        raster_out_path = os.path.join(args.out_raster_dir, f"{os.path.basename(args.query_shp)}_merged.tif")
+        start_time = datetime.now()
+        tile_raster.clip_raster_vsimem(args.in_raster, query_wkt_list, query_bounds, raster_out_path,
+                                       query_prj, args.num_threads)
+        log_time_diff(start_time, datetime.now(), label="RASTER-WRITE_VSIMEM")
+
     sys.exit(0)
     
     pprint(qtile_acc[0].boundary)
@@ -0,0 +1,136 @@
+import os
+
+import fiona
+import shapely
+from shapely import wkb
+from shapely.geometry import shape, MultiPolygon
+
+from quadtree import *
+from quadtree_index_store import *
+from geom_preprocess import *
+from local_pool import *
+
+"""
+    Lazy clipping of coverage features to their quadtree tiles
+
+    Instead of clipping every INTERSECTS tile of every feature while indexing,
+    (feature, tile) pairs are clipped only when a query or raster clip touches
+    them. Results are memoized in memory and, with a memo directory, on disk
+    keyed by the feature's content hash, so they stay valid across incremental
+    re-indexing and are shared by repeated queries.
+"""
+
+def clip_feature_tiles(geom, tile_address_list):
+    """Clip {geom} to each (depth, ix, iy) tile, returning WKB"""
+    if not geom.is_valid:
+        geom = geom.buffer(0)
+    return [ tile_rect(*tile_address).to_shapely_poly().intersection(geom).wkb
+             for tile_address in tile_address_list ]
+
+def get_polygonal_part(geom):
+    """
+    Polygonal part of a clipped tile, or None when it has no area
+    #NOTE: tiles that only touch their feature clip to lines or points"""
+    polygon_list = [ part for part in shapely.get_parts(geom)
+                     if part.geom_type == 'Polygon' and not part.is_empty and part.area > 0 ]
+    if not polygon_list:
+        return None
+    return polygon_list[0] if len(polygon_list) == 1 else MultiPolygon(polygon_list)
+
+class LazyTileClipper:
+    """On-demand, memoized tile clipper over a coverage index"""
+
+    def __init__(self, index_dir, memo_dir=None, geom_cache=None, local_workers=1, local_pool="process"):
+        self.index_dir = index_dir
+        self.manifest = read_manifest(index_dir)
+        self.ft_hashes = get_feature_hashes_by_id(self.manifest)
+        self.memo_dir = memo_dir
+        self.geom_cache = geom_cache
+        self.local_workers = local_workers
+        self.local_pool = local_pool
+        self.memo = dict()
+        self.part_cache = dict()
+        self.hits = 0
+        self.misses = 0
+        if memo_dir is not None:
+            os.makedirs(memo_dir, exist_ok=True)
+
+    def get_memo_key(self, ft_id, depth, ix, iy):
+        ft_hash = self.ft_hashes[ft_id]
+        return f"{ft_hash}_{depth:02d}_{ix}_{iy}"
+
+    def get_memo_path(self, memo_key):
+        return os.path.join(self.memo_dir, memo_key[:2], f"{memo_key}.wkb")
+
+    def get_memo(self, memo_key):
+        if memo_key in self.memo:
+            return self.memo[memo_key]
+        if self.memo_dir is not None and os.path.exists(self.get_memo_path(memo_key)):
+            with open(self.get_memo_path(memo_key), 'rb') as memo_fh:
+                self.memo[memo_key] = memo_fh.read()
+            return self.memo[memo_key]
+        return None
+
+    def put_memo(self, memo_key, geom_wkb):
+        self.memo[memo_key] = geom_wkb
+        if self.memo_dir is not None:
+            memo_path = self.get_memo_path(memo_key)
+            os.makedirs(os.path.dirname(memo_path), exist_ok=True)
+            tmp_path = f"{memo_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as memo_fh:
+                memo_fh.write(geom_wkb)
+            os.replace(tmp_path, memo_path)
+
+    def get_part_wkb(self, part_idx, part_row):
+        """Clipped WKB written eagerly by quadtree_index_mpi --with_wkb, if any"""
+        if part_idx not in self.part_cache:
+            part_info = self.manifest['parts'][part_idx]
+            self.part_cache[part_idx] = read_cover_part(self.index_dir, part_info['file'])
+        part = self.part_cache[part_idx]
+        if 'wkb' not in part:
+            return None
+        return get_part_wkb(part, part_row)
+
+    def clip(self, tile_pair_list):
+        """
+        Clip a batch of (ft_id, depth, ix, iy, node_type, part_idx, part_row) pairs
+        Returns shapely geometries aligned with {tile_pair_list}"""
+        result_wkb = [ None ] * len(tile_pair_list)
+        pending_dict = dict()
+        for pair_idx, (ft_id, depth, ix, iy, node_type, part_idx, part_row) in enumerate(tile_pair_list):
+            if node_type != QuadTreeNodeType.INTERSECTS:
+                # INSIDE tiles clip to themselves
+                result_wkb[pair_idx] = tile_rect(depth, ix, iy).to_shapely_poly().wkb
+                continue
+
+            memo_key = self.get_memo_key(ft_id, depth, ix, iy)
+            geom_wkb = self.get_memo(memo_key)
+            if geom_wkb is None and part_idx is not None:
+                geom_wkb = self.get_part_wkb(part_idx, part_row)
+            if geom_wkb is not None:
+                self.hits += 1
+                result_wkb[pair_idx] = geom_wkb
+            else:
+                self.misses += 1
+                pending_dict.setdefault(ft_id, []).append((pair_idx, memo_key, (depth, ix, iy)))
+
+        if pending_dict:
+            # Read each pending feature once and clip its tiles as one batch
+            ft_id_list = sorted(pending_dict)
+            with fiona.open(self.manifest['cov_shp']) as cov_sh:
+                ft_geom_list = [ prepare_geometry(shape(cov_sh[ft_id]['geometry']), self.geom_cache)
+                                 for ft_id in ft_id_list ]
+            clip_arg_list = [ (ft_geom, [ tile_address for _, _, tile_address in pending_dict[ft_id] ])
+                              for ft_id, ft_geom in zip(ft_id_list, ft_geom_list) ]
+            clip_wkb_lists = map_local(clip_feature_tiles, clip_arg_list, self.local_workers, self.local_pool,
+                                       get_chunksize(len(clip_arg_list), self.local_workers))
+
+            for ft_id, clip_wkb_list in zip(ft_id_list, clip_wkb_lists):
+                for (pair_idx, memo_key, _), geom_wkb in zip(pending_dict[ft_id], clip_wkb_list):
+                    self.put_memo(memo_key, geom_wkb)
+                    result_wkb[pair_idx] = geom_wkb
+
+        return [ wkb.loads(geom_wkb) for geom_wkb in result_wkb ]
+
+    def __str__(self):
+        return f"LazyTileClipper[{self.index_dir}] hits={self.hits} misses={self.misses}"
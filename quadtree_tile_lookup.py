@@ -0,0 +1,235 @@
+import os, json, argparse
+import numpy as np
+
+import fiona
+from shapely.geometry import shape
+
+from quadtree import *
+from quadtree_index_worker import rec_qtree_decompose
+from quadtree_index_store import *
+from geom_preprocess import *
+from quadtree_tile_clip import LazyTileClipper, get_polygonal_part
+from local_pool import *
+
+from datetime import datetime
+
+"""
+    Inverted tile -> feature lookup built from quadtree_index_mpi.py output
+
+    {cov_out_dir}/lookup/*.npy holds one row per (tile, feature) pair, sorted
+    by (tile_code, depth), and is opened memory-mapped. Since every descendant
+    of a tile has a code in [code, code + tile_code_span(depth)), a query tile
+    finds its descendants with one range search and its ancestors with one
+    exact search per coarser depth.
+"""
+
+LOOKUP_DIR_NAME = "lookup"
+PART_COLUMNS = ['tile_code', 'depth', 'ix', 'iy', 'ft_id', 'node_type']
+LOOKUP_COLUMNS = PART_COLUMNS + ['part_idx', 'part_row']
+LOOKUP_DTYPES = {
+    'tile_code': np.uint64, 'depth': np.uint8, 'ix': np.uint32, 'iy': np.uint32,
+    'ft_id': np.int64, 'node_type': np.uint8, 'part_idx': np.uint16, 'part_row': np.uint32,
+}
+
+def log_time_diff(start_time, end_time, label="EXEC_TIME"):
+    time_diff = (end_time - start_time)
+    exec_time_millis = time_diff.total_seconds() * 1000
+    print(f"EXECTIME|{label}|{exec_time_millis:.2f}|milliseconds")
+
+def build_tile_lookup(index_dir):
+    manifest = read_manifest(index_dir)
+    live_features = get_live_features(manifest)
+    # Typed empty columns, so a manifest without parts gives an empty lookup
+    column_lists = { column: [np.empty(0, dtype=LOOKUP_DTYPES[column])] for column in LOOKUP_COLUMNS }
+    for part_idx, part_info in enumerate(manifest['parts']):
+        part = read_cover_part(index_dir, part_info['file'])
+        # Skip rows superseded by a later generation or tombstoned, and
+        # point the rest at the features' current FIDs
+        live_rows, part['ft_id'] = get_live_rows(live_features, part_info, part)
+        for column in PART_COLUMNS:
+            column_lists[column].append(part[column][live_rows])
+        column_lists['part_idx'].append(np.full(live_rows.sum(), part_idx, dtype=np.uint16))
+        column_lists['part_row'].append(np.nonzero(live_rows)[0].astype(np.uint32))
+
+    columns = { column: np.concatenate(arr_list) for column, arr_list in column_lists.items() }
+    sort_order = np.lexsort((columns['depth'], columns['tile_code']))
+
+    lookup_dir = os.path.join(index_dir, LOOKUP_DIR_NAME)
+    os.makedirs(lookup_dir, exist_ok=True)
+    for column, arr in columns.items():
+        np.save(os.path.join(lookup_dir, f"{column}.npy"), arr[sort_order])
+
+    lookup_meta = {
+        'rows': len(sort_order),
+        'depth_levels': sorted(int(depth) for depth in np.unique(columns['depth'])),
+        'tile_size': manifest['tile_size'],
+    }
+    with open(os.path.join(lookup_dir, "lookup.json"), 'w') as meta_fh:
+        json.dump(lookup_meta, meta_fh, indent=2)
+
+    print(f"Built tile lookup: {lookup_meta['rows']} rows at depths {lookup_meta['depth_levels']}")
+    return lookup_meta
+
+class TileLookup:
+    """Memory-mapped, sorted tile -> feature table"""
+
+    def __init__(self, index_dir):
+        lookup_dir = os.path.join(index_dir, LOOKUP_DIR_NAME)
+        with open(os.path.join(lookup_dir, "lookup.json")) as meta_fh:
+            self.meta = json.load(meta_fh)
+        for column in LOOKUP_COLUMNS:
+            setattr(self, column, np.load(os.path.join(lookup_dir, f"{column}.npy"), mmap_mode='r'))
+
+    def match(self, q_depth, q_code):
+        """
+        Find all lookup rows on, below or above the query tiles
+        Returns (query index, lookup row, query tile contains row tile) arrays"""
+        q_depth = np.asarray(q_depth, dtype=np.uint8)
+        q_code = np.asarray(q_code, dtype=np.uint64)
+        if len(q_code) == 0 or len(self.tile_code) == 0:
+            # A query without tiles or an empty lookup
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=bool)
+        q_idx_list, row_list, contains_list = [], [], []
+
+        # Same tile and descendants: code range of each query tile
+        lo = np.searchsorted(self.tile_code, q_code, side='left')
+        hi = np.searchsorted(self.tile_code, q_code + tile_code_span(q_depth), side='left')
+        counts = hi - lo
+        if counts.sum():
+            q_idx = np.repeat(np.arange(len(q_code)), counts)
+            rows = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+            # Ancestors sharing the query's south-west corner also fall in range
+            keep = self.depth[rows] >= q_depth[q_idx]
+            q_idx_list.append(q_idx[keep])
+            row_list.append(rows[keep])
+            contains_list.append(np.ones(keep.sum(), dtype=bool))
+
+        # Strict ancestors: exact code match at each coarser depth level
+        for anc_depth in self.meta['depth_levels']:
+            q_sel = np.nonzero(q_depth > anc_depth)[0]
+            if len(q_sel) == 0:
+                continue
+            anc_span = np.uint64(tile_code_span(anc_depth))
+            anc_code = q_code[q_sel] - (q_code[q_sel] % anc_span)
+            lo = np.searchsorted(self.tile_code, anc_code, side='left')
+            hi = np.searchsorted(self.tile_code, anc_code, side='right')
+            counts = hi - lo
+            if counts.sum() == 0:
+                continue
+            q_idx = np.repeat(q_sel, counts)
+            rows = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+            keep = self.depth[rows] == anc_depth
+            q_idx_list.append(q_idx[keep])
+            row_list.append(rows[keep])
+            contains_list.append(np.zeros(keep.sum(), dtype=bool))
+
+        if not q_idx_list:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=bool)
+        return np.concatenate(q_idx_list), np.concatenate(row_list), np.concatenate(contains_list)
+
+def match_query_tiles(tile_lookup, query_qtiles):
+    """
+    Join the query's quadtree tiles against {tile_lookup}
+    A pair is resolved without geometry when the containing tile is INSIDE its
+    own geometry: the other geometry touches the contained tile, hence the first
+    geometry as well. All other pairs are only candidates.
+    Returns (lookup rows, resolved) arrays, one item per matched pair"""
+    q_address = np.array([ qtile.tile_address() for qtile in query_qtiles ], dtype=np.int64).reshape(-1, 3)
+    q_depth = q_address[:,0].astype(np.uint8)
+    q_code = get_tile_code(q_depth, q_address[:,1], q_address[:,2])
+    q_node_type = np.array([ int(qtile.node_type) for qtile in query_qtiles ], dtype=np.uint8)
+
+    q_idx, rows, q_contains = tile_lookup.match(q_depth, q_code)
+    ft_ids = np.asarray(tile_lookup.ft_id[rows])
+    container_type = np.where(q_contains, q_node_type[q_idx], tile_lookup.node_type[rows])
+    resolved = container_type == QuadTreeNodeType.INSIDE
+    return rows, resolved
+
+def query_tile_lookup(tile_lookup, query_qtiles):
+    """Returns (resolved feature ids, unresolved candidate feature ids)"""
+    rows, resolved = match_query_tiles(tile_lookup, query_qtiles)
+    ft_ids = np.asarray(tile_lookup.ft_id[rows])
+    resolved_ids = np.unique(ft_ids[resolved])
+    candidate_ids = np.setdiff1d(np.unique(ft_ids), resolved_ids)
+    return resolved_ids, candidate_ids
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Build or query the tile lookup of a coverage index",
+                                     epilog="Example: quadtree_tile_lookup.py cov_out_dir --query_shp query.shp")
+    parser.add_argument("cov_out_dir", help="Coverage output directory of quadtree_index_mpi.py")
+    parser.add_argument("--build", action="store_true", help="(Re)build the lookup from the index parts")
+    parser.add_argument("--query_shp", help="Query shapefile")
+    parser.add_argument("--geom_cache_dir", help="Cache directory for preprocessed geometries")
+    parser.add_argument("--refine", action="store_true", help="Resolve remaining candidates against coverage geometries")
+    parser.add_argument("--clip_shp", help="Write coverage tiles touched by the query, clipped to their features")
+    parser.add_argument("--clip_memo_dir", help="Memo directory for lazily clipped tiles")
+    parser.add_argument("--local_workers", type=int, default=1, help="Local pool workers for clipping")
+    parser.add_argument("--local_pool", choices=POOL_TYPES, default="process", help="Local pool type")
+    args = parser.parse_args()
+
+    if args.build:
+        start_time = datetime.now()
+        build_tile_lookup(args.cov_out_dir)
+        log_time_diff(start_time, datetime.now(), label="LOOKUP-BUILD")
+
+    if args.query_shp:
+        tile_lookup = TileLookup(args.cov_out_dir)
+        with fiona.open(args.query_shp) as query_sh:
+            geom_cache = GeometryCache(args.geom_cache_dir) if args.geom_cache_dir else None
+            query_geom = prepare_geometry(shape(next(iter(query_sh))['geometry']), geom_cache)
+
+        start_time = datetime.now()
+        query_qtiles = []
+        rec_qtree_decompose(QuadTree(get_base_rect(), None), query_geom, query_qtiles,
+                            qtile_length_limit=tile_lookup.meta['tile_size'])
+        log_time_diff(start_time, datetime.now(), label="LOOKUP-QUERY_DECOMPOSE")
+
+        start_time = datetime.now()
+        resolved_ids, candidate_ids = query_tile_lookup(tile_lookup, query_qtiles)
+        log_time_diff(start_time, datetime.now(), label="LOOKUP-QUERY_JOIN")
+        print(f"Query tiles: {len(query_qtiles)}")
+        print(f"Resolved: {len(resolved_ids)} -- {resolved_ids.tolist()}")
+        print(f"Candidates: {len(candidate_ids)} -- {candidate_ids.tolist()}")
+
+        if args.refine:
+            start_time = datetime.now()
+            manifest = read_manifest(args.cov_out_dir)
+            with fiona.open(manifest['cov_shp']) as cov_sh:
+                refined_ids = [ ft_id for ft_id in candidate_ids.tolist()
+                                if query_geom.intersects(shape(cov_sh[ft_id]['geometry'])) ]
+            log_time_diff(start_time, datetime.now(), label="LOOKUP-QUERY_REFINE")
+            print(f"Refined: {len(refined_ids)} -- {refined_ids}")
+            print(f"Intersected: {len(resolved_ids) + len(refined_ids)} -- {sorted(resolved_ids.tolist() + refined_ids)}")
+        else:
+            refined_ids = candidate_ids.tolist()
+
+        if args.clip_shp:
+            # Clip only the coverage tiles the query touches, of intersected features
+            start_time = datetime.now()
+            rows, _ = match_query_tiles(tile_lookup, query_qtiles)
+            rows = np.unique(rows)
+            rows = rows[np.isin(tile_lookup.ft_id[rows], np.concatenate([resolved_ids, refined_ids]))]
+            tile_pair_list = [ (int(tile_lookup.ft_id[row]), int(tile_lookup.depth[row]),
+                                int(tile_lookup.ix[row]), int(tile_lookup.iy[row]),
+                                int(tile_lookup.node_type[row]),
+                                int(tile_lookup.part_idx[row]), int(tile_lookup.part_row[row])) for row in rows ]
+            tile_clipper = LazyTileClipper(args.cov_out_dir, memo_dir=args.clip_memo_dir, geom_cache=geom_cache,
+                                           local_workers=args.local_workers, local_pool=args.local_pool)
+            clipped_geom_list = tile_clipper.clip(tile_pair_list)
+            log_time_diff(start_time, datetime.now(), label="LOOKUP-QUERY_CLIP")
+            print(tile_clipper)
+
+            clip_shp_schema = {
+                'geometry': 'Polygon',
+                'properties': dict([('FT_ID', 'int:10'), ('DEPTH', 'int:5'), ('IX', 'int:10'), ('IY', 'int:10'), ('TYPE', 'int:2')])
+                }
+            with fiona.open(args.clip_shp, 'w', 'ESRI Shapefile', clip_shp_schema, crs=from_epsg(32651)) as clip_shp_fh:
+                for (ft_id, depth, ix, iy, node_type, _, _), clipped_geom in zip(tile_pair_list, clipped_geom_list):
+                    clipped_geom = get_polygonal_part(clipped_geom)
+                    if clipped_geom is None:
+                        continue
+                    clip_shp_fh.write({
+                        'geometry': mapping(clipped_geom),
+                        'properties': {'FT_ID': ft_id, 'DEPTH': depth, 'IX': ix, 'IY': iy, 'TYPE': node_type},
+                    })
@@ -1,13 +1,24 @@
 from contextlib import contextmanager
-import os
+from collections import deque
+import os, threading
+import concurrent.futures
 
 from quadtree import *
 import tile_raster_rio
+from tile_writer import TileWriter, TILE_FORMATS, get_rect_geojson
+from geom_preprocess import *
+from raster_tile_cache import *
+from raster_catalogue import RasterCatalogue, clip_tiles_catalogue
+from raster_validity import RasterValidity
+from gen_base_quadtree import load_base_quadtree, get_seed_qtrees, log_uncovered_area
 import rasterio as rio
-from rasterio import Affine, MemoryFile
+from rasterio import Affine, MemoryFile, windows
 import rasterio.mask
+from rasterio.features import geometry_mask, geometry_window
 from rasterio.merge import merge
 
+from datetime import datetime
+
 
 @contextmanager
 def write_mem_raster(data, **profile):
@@ -31,12 +42,8 @@ def write_rect_to_shp(rect, shp_fh, properties_dict):
     """
     Write a {rect} into {shp_fg}
     #NOTE: {properties_dict} must adhere to schema of {shp_fh}"""
-    tile_nw = (rect.min_x, rect.max_y)
-    tile_sw = (rect.min_x, rect.min_y)
-    tile_se = (rect.max_x, rect.min_y)
-    tile_ne = (rect.max_x, rect.max_y)
     shp_fh.write({
-            'geometry': mapping(Polygon([tile_nw, tile_sw, tile_se, tile_ne])),
+            'geometry': get_rect_geojson(rect.min_x, rect.min_y, rect.max_x, rect.max_y),
             'properties': properties_dict,
         })
 
@@ -129,14 +136,477 @@ def rec_tile_search(quadtree, query_shp_geom, query_shp_geom_boundary, out_shp_f
             rec_tile_search(quadtree.sw, query_shp_geom, query_shp_geom_boundary, out_shp_fh, qtile_properties_dict, qtile_length_limit, qtile_acc)
         
 
+def log_time_diff(start_time, end_time, label="EXEC_TIME"):
+    time_diff = (end_time - start_time)
+    exec_time_millis = time_diff.total_seconds() * 1000
+    print(f"EXECTIME|{label}|{exec_time_millis:.2f}|milliseconds")
+
+def get_qtile_window(raster_ds, qtile):
+    return tile_raster_rio.get_tile_window_from_extents(raster_ds,
+        qtile.boundary.min_x, qtile.boundary.min_y, qtile.boundary.max_x, qtile.boundary.max_y, tile_size=1024)
+
+def get_qtile_windows(raster_ds, qtile_acc, exact_windows=False):
+    """
+    Source window of every tile, padded by 5 pixels, or with {exact_windows}
+    planned at once from the tile extents by pixel centre"""
+    if not exact_windows:
+        return [ get_qtile_window(raster_ds, qtile) for qtile in qtile_acc ]
+    qtile_extents = np.array([ (qtile.boundary.min_x, qtile.boundary.min_y, qtile.boundary.max_x, qtile.boundary.max_y)
+                               for qtile in qtile_acc ], dtype=np.float64)
+    return tile_raster_rio.to_windows(tile_raster_rio.get_tile_windows_from_extents(raster_ds.transform, qtile_extents))
+
+def read_tile_windows(raster_ds, tile_window_list, coalesce=False):
+    """Yield the data of every tile window, in order"""
+    if coalesce:
+        yield from tile_raster_rio.read_coalesced(raster_ds, tile_window_list)
+    else:
+        for tile_window in tile_window_list:
+            yield raster_ds.read(window=tile_window)
+
+def clip_tiles_merge(raster_ds, qtile_acc, query_shapes, raster_out_path, coalesce=False, mask_mode="tile",
+                     out_format="gtiff", exact_windows=False, raster_validity=None, tile_cache=None, tile_size=1024):
+    """
+    Clip every tile into an in-memory dataset, then merge them all
+    Tiles over only nodata blocks of {raster_validity} are skipped. INSIDE
+    tiles come from {tile_cache} when given.
+    #NOTE: keeps every tile dataset open until the merge"""
+    raster_meta = raster_ds.meta.copy()
+    nodata = raster_ds.nodata if raster_ds.nodata is not None else 0
+    query_masker = get_query_masker(raster_ds, query_shapes, mask_mode)
+    if query_masker is None:
+        return
+    #tile_window = get_tile_window(raster_ds, cx, cy, tile_size=width)
+    tile_window_list = get_qtile_windows(raster_ds, qtile_acc, exact_windows)
+    if raster_validity is not None:
+        valid_tile_list = raster_validity.prune(zip(qtile_acc, tile_window_list), shrink=False)
+        qtile_acc = [ qtile for qtile, _ in valid_tile_list ]
+        tile_window_list = [ tile_window for _, tile_window in valid_tile_list ]
+    tile_ds_list = []
+    if tile_cache is not None:
+        tile_clip_iter = read_tiles_cached(raster_ds, list(zip(qtile_acc, tile_window_list)), tile_cache,
+                                           get_raster_id(raster_ds.name), coalesce)
+    else:
+        tile_clip_iter = read_tile_windows(raster_ds, tile_window_list, coalesce)
+    for tile_num in range(len(qtile_acc)):
+        tile_window = tile_window_list[tile_num]
+
+        # Read the data in the window
+        # clip is a nbands * N * N numpy array
+        clip = next(tile_clip_iter)
+
+        # You can then write out a new file
+        meta = raster_ds.meta
+        meta['width'], meta['height'] = tile_window.width, tile_window.height
+        temp_gt = rio.windows.transform(tile_window, raster_ds.transform)
+        meta['transform'] = temp_gt
+
+        if qtile_acc[tile_num].node_type == QuadTreeNodeType.INTERSECTS:
+            # Crop to the query window like mask(crop=True), mask like the other writers
+            crop_window = tile_window.intersection(query_masker.query_window)
+            row_off, col_off = crop_window.row_off - tile_window.row_off, crop_window.col_off - tile_window.col_off
+            masked_clip = clip[:, row_off:row_off+crop_window.height, col_off:col_off+crop_window.width]
+            masked_clip[:, query_masker.get_outside_mask(crop_window)] = nodata
+            meta.update({"driver": "GTiff",
+                    "height": masked_clip.shape[1],
+                    "width": masked_clip.shape[2],
+                    "transform": windows.transform(crop_window, raster_ds.transform)})
+            masked_ds = write_mem_raster_no_yield(masked_clip, **meta)
+            tile_ds_list.append(masked_ds)
+            print("INTERSECT -- "+str(masked_ds))
+        else:
+            clip_ds = write_mem_raster_no_yield(clip, **meta)
+            print("WITHIN >>> " + str(clip_ds))
+            tile_ds_list.append(clip_ds)
+    
+    merge_ds, merge_transform = merge(tile_ds_list)
+    raster_meta.update({"driver": "GTiff",
+                        "height": merge_ds.shape[1],
+                        "width": merge_ds.shape[2],
+                        "transform": merge_transform})
+        
+    tile_raster_rio.write_raster(raster_out_path, merge_ds, raster_meta, out_format=out_format, tile_size=tile_size)
+    
+    # Close Tile DS readers after writing to save memory
+    for tile_ds in tile_ds_list:
+        tile_ds.close()
+
+def get_direct_tile_windows(raster_ds, qtile_acc, query_window, exact_windows=False):
+    """
+    Source window of every tile, cropped like rasterio.mask.mask(crop=True)
+    for INTERSECTS tiles. Tiles left without pixels are dropped.
+    Returns a list of (qtile, window)"""
+    raster_bounds = windows.Window(0, 0, raster_ds.width, raster_ds.height)
+    tile_window_list = []
+    for qtile, tile_window in zip(qtile_acc, get_qtile_windows(raster_ds, qtile_acc, exact_windows)):
+        try:
+            tile_window = tile_window.intersection(raster_bounds)
+            if qtile.node_type == QuadTreeNodeType.INTERSECTS:
+                tile_window = tile_window.intersection(query_window)
+        except rasterio.errors.WindowError:
+            continue
+        if tile_window.width <= 0 or tile_window.height <= 0:
+            continue
+        tile_window_list.append((qtile, tile_window))
+    return tile_window_list
+
+MASK_MODES = ["tile", "once", "clipped"]
+
+def get_pixel_geom(geom, raster_transform):
+    """
+    {geom} in the pixel coordinates of {raster_transform}
+    #NOTE: assumes a north-up raster, subtracts then divides so coordinates on
+    the pixel grid stay exact"""
+    return shapely.transform(geom, lambda coords: np.column_stack(
+        ((coords[:, 0] - raster_transform.c) / raster_transform.a,
+         (coords[:, 1] - raster_transform.f) / raster_transform.e)))
+
+def get_window_pixel_transform(window):
+    return Affine.translation(window.col_off, window.row_off)
+
+class QueryMasker:
+    """
+    Outside-the-query pixel masks of tile windows
+    tile:    rasterize all of {query_shapes} for every tile
+    once:    rasterize {query_shapes} once over the query window, slice per tile
+    clipped: rasterize only the query polygons whose bounds reach each tile
+    #NOTE: every mode rasterizes the query in raster pixel coordinates, which
+    a window only shifts by whole pixels, and polygons are never cut, so
+    every mode masks the same pixels, also pixel centres on a query edge"""
+
+    def __init__(self, raster_ds, query_shapes, mask_mode="tile"):
+        self.mask_mode = mask_mode
+        self.query_window = geometry_window(raster_ds, query_shapes)
+        self.query_pixel_shapes = [ mapping(get_pixel_geom(shape(query_shape), raster_ds.transform))
+                                    for query_shape in query_shapes ]
+        if mask_mode == "once":
+            self.query_window = self.query_window.round_offsets().round_lengths()
+            self.query_outside = geometry_mask(self.query_pixel_shapes,
+                                               out_shape=(self.query_window.height, self.query_window.width),
+                                               transform=get_window_pixel_transform(self.query_window))
+        elif mask_mode == "clipped":
+            self.query_parts = shapely.get_parts([ shape(query_shape) for query_shape in self.query_pixel_shapes ])
+            self.query_part_tree = shapely.STRtree(self.query_parts)
+
+    def get_outside_mask(self, tile_window):
+        tile_window = tile_window.round_offsets().round_lengths()
+        tile_transform = get_window_pixel_transform(tile_window)
+        out_shape = (tile_window.height, tile_window.width)
+
+        if self.mask_mode == "once":
+            # Pixels outside the query window are outside the query
+            outside_mask = np.ones(out_shape, dtype=bool)
+            try:
+                overlap = tile_window.intersection(self.query_window)
+            except rasterio.errors.WindowError:
+                return outside_mask
+            row_off, col_off = overlap.row_off - tile_window.row_off, overlap.col_off - tile_window.col_off
+            q_row_off, q_col_off = overlap.row_off - self.query_window.row_off, overlap.col_off - self.query_window.col_off
+            outside_mask[row_off:row_off+overlap.height, col_off:col_off+overlap.width] = \
+                self.query_outside[q_row_off:q_row_off+overlap.height, q_col_off:q_col_off+overlap.width]
+            return outside_mask
+
+        elif self.mask_mode == "clipped":
+            # Polygons away from the tile hold none of its pixel centres
+            part_idx = self.query_part_tree.query(shapely.box(tile_window.col_off, tile_window.row_off,
+                                                              tile_window.col_off + tile_window.width,
+                                                              tile_window.row_off + tile_window.height))
+            if len(part_idx) == 0:
+                return np.ones(out_shape, dtype=bool)
+            return geometry_mask([ mapping(part) for part in self.query_parts[np.sort(part_idx)] ],
+                                 out_shape=out_shape, transform=tile_transform)
+
+        return geometry_mask(self.query_pixel_shapes, out_shape=out_shape, transform=tile_transform)
+
+def get_query_masker(raster_ds, query_shapes, mask_mode="tile"):
+    """QueryMasker of {query_shapes}, or None when the query does not overlap {raster_ds}"""
+    try:
+        return QueryMasker(raster_ds, query_shapes, mask_mode)
+    except rasterio.errors.WindowError:
+        print(f"Query does not overlap raster [{raster_ds.name}], skipping")
+        return None
+
+def verify_mask_modes(raster_ds, qtile_acc, query_shapes, exact_windows=False):
+    """
+    Compare the outside masks of every MASK_MODES mode over the INTERSECTS
+    tile windows of {qtile_acc}
+    Returns the number of tiles whose masks differ"""
+    query_masker_list = [ get_query_masker(raster_ds, query_shapes, mask_mode) for mask_mode in MASK_MODES ]
+    if query_masker_list[0] is None:
+        return 0
+    mismatch_count = 0
+    for qtile, tile_window in get_direct_tile_windows(raster_ds, qtile_acc, query_masker_list[0].query_window, exact_windows):
+        if qtile.node_type != QuadTreeNodeType.INTERSECTS:
+            continue
+        tile_mask = query_masker_list[0].get_outside_mask(tile_window)
+        if not all(np.array_equal(tile_mask, query_masker.get_outside_mask(tile_window))
+                   for query_masker in query_masker_list[1:]):
+            mismatch_count += 1
+    return mismatch_count
+
+def mask_tile_clip(qtile, tile_window, clip, query_masker, nodata):
+    """Set pixels of an INTERSECTS tile outside the query to {nodata}"""
+    if qtile.node_type == QuadTreeNodeType.INTERSECTS:
+        clip[:, query_masker.get_outside_mask(tile_window)] = nodata
+    return clip
+
+class ThreadLocalRaster:
+    """One open dataset handle per thread, GDAL handles are not thread-safe"""
+
+    def __init__(self, raster_path):
+        self.raster_path = raster_path
+        self.local = threading.local()
+        self.ds_list = []
+        self.lock = threading.Lock()
+
+    def get_ds(self):
+        if not hasattr(self.local, "ds"):
+            self.local.ds = rio.open(self.raster_path)
+            with self.lock:
+                self.ds_list.append(self.local.ds)
+        return self.local.ds
+
+    def close(self):
+        for ds in self.ds_list:
+            ds.close()
+        self.ds_list = []
+
+def read_tiles_cached(raster_ds, tile_window_list, tile_cache, raster_id, coalesce=False):
+    """
+    Yield the data of every (qtile, window), in order, INSIDE tiles from
+    {tile_cache} when stored there. Tiles not served from the cache are read
+    together (coalesced if asked) and INSIDE ones are stored."""
+    cached = [ qtile.node_type == QuadTreeNodeType.INSIDE and tile_cache.contains(raster_id, qtile.tile_address())
+               for qtile, _ in tile_window_list ]
+    read_iter = read_tile_windows(raster_ds, [ tile_window for (_, tile_window), is_cached
+                                               in zip(tile_window_list, cached) if not is_cached ], coalesce)
+    for (qtile, tile_window), is_cached in zip(tile_window_list, cached):
+        clip = tile_cache.get(raster_id, qtile.tile_address(), tile_window) if is_cached else None
+        if clip is None and is_cached:
+            # Evicted or stale since checked
+            clip = raster_ds.read(window=tile_window)
+            tile_cache.put(raster_id, qtile.tile_address(), tile_window, clip)
+        elif clip is None:
+            clip = next(read_iter)
+            if qtile.node_type == QuadTreeNodeType.INSIDE:
+                tile_cache.record_miss()
+                tile_cache.put(raster_id, qtile.tile_address(), tile_window, clip)
+        yield clip
+
+def extract_tiles_threaded(raster_path, tile_window_list, query_masker, nodata, read_workers, max_pending=None,
+                           tile_cache=None, raster_id=None):
+    """
+    Read and mask tiles on a thread pool, yielding them in input order
+    At most {max_pending} tiles are in flight, so a slow writer bounds memory
+    #NOTE: reads and rasterizing release the GIL inside GDAL"""
+    if max_pending is None:
+        max_pending = read_workers * 2
+    thread_raster = ThreadLocalRaster(raster_path)
+
+    def extract_tile(qtile, tile_window):
+        if tile_cache is not None and qtile.node_type == QuadTreeNodeType.INSIDE:
+            clip = tile_cache.get(raster_id, qtile.tile_address(), tile_window)
+            if clip is None:
+                clip = thread_raster.get_ds().read(window=tile_window)
+                tile_cache.put(raster_id, qtile.tile_address(), tile_window, clip)
+            return clip
+        ds = thread_raster.get_ds()
+        return mask_tile_clip(qtile, tile_window, ds.read(window=tile_window), query_masker, nodata)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=read_workers) as executor:
+            pending = deque()
+            for qtile, tile_window in tile_window_list:
+                pending.append(executor.submit(extract_tile, qtile, tile_window))
+                if len(pending) >= max_pending:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+    finally:
+        thread_raster.close()
+
+def write_tile_mosaic(raster_ds, tile_window_list, query_masker, out_window, write_path, nodata,
+                      coalesce=False, read_workers=1, tile_cache=None, init_rows=256):
+    """
+    Write the (qtile, window) tiles of {tile_window_list} into a new GeoTIFF
+    at {write_path} covering {out_window} of the source raster"""
+    raster_meta = raster_ds.meta.copy()
+    raster_meta.update({"driver": "GTiff",
+                        "height": out_window.height,
+                        "width": out_window.width,
+                        "nodata": nodata,
+                        "transform": windows.transform(out_window, raster_ds.transform)})
+
+    with rio.open(write_path, 'w+', **raster_meta) as raster_out_ds:
+        # Initialise to nodata a strip at a time
+        for row_off in range(0, out_window.height, init_rows):
+            strip_window = windows.Window(0, row_off, out_window.width, min(init_rows, out_window.height - row_off))
+            raster_out_ds.write(np.full((raster_ds.count, strip_window.height, strip_window.width),
+                                        nodata, dtype=raster_meta['dtype']), window=strip_window)
+
+        raster_id = get_raster_id(raster_ds.name) if tile_cache is not None else None
+        if read_workers > 1:
+            tile_clip_iter = extract_tiles_threaded(raster_ds.name, tile_window_list, query_masker, nodata, read_workers,
+                                                    tile_cache=tile_cache, raster_id=raster_id)
+        else:
+            if tile_cache is not None:
+                read_iter = read_tiles_cached(raster_ds, tile_window_list, tile_cache, raster_id, coalesce)
+            else:
+                read_iter = read_tile_windows(raster_ds, [ tile_window for _, tile_window in tile_window_list ], coalesce)
+            tile_clip_iter = ( mask_tile_clip(qtile, tile_window, clip, query_masker, nodata)
+                               for (qtile, tile_window), clip in zip(tile_window_list, read_iter) )
+
+        for (qtile, tile_window), clip in zip(tile_window_list, tile_clip_iter):
+            dst_window = windows.Window(tile_window.col_off - out_window.col_off,
+                                        tile_window.row_off - out_window.row_off,
+                                        tile_window.width, tile_window.height)
+            dst_clip = raster_out_ds.read(window=dst_window)
+            fill_mask = tile_raster_rio.get_nodata_mask(dst_clip, nodata) & ~tile_raster_rio.get_nodata_mask(clip, nodata)
+            if fill_mask.any():
+                dst_clip[fill_mask] = clip[fill_mask]
+                raster_out_ds.write(dst_clip, window=dst_window)
+
+def clip_tiles_direct(raster_ds, qtile_acc, query_shapes, raster_out_path, coalesce=False, read_workers=1,
+                      mask_mode="tile", out_format="gtiff", tile_cache=None, init_rows=256, exact_windows=False,
+                      raster_validity=None, tile_size=1024):
+    """
+    Write every tile straight into its window of a single output raster
+    The output covers the union of the tile windows and starts as nodata, a
+    tile only fills pixels still nodata, the same as merge(method='first').
+    Tiles are written in order, read either one at a time or, with
+    {read_workers} > 1, ahead of the writer on a thread pool. INSIDE tiles
+    come from {tile_cache} when given. Tiles over only nodata blocks of
+    {raster_validity} are skipped and the rest shrunk to their valid pixels,
+    the output keeps the extent of the unpruned tiles.
+    #NOTE: a COG is written to a plain GeoTIFF first, its origin snapped to
+    the quadtree grid of {tile_size}, then copied with blocks and overviews"""
+    nodata = raster_ds.nodata if raster_ds.nodata is not None else 0
+    query_masker = get_query_masker(raster_ds, query_shapes, mask_mode)
+    if query_masker is None:
+        return
+    tile_window_list = get_direct_tile_windows(raster_ds, qtile_acc, query_masker.query_window, exact_windows)
+    if not tile_window_list:
+        print("No tile windows to write")
+        return
+    out_window = windows.union(*[ tile_window for _, tile_window in tile_window_list ])
+    out_window = out_window.round_offsets().round_lengths()
+    if out_format == "cog":
+        out_window = tile_raster_rio.align_window_to_quadtree(raster_ds.transform, out_window, tile_size)
+    if raster_validity is not None:
+        tile_window_list = raster_validity.prune(tile_window_list)
+
+    write_path = raster_out_path if out_format != "cog" else f"{raster_out_path}.{os.getpid()}.tmp.tif"
+    write_tile_mosaic(raster_ds, tile_window_list, query_masker, out_window, write_path, nodata,
+                      coalesce=coalesce, read_workers=read_workers, tile_cache=tile_cache, init_rows=init_rows)
+
+    if out_format == "cog":
+        tile_raster_rio.write_cog(write_path, raster_out_path, tile_size)
+        os.remove(write_path)
+
+def clip_tiles_vrt(raster_ds, qtile_acc, query_shapes, raster_out_path, coalesce=False, mask_mode="tile",
+                   exact_windows=False, raster_validity=None):
+    """
+    Write only the masked INTERSECTS tiles, as small GeoTIFFs, and a VRT
+    mosaic that reads INSIDE tiles straight from the source raster
+    Sources are listed last tile first, so with nodata skipped the first
+    tile with data wins, the same as merge(method='first'). Tiles over only
+    nodata blocks of {raster_validity} are left out."""
+    nodata = raster_ds.nodata if raster_ds.nodata is not None else 0
+    query_masker = get_query_masker(raster_ds, query_shapes, mask_mode)
+    if query_masker is None:
+        return
+    tile_window_list = get_direct_tile_windows(raster_ds, qtile_acc, query_masker.query_window, exact_windows)
+    if not tile_window_list:
+        print("No tile windows to write")
+        return
+    out_window = windows.union(*[ tile_window for _, tile_window in tile_window_list ])
+    out_window = out_window.round_offsets().round_lengths()
+    if raster_validity is not None:
+        tile_window_list = raster_validity.prune(tile_window_list)
+
+    tile_dir = f"{os.path.splitext(raster_out_path)[0]}_tiles"
+    os.makedirs(tile_dir, exist_ok=True)
+    boundary_list = [ (qtile, tile_window) for qtile, tile_window in tile_window_list
+                      if qtile.node_type == QuadTreeNodeType.INTERSECTS ]
+    boundary_path_dict = dict()
+    read_iter = read_tile_windows(raster_ds, [ tile_window for _, tile_window in boundary_list ], coalesce)
+    for (qtile, tile_window), clip in zip(boundary_list, read_iter):
+        clip = mask_tile_clip(qtile, tile_window, clip, query_masker, nodata)
+        depth, ix, iy = qtile.tile_address()
+        tile_path = os.path.join(tile_dir, f"tile_{depth:02d}_{ix}_{iy}.tif")
+        tile_meta = raster_ds.meta.copy()
+        tile_meta.update({"driver": "GTiff",
+                          "height": clip.shape[1],
+                          "width": clip.shape[2],
+                          "nodata": nodata,
+                          "transform": windows.transform(tile_window, raster_ds.transform)})
+        with rio.open(tile_path, 'w', **tile_meta) as tile_out_ds:
+            tile_out_ds.write(clip)
+        boundary_path_dict[id(qtile)] = tile_path
+
+    source_list = []
+    for qtile, tile_window in reversed(tile_window_list):
+        dst_window = windows.Window(tile_window.col_off - out_window.col_off, tile_window.row_off - out_window.row_off,
+                                    tile_window.width, tile_window.height)
+        if id(qtile) in boundary_path_dict:
+            src_window = windows.Window(0, 0, tile_window.width, tile_window.height)
+            source_list.append((boundary_path_dict[id(qtile)], src_window, dst_window))
+        else:
+            source_list.append((raster_ds.name, tile_window, dst_window))
+
+    raster_meta = raster_ds.meta.copy()
+    raster_meta.update({"height": out_window.height,
+                        "width": out_window.width,
+                        "nodata": nodata,
+                        "transform": windows.transform(out_window, raster_ds.transform)})
+    tile_raster_rio.write_vrt(raster_out_path, raster_meta, source_list)
+    print(f"VRT: {len(source_list)} sources, {len(boundary_path_dict)} boundary tiles written")
+
+
 if __name__ == "__main__":
     #Parse CLI arguments
     parser = argparse.ArgumentParser()
     parser.add_argument("--query_shp", help="Output shapefile")
     parser.add_argument("--out_shp", help="Output shapefile")
+    parser.add_argument("--tile_format", choices=list(TILE_FORMATS), default="shp",
+                        help="Format of the --out_shp tiles, its extension follows the format")
+    parser.add_argument("--base_qtree", help="Base quadtree npz from gen_base_quadtree.py to seed the search from")
     parser.add_argument("--in_raster", help="Input raster")
+    parser.add_argument("--in_catalogue", help="Raster catalogue from raster_catalogue.py, instead of --in_raster")
     parser.add_argument("--out_raster_dir", help="Input raster")
+    parser.add_argument("--geom_cache_dir", help="Cache directory for preprocessed geometries")
+    parser.add_argument("--tile_size", type=int, default=1024, help="Length limit of the query's quadtree tiles in UTM51N")
+    parser.add_argument("--simplify", action="store_true", help="Simplify geometries with a tolerance tied to --tile_size")
+    parser.add_argument("--writer", choices=["merge", "direct", "vrt"], default="merge",
+                        help="merge: in-memory tile datasets + rasterio merge, direct: write tiles into one output raster, "
+                             "vrt: write boundary tiles only and a VRT referencing the source raster")
+    parser.add_argument("--coalesce", action="store_true", help="Read adjacent tiles as block-aligned groups")
+    parser.add_argument("--read_workers", type=int, default=1,
+                        help="Threads reading and masking tiles ahead of the direct writer (ignores --coalesce)")
+    parser.add_argument("--tile_cache_dir", help="Store of INSIDE raster tiles reused across clips (merge and direct writers)")
+    parser.add_argument("--tile_cache_mb", type=float, default=1024, help="Size bound of the raster tile store")
+    parser.add_argument("--out_format", choices=tile_raster_rio.OUT_FORMATS, default="gtiff",
+                        help="Plain GeoTIFF or cloud-optimized GeoTIFF aligned to the quadtree")
+    parser.add_argument("--mask_mode", choices=MASK_MODES, default="tile",
+                        help="tile: rasterize the query per tile, once: rasterize it once and slice, clipped: rasterize it clipped to each tile")
+    parser.add_argument("--verify_masks", action="store_true",
+                        help="Also check that every --mask_mode masks the same pixels, exits 1 when they differ")
+    parser.add_argument("--exact_windows", action="store_true",
+                        help="Plan exact tile windows by pixel centre, without the 5-pixel pad")
+    parser.add_argument("--prune_nodata", action="store_true",
+                        help="Skip tiles over only nodata blocks, the direct and vrt writers also shrink the rest to their valid pixels")
+    parser.add_argument("--validity_cache_dir", help="Cache directory for the block validity scans of --prune_nodata")
     args = parser.parse_args()
+    if args.in_catalogue:
+        # The catalogue clip is its own writer, these only apply to --in_raster
+        raster_only_flags = [ f"--{dest}" for dest in ["writer", "out_format", "mask_mode", "verify_masks", "exact_windows",
+                                                      "prune_nodata", "validity_cache_dir", "tile_cache_dir", "coalesce",
+                                                      "read_workers"]
+                              if getattr(args, dest) != parser.get_default(dest) ]
+        if raster_only_flags:
+            parser.error(f"--in_catalogue does not support {', '.join(raster_only_flags)}")
+    if args.tile_cache_dir and args.writer == "vrt":
+        # The VRT references INSIDE tiles in the source raster, they are never read
+        parser.error("--tile_cache_dir needs --writer merge or direct")
 
     
     min_x = local_config.BASE_QUADTREE["min_x"]
@@ -167,8 +637,12 @@ if __name__ == "__main__":
     
     with fiona.open(args.query_shp, 'r', 'ESRI Shapefile') as query_shp_fh:
         #shp_geom = shape(shp.next()['geometry'])
-        shp_poly = shape(query_shp_fh.next()['geometry'])
-        query_shapes =  [feature["geometry"] for feature in query_shp_fh]
+        simplify_tolerance = get_simplify_tolerance(args.tile_size) if args.simplify else 0.0
+        geom_cache = GeometryCache(args.geom_cache_dir, simplify_tolerance) if args.geom_cache_dir else None
+        shp_poly = prepare_geometry(shape(query_shp_fh.next()['geometry']), geom_cache, simplify_tolerance)
+        # Mask with the same prepared geometries the tiles are searched with
+        query_shapes = [ mapping(prepare_geometry(shape(feature["geometry"]), geom_cache, simplify_tolerance))
+                         for feature in query_shp_fh ]
         try:
             print(f"QUERY GEOMETRY: {len(shp_poly.geoms)}")
         except:
@@ -176,7 +650,7 @@ if __name__ == "__main__":
         print(f"QUERY BOUNDS: {shp_poly.bounds}")
         shp_poly_boundary = Rect.from_extents(*shp_poly.bounds)
         
-        with fiona.open(args.out_shp, 'w','ESRI Shapefile', out_shp_schema, crs=from_epsg(32651), ) as output_shp_fh:
+        with TileWriter(args.out_shp, out_shp_schema, args.tile_format, crs=from_epsg(32651)) as output_shp_fh:
             base_qt_dict = {
                 "TYPE" : 0,
                 "DEPTH" : 0,
@@ -184,7 +658,14 @@ if __name__ == "__main__":
                 "MIN_X" : bbox.min_x, "MIN_Y" : bbox.min_y, 
                 "MAX_X" : bbox.max_x, "MAX_Y" : bbox.max_y
             }
-            rec_tile_search(qtree, shp_poly, shp_poly_boundary, output_shp_fh, base_qt_dict, qtile_length_limit=1024, qtile_acc=qtile_acc)
+            if args.base_qtree:
+                seed_qtrees = get_seed_qtrees(load_base_quadtree(args.base_qtree), shp_poly.bounds)
+                print(f"BASE QTREE SEEDS: {len(seed_qtrees)}")
+                log_uncovered_area(shp_poly, seed_qtrees)
+            else:
+                seed_qtrees = [qtree]
+            for seed_qtree in seed_qtrees:
+                rec_tile_search(seed_qtree, shp_poly, shp_poly_boundary, output_shp_fh, base_qt_dict, qtile_length_limit=args.tile_size, qtile_acc=qtile_acc)
         
         print(f"ACCUMULATED QTILES: {len(qtile_acc)}")
         # qtile_acc = [
@@ -198,113 +679,60 @@ if __name__ == "__main__":
         # ]
 
         query_shp_name = os.path.basename(args.query_shp)
-        raster_file_name = os.path.basename(args.in_raster)
-        raster_file_ext = "tif"
-        with rio.open(args.in_raster) as raster_ds:
-
-            # raster_prj  = raster_ds.GetProjection()
-            # raster_gt   = raster_ds.GetGeoTransform()
-            raster_meta = raster_ds.meta.copy()
-            raster_ncols, raster_nrows = raster_ds.meta['width'], raster_ds.meta['height']
-            raster_band_num = 1
-            print(f"RASTER META:")
-            print(f"RASTER COLS: {raster_ncols}")
-            print(f"RASTER ROWS: {raster_nrows}")
-
-
-            tile_window_list = []
-            tile_ds_list = []
-            for tile_num in range(len(qtile_acc)):
-                #width, height, cx, cy, min_x, min_y, max_x, max_y = qtile_acc[tile_num]
-                
-                width   = qtile_acc[tile_num].boundary.w
-                height  = qtile_acc[tile_num].boundary.h
-                cx      = qtile_acc[tile_num].boundary.cx
-                cy      = qtile_acc[tile_num].boundary.cy
-                min_x   = qtile_acc[tile_num].boundary.min_x
-                min_y   = qtile_acc[tile_num].boundary.min_y
-                max_x   = qtile_acc[tile_num].boundary.max_x
-                max_y   = qtile_acc[tile_num].boundary.max_y
-
-                #tile_window = get_tile_window(raster_ds, cx, cy, tile_size=width)
-                tile_window = tile_raster_rio.get_tile_window_from_extents(raster_ds, min_x, min_y, max_x, max_y, tile_size=1024)
-                # print(f"TILE WINDOW: {tile_window}") 
-                tile_window_list.append(tile_window)
-
-                tile_name = f"{query_shp_name}_{tile_num}.{raster_file_ext}"    
-                tile_output_path = os.path.join(args.out_raster_dir, tile_name)
-                # print(f"Writing to: [{tile_output_path}]")
-
-                # Read the data in the window
-                # clip is a nbands * N * N numpy array
-                clip = raster_ds.read(window=tile_window)
-
-                # You can then write out a new file
-                meta = raster_ds.meta
-                meta['width'], meta['height'] = tile_window.width, tile_window.height
-                temp_gt = rio.windows.transform(tile_window, raster_ds.transform)
-                meta['transform'] = temp_gt
-                
-
-                # print("--------")
-                # print(f"{qtile_acc[tile_num].node_type} -- {qtile_acc[tile_num]}")
-                # pprint(raster_ds.transform.f)
-                # pprint(raster_ds.window_transform(tile_window))
-                # pprint(raster_meta['transform'])
-                # pprint(meta['transform'])
-
-                # pprint(clip) 
-                
-                """"" NOTE: Write tiles snippet
-                if qtile_acc[tile_num].node_type == QuadTreeNodeType.INTERSECTS:
-                    
-                    with write_mem_raster(clip, **meta) as clip_ds:
-                        masked_clip, masked_transform = rasterio.mask.mask(clip_ds, query_shapes, crop=True)
-                        meta.update({"driver": "GTiff",
-                                "height": masked_clip.shape[1],
-                                "width": masked_clip.shape[2],
-                                "transform": masked_transform})
-                        
-                        with rio.open(tile_output_path, 'w', **meta) as raster_out_ds:
-                            raster_out_ds.write(masked_clip)
+        raster_file_name = os.path.basename(args.in_raster or args.in_catalogue)
+        raster_file_ext = "vrt" if args.writer == "vrt" else "tif"
+        if args.in_catalogue:
+            raster_out_path = os.path.join(args.out_raster_dir, f"{query_shp_name}_merged.{raster_file_ext}")
+            start_time = datetime.now()
+            raster_catalogue = RasterCatalogue(args.in_catalogue)
+            clip_tiles_catalogue(raster_catalogue, qtile_acc, query_shapes, shp_poly.bounds, raster_out_path)
+            log_time_diff(start_time, datetime.now(), label="RASTER-WRITE_CATALOGUE")
+        else:
+            with rio.open(args.in_raster) as raster_ds:
+
+                # raster_prj  = raster_ds.GetProjection()
+                # raster_gt   = raster_ds.GetGeoTransform()
+                raster_meta = raster_ds.meta.copy()
+                raster_ncols, raster_nrows = raster_ds.meta['width'], raster_ds.meta['height']
+                raster_band_num = 1
+                print(f"RASTER META:")
+                print(f"RASTER COLS: {raster_ncols}")
+                print(f"RASTER ROWS: {raster_nrows}")
+
+
+                raster_out_name = f"{query_shp_name}_merged.{raster_file_ext}"    
+                raster_out_path = os.path.join(args.out_raster_dir, raster_out_name)
+
+                tile_cache = RasterTileCache(args.tile_cache_dir, args.tile_cache_mb) if args.tile_cache_dir else None
+                raster_validity = RasterValidity(raster_ds, args.validity_cache_dir) if args.prune_nodata else None
+                start_time = datetime.now()
+                if args.writer == "direct":
+                    clip_tiles_direct(raster_ds, qtile_acc, query_shapes, raster_out_path,
+                                      coalesce=args.coalesce, read_workers=args.read_workers, mask_mode=args.mask_mode,
+                                      out_format=args.out_format, tile_cache=tile_cache, exact_windows=args.exact_windows,
+                                      raster_validity=raster_validity, tile_size=args.tile_size)
+                elif args.writer == "vrt":
+                    clip_tiles_vrt(raster_ds, qtile_acc, query_shapes, raster_out_path,
+                                   coalesce=args.coalesce, mask_mode=args.mask_mode, exact_windows=args.exact_windows,
+                                   raster_validity=raster_validity)
                 else:
-                    with rio.open(tile_output_path, 'w', **meta) as raster_out_ds:
-                        raster_out_ds.write(clip)
-                #"""
-
-                if qtile_acc[tile_num].node_type == QuadTreeNodeType.INTERSECTS:
-                    
-                    with write_mem_raster(clip, **meta) as clip_ds:
-                        masked_clip, masked_transform = rasterio.mask.mask(clip_ds, query_shapes, crop=True)
-                        meta.update({"driver": "GTiff",
-                                "height": masked_clip.shape[1],
-                                "width": masked_clip.shape[2],
-                                "transform": masked_transform})
-                    
-                        
-                    masked_ds = write_mem_raster_no_yield(masked_clip, **meta)
-                    tile_ds_list.append(masked_ds)
-                    print("INTERSECT -- "+str(masked_ds))
-                else:
-                    clip_ds = write_mem_raster_no_yield(clip, **meta)
-                    print("WITHIN >>> " + str(clip_ds))
-                    tile_ds_list.append(clip_ds)
-            
-            merge_ds, merge_transform = merge(tile_ds_list)
-            raster_meta.update({"driver": "GTiff",
-                                "height": merge_ds.shape[1],
-                                "width": merge_ds.shape[2],
-                                "transform": merge_transform})
-            
-            raster_out_name = f"{query_shp_name}_merged.{raster_file_ext}"    
-            raster_out_path = os.path.join(args.out_raster_dir, raster_out_name)
-                
-            with rio.open(raster_out_path, 'w', **raster_meta) as raster_out_ds:
-                raster_out_ds.write(merge_ds)
-            
-            # Close Tile DS readers after writing to save memory
-            for tile_ds in tile_ds_list:
-                tile_ds.close()
+                    clip_tiles_merge(raster_ds, qtile_acc, query_shapes, raster_out_path,
+                                     coalesce=args.coalesce, mask_mode=args.mask_mode, out_format=args.out_format,
+                                     exact_windows=args.exact_windows, raster_validity=raster_validity, tile_cache=tile_cache,
+                                     tile_size=args.tile_size)
+                end_time = datetime.now()
+                log_time_diff(start_time, end_time, label=f"RASTER-WRITE_{args.writer.upper()}")
+                print(f"THROUGHPUT|RASTER-WRITE_{args.writer.upper()}|{len(qtile_acc) / max((end_time - start_time).total_seconds(), 1e-6):.2f}|tiles_per_second")
+
+                if args.verify_masks:
+                    mismatch_count = verify_mask_modes(raster_ds, qtile_acc, query_shapes, args.exact_windows)
+                    print(f"MASK MODES: {', '.join(MASK_MODES)} differ on {mismatch_count} tiles")
+                    if mismatch_count:
+                        raise SystemExit(1)
+                if tile_cache is not None:
+                    tile_cache.log_stats()
+                if raster_validity is not None:
+                    raster_validity.log_stats()
         """
         # TEST: Generate base quadtree
         with fiona.open(args.out_shp, 'w','ESRI Shapefile', out_shp_schema, crs=from_epsg(32651), ) as output_shp_fh:
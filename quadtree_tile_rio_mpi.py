@@ -0,0 +1,257 @@
+from mpi4py import MPI
+
+import fiona
+from shapely.geometry import mapping, shape
+
+import numpy as np
+import rasterio as rio
+import rasterio.shutil
+from rasterio import windows
+
+import argparse, os
+
+from quadtree import *
+from quadtree_index_worker import log_balance
+from quadtree_tile_rio import rec_tile_search, get_direct_tile_windows, write_tile_mosaic, QueryMasker, get_query_masker, MASK_MODES
+import tile_raster_rio
+from tile_writer import TileWriter, TILE_FORMATS
+from gen_base_quadtree import load_base_quadtree, get_seed_qtrees, log_uncovered_area
+from raster_validity import RasterValidity
+from local_pool import *
+from geom_preprocess import *
+
+from pprint import pprint
+from datetime import datetime
+
+"""
+    MPI raster clipping driver
+
+    Rank 0 decomposes the query into quadtree tiles, sorts them by tile code
+    (Morton order, so neighbouring tiles stay together) and cuts the sorted
+    list into contiguous runs of roughly equal pixel counts, one per worker.
+    Every worker reads and masks its tiles from the shared raster into its own
+    part GeoTIFF, over the union of its tile windows, and rank 0 stitches the
+    parts with a VRT.
+    #NOTE: tiles overlap only in their padding, where every tile holding data
+    has the same source pixel, so the mosaic does not depend on part order
+"""
+
+def log_to_cluster(cluster_rank, msg):
+    print(f"R[{cluster_rank}]>{msg}")
+
+def log_time_diff(cluster_rank, start_time, end_time, label="EXEC_TIME"):
+    time_diff = (end_time - start_time)
+    exec_time_millis = time_diff.total_seconds() * 1000
+    print(f"R[{cluster_rank}]>EXECTIME|{label}|{exec_time_millis:.2f}|milliseconds")
+
+def get_window_tuple(window):
+    return (int(window.col_off), int(window.row_off), int(window.width), int(window.height))
+
+def split_by_locality(tile_codes, tile_costs, num_bins):
+    """
+    Cut tiles sorted by {tile_codes} into {num_bins} contiguous runs of
+    about equal total {tile_costs}
+    Returns a list of index arrays, one per bin"""
+    tile_order = np.argsort(tile_codes, kind='stable')
+    costs = np.asarray(tile_costs, dtype=np.float64)[tile_order]
+    cost_before = np.cumsum(costs) - costs
+    tile_bins = np.minimum((cost_before * num_bins / max(costs.sum(), 1.0)).astype(np.int64), num_bins - 1)
+    return [ tile_order[tile_bins == bin_idx] for bin_idx in range(num_bins) ]
+
+def get_part_name(query_shp_name, rank):
+    return f"{query_shp_name}_part_r{rank:04d}.tif"
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Clip a raster to a query shapefile over MPI ranks",
+                                     epilog="Example: mpirun -np 5 python quadtree_tile_rio_mpi.py --query_shp query.shp ...")
+    parser.add_argument("--query_shp", help="Query shapefile")
+    parser.add_argument("--out_shp", help="Output shapefile of the query's quadtree tiles")
+    parser.add_argument("--tile_format", choices=list(TILE_FORMATS), default="shp",
+                        help="Format of the --out_shp tiles, its extension follows the format")
+    parser.add_argument("--base_qtree", help="Base quadtree npz from gen_base_quadtree.py to seed the search from")
+    parser.add_argument("--in_raster", help="Input raster")
+    parser.add_argument("--out_raster_dir", help="Output directory")
+    parser.add_argument("--geom_cache_dir", help="Cache directory for preprocessed geometries")
+    parser.add_argument("--tile_size", type=int, default=1024, help="Length limit of the query's quadtree tiles in UTM51N")
+    parser.add_argument("--simplify", action="store_true", help="Simplify geometries with a tolerance tied to --tile_size")
+    parser.add_argument("--mask_mode", choices=MASK_MODES, default="tile",
+                        help="How root and ranks rasterize the query for boundary tiles, see quadtree_tile_rio.py")
+    parser.add_argument("--coalesce", action="store_true", help="Read adjacent tiles as block-aligned groups")
+    parser.add_argument("--read_workers", type=int, default=1, help="Threads reading and masking tiles per rank")
+    parser.add_argument("--out_format", choices=["vrt", "gtiff", "cog"], default="vrt",
+                        help="Keep the VRT over the rank parts, or also copy it to a single GeoTIFF or COG")
+    parser.add_argument("--exact_windows", action="store_true",
+                        help="Plan exact tile windows by pixel centre, without the 5-pixel pad")
+    parser.add_argument("--prune_nodata", action="store_true",
+                        help="Skip tiles over only nodata blocks, shrink the rest to their valid pixels")
+    parser.add_argument("--validity_cache_dir", help="Cache directory for the block validity scans of --prune_nodata")
+    args = parser.parse_args()
+
+    cluster_comm = MPI.COMM_WORLD
+    cluster_size = cluster_comm.Get_size()
+    cluster_worker_size = cluster_size-1
+    cluster_rank = cluster_comm.Get_rank()
+    node_name = MPI.Get_processor_name()
+    print('cluster_size=%d, cluster_rank=%d, node:[%s]' % (cluster_size, cluster_rank, node_name))
+    if cluster_worker_size < 1:
+        log_to_cluster(cluster_rank, "Needs at least 2 ranks, rank 0 only coordinates")
+        MPI.Finalize()
+        raise SystemExit(1)
+
+    query_shp_name = os.path.basename(args.query_shp)
+    part_dir = os.path.join(args.out_raster_dir, f"{query_shp_name}_parts")
+
+    #NOTE: Decompose the query and split its tiles by locality on root
+    scatter_list = []
+    query_shapes = None
+    out_window_tuple = None
+    start_time = datetime.now()
+    if cluster_rank == 0:
+        os.makedirs(part_dir, exist_ok=True)
+        with fiona.open(args.query_shp) as query_sh:
+            simplify_tolerance = get_simplify_tolerance(args.tile_size) if args.simplify else 0.0
+            geom_cache = GeometryCache(args.geom_cache_dir, simplify_tolerance) if args.geom_cache_dir else None
+            query_geom = prepare_geometry(shape(next(iter(query_sh))['geometry']), geom_cache, simplify_tolerance)
+            # Mask with the same prepared geometries the tiles are searched with
+            query_shapes = [ mapping(prepare_geometry(shape(feature['geometry']), geom_cache, simplify_tolerance))
+                             for feature in query_sh ]
+
+        out_shp_schema = {
+            'geometry': 'Polygon',
+            'properties': dict([('TYPE', 'int:2'), ('DEPTH', 'int:5'),
+                ('CX', 'float:19'), ('CY', 'float:19'),
+                ('MIN_X', 'float:19'), ('MIN_Y', 'float:19'),
+                ('MAX_X', 'float:19'), ('MAX_Y', 'float:19')])
+            }
+        bbox = get_base_rect()
+        qtile_acc = []
+        with TileWriter(args.out_shp, out_shp_schema, args.tile_format, crs=from_epsg(32651)) as output_shp_fh:
+            base_qt_dict = {
+                "TYPE" : 0,
+                "DEPTH" : 0,
+                "CX" : bbox.cx,  "CY" : bbox.cy,
+                "MIN_X" : bbox.min_x, "MIN_Y" : bbox.min_y,
+                "MAX_X" : bbox.max_x, "MAX_Y" : bbox.max_y
+            }
+            if args.base_qtree:
+                seed_qtrees = get_seed_qtrees(load_base_quadtree(args.base_qtree), query_geom.bounds)
+                log_to_cluster(cluster_rank, f"Base quadtree seeds: {len(seed_qtrees)}")
+                log_uncovered_area(query_geom, seed_qtrees)
+            else:
+                seed_qtrees = [QuadTree(bbox, None)]
+            for seed_qtree in seed_qtrees:
+                rec_tile_search(seed_qtree, query_geom, Rect.from_extents(*query_geom.bounds), output_shp_fh,
+                                base_qt_dict, qtile_length_limit=args.tile_size, qtile_acc=qtile_acc)
+        log_time_diff(cluster_rank, start_time, datetime.now(), label="RASTER-QUERY_DECOMPOSE")
+        log_to_cluster(cluster_rank, f"Query tiles: {len(qtile_acc)}")
+
+        start_time = datetime.now()
+        with rio.open(args.in_raster) as raster_ds:
+            query_masker = get_query_masker(raster_ds, query_shapes, args.mask_mode)
+            tile_window_list = []
+            if query_masker is not None:
+                tile_window_list = get_direct_tile_windows(raster_ds, qtile_acc, query_masker.query_window,
+                                                           exact_windows=args.exact_windows)
+            if tile_window_list:
+                out_window = windows.union(*[ tile_window for _, tile_window in tile_window_list ])
+                out_window = out_window.round_offsets().round_lengths()
+                if args.out_format == "cog":
+                    # Same origin on the quadtree grid as quadtree_tile_rio.py --out_format cog
+                    out_window = tile_raster_rio.align_window_to_quadtree(raster_ds.transform, out_window, args.tile_size)
+                out_window_tuple = get_window_tuple(out_window)
+            if args.prune_nodata and tile_window_list:
+                raster_validity = RasterValidity(raster_ds, args.validity_cache_dir)
+                tile_window_list = raster_validity.prune(tile_window_list)
+                raster_validity.log_stats()
+
+        tile_address = np.array([ qtile.tile_address() for qtile, _ in tile_window_list ], dtype=np.int64).reshape(-1, 3)
+        tile_codes = get_tile_code(tile_address[:,0].astype(np.uint8), tile_address[:,1], tile_address[:,2])
+        tile_costs = [ tile_window.width * tile_window.height for _, tile_window in tile_window_list ]
+        for tile_idx_list in split_by_locality(tile_codes, tile_costs, cluster_worker_size):
+            scatter_list.append([ (*tile_window_list[tile_idx][0].tile_address(), int(tile_window_list[tile_idx][0].node_type),
+                                   get_window_tuple(tile_window_list[tile_idx][1])) for tile_idx in tile_idx_list ])
+        log_time_diff(cluster_rank, start_time, datetime.now(), label="RASTER-SPLIT_LOCALITY")
+        log_to_cluster(cluster_rank, f"Scatter list lens: {[len(ilist) for ilist in scatter_list]}")
+
+    query_shapes = cluster_comm.bcast(query_shapes, root=0)
+    out_window_tuple = cluster_comm.bcast(out_window_tuple, root=0)
+    scatter_list.insert(0, None)    # None item at root, so no data is sent to root
+    scatter_list = cluster_comm.scatter(scatter_list, root=0)
+
+    #NOTE: Each worker writes its tiles into its own part
+    part_info = None
+    if cluster_rank != 0 and scatter_list:
+        start_time = datetime.now()
+        rank_tile_window_list = []
+        for depth, ix, iy, node_type, window_tuple in scatter_list:
+            qtile = QuadTree(tile_rect(depth, ix, iy), None)
+            qtile.node_type = QuadTreeNodeType(node_type)
+            rank_tile_window_list.append((qtile, windows.Window(*window_tuple)))
+        part_window = windows.union(*[ tile_window for _, tile_window in rank_tile_window_list ])
+        part_name = get_part_name(query_shp_name, cluster_rank)
+
+        with rio.open(args.in_raster) as raster_ds:
+            nodata = raster_ds.nodata if raster_ds.nodata is not None else 0
+            query_masker = QueryMasker(raster_ds, query_shapes, args.mask_mode)
+            write_tile_mosaic(raster_ds, rank_tile_window_list, query_masker, part_window,
+                              os.path.join(part_dir, part_name), nodata,
+                              coalesce=args.coalesce, read_workers=args.read_workers)
+
+        work_millis = (datetime.now() - start_time).total_seconds() * 1000
+        log_time_diff(cluster_rank, start_time, datetime.now(), label="RASTER-WRITE_PART")
+        part_info = {
+            'rank': cluster_rank,
+            'node': node_name,
+            'file': part_name,
+            'window': get_window_tuple(part_window),
+            'tiles': len(rank_tile_window_list),
+            'pixels': int(sum(tile_window.width * tile_window.height for _, tile_window in rank_tile_window_list)),
+            'work_millis': work_millis,
+        }
+
+    #NOTE: Gather parts and stitch them with a VRT on root
+    part_info_list = cluster_comm.gather(part_info, root=0)
+    if cluster_rank == 0:
+        part_info_list = [ part_info for part_info in part_info_list if part_info is not None ]
+        if not part_info_list:
+            log_to_cluster(cluster_rank, "No tile windows to write")
+    if cluster_rank == 0 and part_info_list:
+        start_time = datetime.now()
+        pprint(part_info_list)
+        log_balance("RASTER-RANK_TIME", [ part_info['work_millis'] for part_info in part_info_list ])
+        log_balance("RASTER-RANK_PIXELS", [ part_info['pixels'] for part_info in part_info_list ])
+
+        out_window = windows.Window(*out_window_tuple)
+        source_list = []
+        for part_info in part_info_list:
+            part_window = windows.Window(*part_info['window'])
+            source_list.append((os.path.join(part_dir, part_info['file']),
+                                windows.Window(0, 0, part_window.width, part_window.height),
+                                windows.Window(part_window.col_off - out_window.col_off, part_window.row_off - out_window.row_off,
+                                               part_window.width, part_window.height)))
+
+        with rio.open(args.in_raster) as raster_ds:
+            raster_meta = raster_ds.meta.copy()
+            raster_meta.update({"height": out_window.height,
+                                "width": out_window.width,
+                                "nodata": raster_ds.nodata if raster_ds.nodata is not None else 0,
+                                "transform": windows.transform(out_window, raster_ds.transform)})
+        vrt_path = os.path.join(args.out_raster_dir, f"{query_shp_name}_merged.vrt")
+        tile_raster_rio.write_vrt(vrt_path, raster_meta, source_list)
+        log_to_cluster(cluster_rank, f"VRT: {vrt_path} over {len(source_list)} parts")
+
+        raster_out_path = os.path.join(args.out_raster_dir, f"{query_shp_name}_merged.tif")
+        if args.out_format == "gtiff":
+            rio.shutil.copy(vrt_path, raster_out_path, driver="GTiff")
+        elif args.out_format == "cog":
+            tmp_path = f"{raster_out_path}.{os.getpid()}.tmp.tif"
+            rio.shutil.copy(vrt_path, tmp_path, driver="GTiff")
+            tile_raster_rio.write_cog(tmp_path, raster_out_path, args.tile_size)
+            os.remove(tmp_path)
+        log_time_diff(cluster_rank, start_time, datetime.now(), label="RASTER-STITCH_PARTS")
+
+    #NOTE: Report peak memory per node
+    log_node_memory(cluster_comm, cluster_rank, node_name)
+
+    MPI.Finalize
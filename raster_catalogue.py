@@ -0,0 +1,248 @@
+import os, json, glob, math, argparse
+from collections import OrderedDict
+
+import numpy as np
+import rtree.index
+import rasterio as rio
+from affine import Affine
+from rasterio import windows
+from rasterio.features import geometry_mask
+
+from quadtree import *
+import tile_raster_rio
+
+from datetime import datetime
+
+"""
+    Catalogue of a directory of rasters (e.g. LiDAR DEM blocks)
+
+    Footprint, CRS, resolution and layout of every raster are read once and
+    persisted as JSON; an rtree over the footprints is built when loading.
+    All rasters must share one CRS, a mixed directory is refused.
+    Clipping then mosaics, per quadtree tile, only the rasters whose footprint
+    intersects the tile, instead of building one giant mosaic first.
+    Rebuilding reuses the entries of files whose size and mtime did not change.
+
+    {
+        "version": 1, "created": ..., "raster_dir": ...,
+        "rasters": [ {"path", "size", "mtime", "bounds", "crs", "res",
+                      "width", "height", "count", "dtype", "nodata"}, ... ]
+    }
+"""
+
+CATALOGUE_VERSION = 1
+
+def log_time_diff(start_time, end_time, label="EXEC_TIME"):
+    time_diff = (end_time - start_time)
+    exec_time_millis = time_diff.total_seconds() * 1000
+    print(f"EXECTIME|{label}|{exec_time_millis:.2f}|milliseconds")
+
+def read_raster_entry(raster_path):
+    raster_stat = os.stat(raster_path)
+    with rio.open(raster_path) as raster_ds:
+        return {
+            'path': os.path.abspath(raster_path),
+            'size': raster_stat.st_size,
+            'mtime': raster_stat.st_mtime,
+            'bounds': list(raster_ds.bounds),
+            'crs': raster_ds.crs.to_wkt() if raster_ds.crs is not None else None,
+            'res': list(raster_ds.res),
+            'width': raster_ds.width,
+            'height': raster_ds.height,
+            'count': raster_ds.count,
+            'dtype': raster_ds.dtypes[0],
+            'nodata': raster_ds.nodata,
+        }
+
+def check_single_crs(raster_entries):
+    """Raise ValueError unless every raster of {raster_entries} has the same CRS"""
+    crs_paths = dict()
+    for entry in raster_entries:
+        entry_crs = rio.crs.CRS.from_wkt(entry['crs']) if entry['crs'] else None
+        for crs in crs_paths:
+            if crs == entry_crs:
+                crs_paths[crs].append(entry['path'])
+                break
+        else:
+            crs_paths[entry_crs] = [ entry['path'] ]
+    if len(crs_paths) > 1:
+        crs_summary = "; ".join(f"{crs.to_string() if crs is not None else None}: {len(path_list)} rasters, e.g. {path_list[0]}"
+                                for crs, path_list in crs_paths.items())
+        raise ValueError(f"Catalogue rasters are in {len(crs_paths)} different CRS, catalogue each CRS separately ({crs_summary})")
+
+def build_catalogue(raster_dir, catalogue_path, pattern="*.tif"):
+    prev_entries = dict()
+    if os.path.exists(catalogue_path):
+        with open(catalogue_path) as catalogue_fh:
+            prev_entries = { entry['path']: entry for entry in json.load(catalogue_fh)['rasters'] }
+
+    raster_entries = []
+    reused = 0
+    for raster_path in sorted(glob.glob(os.path.join(raster_dir, "**", pattern), recursive=True)):
+        raster_path = os.path.abspath(raster_path)
+        raster_stat = os.stat(raster_path)
+        prev_entry = prev_entries.get(raster_path)
+        if prev_entry is not None and prev_entry['size'] == raster_stat.st_size and prev_entry['mtime'] == raster_stat.st_mtime:
+            raster_entries.append(prev_entry)
+            reused += 1
+        else:
+            raster_entries.append(read_raster_entry(raster_path))
+
+    check_single_crs(raster_entries)
+
+    catalogue = {
+        'version': CATALOGUE_VERSION,
+        'created': datetime.now().isoformat(),
+        'raster_dir': os.path.abspath(raster_dir),
+        'rasters': raster_entries,
+    }
+    with open(catalogue_path, 'w') as catalogue_fh:
+        json.dump(catalogue, catalogue_fh, indent=2)
+    print(f"Catalogued {len(raster_entries)} rasters ({reused} unchanged) into {catalogue_path}")
+    return catalogue
+
+class RasterCatalogue:
+    """Footprint-indexed set of rasters sharing a CRS, mosaicked on read"""
+
+    def __init__(self, catalogue_path, max_open=64):
+        with open(catalogue_path) as catalogue_fh:
+            self.catalogue = json.load(catalogue_fh)
+        self.entries = self.catalogue['rasters']
+        check_single_crs(self.entries)
+        self.footprint_idx = rtree.index.Index()
+        for pos, entry in enumerate(self.entries):
+            self.footprint_idx.insert(pos, entry['bounds'])
+        self.max_open = max_open
+        self.open_ds = OrderedDict()
+
+        first_entry = self.entries[0]
+        self.res = min(min(entry['res']) for entry in self.entries)
+        self.dtype = first_entry['dtype']
+        self.count = first_entry['count']
+        self.nodata = first_entry['nodata'] if first_entry['nodata'] is not None else 0
+        self.crs = rio.crs.CRS.from_wkt(first_entry['crs']) if first_entry['crs'] else None
+        # Output grid shares the first raster's pixel corners
+        self.grid_origin = (first_entry['bounds'][0], first_entry['bounds'][3])
+
+    def select(self, bounds):
+        """Positions of the rasters whose footprint intersects {bounds}"""
+        return sorted(self.footprint_idx.intersection(bounds))
+
+    def get_ds(self, pos):
+        """Open dataset of raster {pos}, keeping at most {max_open} open"""
+        if pos in self.open_ds:
+            self.open_ds.move_to_end(pos)
+            return self.open_ds[pos]
+        if len(self.open_ds) >= self.max_open:
+            _, old_ds = self.open_ds.popitem(last=False)
+            old_ds.close()
+        self.open_ds[pos] = rio.open(self.entries[pos]['path'])
+        return self.open_ds[pos]
+
+    def close(self):
+        for raster_ds in self.open_ds.values():
+            raster_ds.close()
+        self.open_ds.clear()
+
+    def get_grid_window(self, min_x, min_y, max_x, max_y):
+        """
+        Transform and (width, height) of the grid-aligned raster covering the
+        extents"""
+        origin_x, origin_y = self.grid_origin
+        grid_min_x = origin_x + math.floor((min_x - origin_x) / self.res) * self.res
+        grid_max_y = origin_y - math.floor((origin_y - max_y) / self.res) * self.res
+        width = math.ceil((max_x - grid_min_x) / self.res)
+        height = math.ceil((grid_max_y - min_y) / self.res)
+        return Affine(self.res, 0, grid_min_x, 0, -self.res, grid_max_y), width, height
+
+    def read_mosaic(self, out_transform, out_shape):
+        """
+        Mosaic the rasters under the window {out_shape} at {out_transform}
+        Rasters are read in catalogue order, the first with data wins"""
+        height, width = out_shape
+        out_bounds = windows.bounds(windows.Window(0, 0, width, height), out_transform)
+        mosaic = np.full((self.count, height, width), self.nodata, dtype=self.dtype)
+        for pos in self.select(out_bounds):
+            raster_ds = self.get_ds(pos)
+            overlap = (max(out_bounds[0], raster_ds.bounds.left), max(out_bounds[1], raster_ds.bounds.bottom),
+                       min(out_bounds[2], raster_ds.bounds.right), min(out_bounds[3], raster_ds.bounds.top))
+            if overlap[0] >= overlap[2] or overlap[1] >= overlap[3]:
+                continue
+            dst_window = windows.from_bounds(*overlap, transform=out_transform)
+            col_off, row_off = int(round(dst_window.col_off)), int(round(dst_window.row_off))
+            dst_width = min(int(round(dst_window.width)), width - col_off)
+            dst_height = min(int(round(dst_window.height)), height - row_off)
+            if dst_width <= 0 or dst_height <= 0:
+                continue
+            # Nearest-neighbour resampled when resolution or grid differ
+            src_window = windows.from_bounds(*overlap, transform=raster_ds.transform)
+            data = raster_ds.read(window=src_window, out_shape=(raster_ds.count, dst_height, dst_width))
+            dst_data = mosaic[:, row_off:row_off+dst_height, col_off:col_off+dst_width]
+            src_nodata = raster_ds.nodata if raster_ds.nodata is not None else self.nodata
+            fill_mask = tile_raster_rio.get_nodata_mask(dst_data, self.nodata) & ~tile_raster_rio.get_nodata_mask(data, src_nodata)
+            dst_data[fill_mask] = data[fill_mask]
+        return mosaic
+
+def clip_tiles_catalogue(raster_catalogue, qtile_acc, query_shapes, query_bounds, raster_out_path, init_rows=256):
+    """
+    Clip the catalogue to the query, one quadtree tile at a time
+    Each tile mosaics only the rasters under it; INTERSECTS tiles are masked."""
+    out_transform, out_width, out_height = raster_catalogue.get_grid_window(*query_bounds)
+    raster_meta = {
+        "driver": "GTiff",
+        "dtype": raster_catalogue.dtype,
+        "count": raster_catalogue.count,
+        "nodata": raster_catalogue.nodata,
+        "crs": raster_catalogue.crs,
+        "width": out_width,
+        "height": out_height,
+        "transform": out_transform,
+    }
+    out_full_window = windows.Window(0, 0, out_width, out_height)
+
+    with rio.open(raster_out_path, 'w', **raster_meta) as raster_out_ds:
+        # Initialise to nodata a strip at a time
+        for row_off in range(0, out_height, init_rows):
+            strip_window = windows.Window(0, row_off, out_width, min(init_rows, out_height - row_off))
+            raster_out_ds.write(np.full((raster_catalogue.count, strip_window.height, strip_window.width),
+                                        raster_catalogue.nodata, dtype=raster_catalogue.dtype), window=strip_window)
+
+        tile_count, raster_reads = 0, 0
+        for qtile in qtile_acc:
+            tile_window = windows.from_bounds(qtile.boundary.min_x, qtile.boundary.min_y,
+                                              qtile.boundary.max_x, qtile.boundary.max_y, transform=out_transform)
+            col_start, row_start = math.floor(tile_window.col_off + 0.5), math.floor(tile_window.row_off + 0.5)
+            col_stop = math.floor(tile_window.col_off + tile_window.width + 0.5)
+            row_stop = math.floor(tile_window.row_off + tile_window.height + 0.5)
+            try:
+                tile_window = windows.Window(col_start, row_start, col_stop - col_start, row_stop - row_start) \
+                    .intersection(out_full_window)
+            except rio.errors.WindowError:
+                continue
+            if tile_window.width <= 0 or tile_window.height <= 0:
+                continue
+
+            tile_transform = windows.transform(tile_window, out_transform)
+            tile_shape = (int(tile_window.height), int(tile_window.width))
+            raster_reads += len(raster_catalogue.select(windows.bounds(tile_window, out_transform)))
+            mosaic = raster_catalogue.read_mosaic(tile_transform, tile_shape)
+            if qtile.node_type == QuadTreeNodeType.INTERSECTS:
+                mosaic[:, geometry_mask(query_shapes, out_shape=tile_shape, transform=tile_transform)] = raster_catalogue.nodata
+            raster_out_ds.write(mosaic, window=tile_window)
+            tile_count += 1
+
+    raster_catalogue.close()
+    print(f"CATALOGUE CLIP: {tile_count} tiles from {raster_reads} raster reads")
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Catalogue a directory of rasters for quadtree_tile_rio.py --in_catalogue",
+                                     epilog="Example: raster_catalogue.py dem_blocks/ dem_catalogue.json")
+    parser.add_argument("raster_dir", help="Directory searched recursively for rasters")
+    parser.add_argument("catalogue_json", help="Output catalogue, updated in place if it exists")
+    parser.add_argument("--pattern", default="*.tif", help="Raster file name pattern")
+    args = parser.parse_args()
+
+    start_time = datetime.now()
+    build_catalogue(args.raster_dir, args.catalogue_json, args.pattern)
+    log_time_diff(start_time, datetime.now(), label="CATALOGUE-BUILD")
@@ -0,0 +1,311 @@
+import os, json, math, argparse
+import numpy as np
+
+import fiona
+import rasterio as rio
+import rasterio.mask
+from rasterio import windows
+from rasterio.features import geometry_mask
+from shapely.geometry import box, mapping, shape
+
+from quadtree import *
+from raster_tile_cache import get_raster_id
+from geom_preprocess import *
+
+from datetime import datetime
+
+"""
+    Statistics pyramid of a raster band over BASE_QUADTREE tiles
+
+    Every pixel is assigned to the leaf tile ({tile_size} map units) holding
+    its centre. Each tile, at the leaf depth and every coarser depth, stores
+    the valid pixel count, sum, sum of squares, min and max of its pixels.
+    A zonal query decomposes the polygon into quadtree tiles and combines the
+    stored aggregates of INSIDE tiles; pixels are only read for the leaf
+    INTERSECTS tiles along the boundary.
+
+    {pyramid}.npz, rows sorted by (depth, tile_code):
+        depth, ix, iy, tile_code, count, sum, sumsq, min, max
+        meta_json   raster path and id, band, nodata, tile_size, leaf_depth
+"""
+
+STATS_COLUMNS = ['depth', 'ix', 'iy', 'tile_code', 'count', 'sum', 'sumsq', 'min', 'max']
+
+def log_time_diff(start_time, end_time, label="EXEC_TIME"):
+    time_diff = (end_time - start_time)
+    exec_time_millis = time_diff.total_seconds() * 1000
+    print(f"EXECTIME|{label}|{exec_time_millis:.2f}|milliseconds")
+
+def get_leaf_depth(tile_size):
+    """Depth of {tile_size} leaves, checking it divides BASE_QUADTREE in powers of two"""
+    base_w = local_config.BASE_QUADTREE["max_x"] - local_config.BASE_QUADTREE["min_x"]
+    leaf_depth = math.log2(base_w / tile_size)
+    if leaf_depth != int(leaf_depth) or not 0 <= leaf_depth <= QTREE_MAX_DEPTH:
+        raise ValueError(f"Tile size {tile_size} is not BASE_QUADTREE width {base_w} over a power of two")
+    return int(leaf_depth)
+
+def get_pixel_tile_index(raster_transform, cols, rows, tile_size):
+    """Leaf tile ix of pixel columns {cols} and iy of pixel rows {rows}, by pixel centre"""
+    xs = raster_transform.c + (np.asarray(cols) + 0.5) * raster_transform.a
+    ys = raster_transform.f + (np.asarray(rows) + 0.5) * raster_transform.e
+    ixs = np.floor((xs - local_config.BASE_QUADTREE["min_x"]) / tile_size).astype(np.int64)
+    iys = np.floor((ys - local_config.BASE_QUADTREE["min_y"]) / tile_size).astype(np.int64)
+    return ixs, iys
+
+def get_valid_mask(data, nodata):
+    valid = ~np.isnan(data)
+    if nodata is not None:
+        valid &= data != nodata
+    return valid
+
+def aggregate_parent_level(level):
+    """Aggregate a level's tiles into their parents one depth up"""
+    parent_key, inverse = np.unique(np.stack([level['ix'] >> 1, level['iy'] >> 1], axis=1), axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    num_parents = len(parent_key)
+    parent = {
+        'ix': parent_key[:,0],
+        'iy': parent_key[:,1],
+        'count': np.bincount(inverse, weights=level['count'], minlength=num_parents).astype(np.int64),
+        'sum': np.bincount(inverse, weights=level['sum'], minlength=num_parents),
+        'sumsq': np.bincount(inverse, weights=level['sumsq'], minlength=num_parents),
+        'min': np.full(num_parents, np.inf),
+        'max': np.full(num_parents, -np.inf),
+    }
+    np.minimum.at(parent['min'], inverse, level['min'])
+    np.maximum.at(parent['max'], inverse, level['max'])
+    return parent
+
+def build_stats_pyramid(raster_path, pyramid_path, tile_size=1024, band=1, strip_rows=512):
+    with rio.open(raster_path) as raster_ds:
+        nodata = raster_ds.nodata
+        col_ix, _ = get_pixel_tile_index(raster_ds.transform, np.arange(raster_ds.width), 0, tile_size)
+        _, row_iy = get_pixel_tile_index(raster_ds.transform, 0, np.arange(raster_ds.height), tile_size)
+        ix0, iy0 = col_ix.min(), row_iy.min()
+        nx, ny = col_ix.max() - ix0 + 1, row_iy.max() - iy0 + 1
+
+        count = np.zeros(nx * ny, dtype=np.int64)
+        tile_sum = np.zeros(nx * ny)
+        tile_sumsq = np.zeros(nx * ny)
+        tile_min = np.full(nx * ny, np.inf)
+        tile_max = np.full(nx * ny, -np.inf)
+
+        # One strip of rows at a time, every pixel binned into its leaf tile
+        for row_off in range(0, raster_ds.height, strip_rows):
+            strip_window = windows.Window(0, row_off, raster_ds.width, min(strip_rows, raster_ds.height - row_off))
+            data = raster_ds.read(band, window=strip_window).astype(np.float64)
+            valid = get_valid_mask(data, nodata)
+            flat_idx = (row_iy[row_off:row_off+strip_window.height] - iy0)[:,None] * nx + (col_ix - ix0)[None,:]
+            idx, values = flat_idx[valid], data[valid]
+            count += np.bincount(idx, minlength=nx * ny)
+            tile_sum += np.bincount(idx, weights=values, minlength=nx * ny)
+            tile_sumsq += np.bincount(idx, weights=values * values, minlength=nx * ny)
+            np.minimum.at(tile_min, idx, values)
+            np.maximum.at(tile_max, idx, values)
+
+    leaf_depth = get_leaf_depth(tile_size)
+    nonempty = np.nonzero(count)[0]
+    level = {
+        'ix': ix0 + nonempty % nx,
+        'iy': iy0 + nonempty // nx,
+        'count': count[nonempty],
+        'sum': tile_sum[nonempty],
+        'sumsq': tile_sumsq[nonempty],
+        'min': tile_min[nonempty],
+        'max': tile_max[nonempty],
+    }
+    column_lists = { column: [] for column in STATS_COLUMNS }
+    for depth in range(leaf_depth, -1, -1):
+        level['depth'] = np.full(len(level['ix']), depth, dtype=np.uint8)
+        level['tile_code'] = get_tile_code(level['depth'], level['ix'].astype(np.uint32), level['iy'].astype(np.uint32))
+        for column in STATS_COLUMNS:
+            column_lists[column].append(level[column])
+        if depth > 0:
+            level = aggregate_parent_level(level)
+
+    columns = { column: np.concatenate(arr_list) for column, arr_list in column_lists.items() }
+    sort_order = np.lexsort((columns['tile_code'], columns['depth']))
+    meta = {
+        'raster': os.path.abspath(raster_path),
+        'raster_id': get_raster_id(raster_path),
+        'band': band,
+        'nodata': nodata,
+        'tile_size': tile_size,
+        'leaf_depth': leaf_depth,
+    }
+    with open(pyramid_path, 'wb') as pyramid_fh:
+        np.savez(pyramid_fh, meta_json=np.array(json.dumps(meta)),
+                 **{ column: arr[sort_order] for column, arr in columns.items() })
+    print(f"Built stats pyramid: {len(sort_order)} tiles at depths {leaf_depth}..0, {int(count.sum())} valid pixels")
+    return meta
+
+def rec_stats_decompose(qtree, geom, qtile_acc, leaf_depth):
+    """
+    Like quadtree_tile_rio.rec_tile_search: INSIDE tiles at any depth,
+    INTERSECTS leaves at the pyramid's {leaf_depth}"""
+    if qtree.boundary.to_shapely_poly().within(geom):
+        qtree.node_type = QuadTreeNodeType.INSIDE
+        qtile_acc.append(qtree)
+        return
+
+    if qtree.depth >= leaf_depth:
+        if qtree.intersects_shapely_geom(geom):
+            qtree.node_type = QuadTreeNodeType.INTERSECTS
+            qtile_acc.append(qtree)
+        return
+
+    qtree.divide()
+    for child in (qtree.nw, qtree.ne, qtree.se, qtree.sw):
+        if child.intersects_shapely_geom(geom):
+            rec_stats_decompose(child, geom, qtile_acc, leaf_depth)
+
+class ZonalStats:
+    """Running count, sum, sum of squares, min and max"""
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.sumsq = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, count, value_sum, value_sumsq, value_min, value_max):
+        self.count += int(count)
+        self.sum += float(value_sum)
+        self.sumsq += float(value_sumsq)
+        self.min = min(self.min, float(value_min))
+        self.max = max(self.max, float(value_max))
+
+    def add_values(self, values):
+        if len(values):
+            self.add(len(values), values.sum(), (values * values).sum(), values.min(), values.max())
+
+    def to_dict(self):
+        mean = self.sum / self.count if self.count else None
+        std = math.sqrt(max(0.0, self.sumsq / self.count - mean * mean)) if self.count else None
+        return {
+            'count': self.count,
+            'min': self.min if self.count else None,
+            'max': self.max if self.count else None,
+            'mean': mean,
+            'std': std,
+            'sum': self.sum,
+        }
+
+class StatsPyramid:
+
+    def __init__(self, pyramid_path):
+        with np.load(pyramid_path) as pyramid_npz:
+            self.meta = json.loads(str(pyramid_npz['meta_json']))
+            for column in STATS_COLUMNS:
+                setattr(self, column, pyramid_npz[column])
+        if get_leaf_depth(self.meta['tile_size']) != self.meta['leaf_depth']:
+            raise ValueError(f"Stats pyramid [{pyramid_path}] leaf depth does not match its tile size, rebuild with --build")
+        self.depth_start = np.searchsorted(self.depth, np.arange(self.meta['leaf_depth'] + 2), side='left')
+
+    def add_tile(self, zonal_stats, depth, ix, iy):
+        """Add the stored aggregate of tile (depth, ix, iy) to {zonal_stats}"""
+        lo, hi = self.depth_start[depth], self.depth_start[depth+1]
+        code = get_tile_code(depth, ix, iy)
+        row = lo + np.searchsorted(self.tile_code[lo:hi], np.uint64(code))
+        if row < hi and self.tile_code[row] == code:
+            zonal_stats.add(self.count[row], self.sum[row], self.sumsq[row], self.min[row], self.max[row])
+
+def query_zonal_stats(stats_pyramid, raster_ds, query_geom):
+    """
+    min, max, mean, std, sum and count of the pyramid's raster band within
+    {query_geom}, pixels counted by centre"""
+    tile_size = stats_pyramid.meta['tile_size']
+    band, nodata = stats_pyramid.meta['band'], stats_pyramid.meta['nodata']
+    query_geom = query_geom.intersection(box(*raster_ds.bounds))
+    zonal_stats = ZonalStats()
+    if query_geom.is_empty:
+        return zonal_stats.to_dict(), 0, 0
+
+    qtile_acc = []
+    rec_stats_decompose(QuadTree(get_base_rect(), None), query_geom, qtile_acc, stats_pyramid.meta['leaf_depth'])
+
+    query_shapes = [ mapping(query_geom) ]
+    raster_window = windows.Window(0, 0, raster_ds.width, raster_ds.height)
+    inside_count, boundary_count = 0, 0
+    for qtile in qtile_acc:
+        depth, ix, iy = qtile.tile_address()
+        if qtile.node_type == QuadTreeNodeType.INSIDE:
+            stats_pyramid.add_tile(zonal_stats, depth, ix, iy)
+            inside_count += 1
+            continue
+
+        # Boundary leaf: its pixels, by centre, that fall inside the query
+        tile_window = windows.from_bounds(qtile.boundary.min_x, qtile.boundary.min_y,
+                                          qtile.boundary.max_x, qtile.boundary.max_y, transform=raster_ds.transform)
+        col_start, row_start = math.floor(tile_window.col_off) - 1, math.floor(tile_window.row_off) - 1
+        tile_window = windows.Window(col_start, row_start,
+                                     math.ceil(tile_window.col_off + tile_window.width) + 1 - col_start,
+                                     math.ceil(tile_window.row_off + tile_window.height) + 1 - row_start)
+        try:
+            tile_window = tile_window.intersection(raster_window)
+        except rio.errors.WindowError:
+            continue
+        data = raster_ds.read(band, window=tile_window).astype(np.float64)
+        col_ix, _ = get_pixel_tile_index(raster_ds.transform, tile_window.col_off + np.arange(data.shape[1]), 0, tile_size)
+        _, row_iy = get_pixel_tile_index(raster_ds.transform, 0, tile_window.row_off + np.arange(data.shape[0]), tile_size)
+        in_tile = (row_iy[:,None] == iy) & (col_ix[None,:] == ix)
+        in_query = ~geometry_mask(query_shapes, out_shape=data.shape, transform=windows.transform(tile_window, raster_ds.transform))
+        zonal_stats.add_values(data[in_tile & in_query & get_valid_mask(data, nodata)])
+        boundary_count += 1
+
+    return zonal_stats.to_dict(), inside_count, boundary_count
+
+def query_zonal_stats_pixels(raster_ds, query_geom, band=1):
+    """Reference: every pixel of the query's window"""
+    masked_data, _ = rasterio.mask.mask(raster_ds, [ mapping(query_geom) ], crop=True, indexes=band, filled=False)
+    zonal_stats = ZonalStats()
+    values = masked_data.compressed().astype(np.float64)
+    zonal_stats.add_values(values[get_valid_mask(values, raster_ds.nodata)])
+    return zonal_stats.to_dict()
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Build a raster statistics pyramid, or query zonal statistics from it",
+                                     epilog="Example: raster_stats_pyramid.py dem.tif dem_stats.npz --build; "
+                                            "raster_stats_pyramid.py dem.tif dem_stats.npz --query_shp query.shp")
+    parser.add_argument("in_raster", help="Input raster")
+    parser.add_argument("pyramid_npz", help="Statistics pyramid file")
+    parser.add_argument("--build", action="store_true", help="(Re)build the pyramid")
+    parser.add_argument("--tile_size", type=int, default=1024, help="Leaf tile size in UTM51N")
+    parser.add_argument("--band", type=int, default=1, help="Raster band")
+    parser.add_argument("--query_shp", help="Query shapefile")
+    parser.add_argument("--geom_cache_dir", help="Cache directory for preprocessed geometries")
+    parser.add_argument("--verify", action="store_true", help="Also compute the statistics from every pixel")
+    args = parser.parse_args()
+
+    if args.build:
+        try:
+            get_leaf_depth(args.tile_size)
+        except ValueError as e:
+            parser.error(str(e))
+        start_time = datetime.now()
+        build_stats_pyramid(args.in_raster, args.pyramid_npz, tile_size=args.tile_size, band=args.band)
+        log_time_diff(start_time, datetime.now(), label="STATS-BUILD")
+
+    if args.query_shp:
+        stats_pyramid = StatsPyramid(args.pyramid_npz)
+        if stats_pyramid.meta['raster_id'] != get_raster_id(args.in_raster):
+            print(f"WARNING: {args.in_raster} changed since the pyramid was built, rebuild with --build")
+
+        with fiona.open(args.query_shp) as query_sh:
+            geom_cache = GeometryCache(args.geom_cache_dir) if args.geom_cache_dir else None
+            query_geom = prepare_geometry(shape(next(iter(query_sh))['geometry']), geom_cache)
+
+        with rio.open(args.in_raster) as raster_ds:
+            start_time = datetime.now()
+            zonal_stats, inside_count, boundary_count = query_zonal_stats(stats_pyramid, raster_ds, query_geom)
+            log_time_diff(start_time, datetime.now(), label="STATS-QUERY_PYRAMID")
+            print(f"Tiles: {inside_count} INSIDE from the pyramid, {boundary_count} INTERSECTS from pixels")
+            print(f"ZONAL STATS: {json.dumps(zonal_stats)}")
+
+            if args.verify:
+                start_time = datetime.now()
+                pixel_stats = query_zonal_stats_pixels(raster_ds, query_geom, band=args.band)
+                log_time_diff(start_time, datetime.now(), label="STATS-QUERY_PIXELS")
+                print(f"PIXEL STATS: {json.dumps(pixel_stats)}")
@@ -0,0 +1,133 @@
+import os, hashlib, threading
+import numpy as np
+
+"""
+    Persistent raster tile store keyed by (raster id, depth, ix, iy)
+
+    Tiles fully INSIDE a query are cut the same way from the same source
+    raster whatever the query, so their pixels are stored once as compressed
+    npz chunks and reused by later clips. The raster id changes with the
+    source file's path, size and modification time, so a replaced raster never
+    serves stale tiles. The store is bounded in size, least recently used
+    tiles are evicted first.
+
+    {cache_dir}/{raster_id}/{depth}/{ix}_{iy}.npz
+        data    tile pixels, bands * rows * cols
+        window  col_off, row_off, width, height in the source raster
+"""
+
+def get_raster_id(raster_path):
+    raster_stat = os.stat(raster_path)
+    raster_hash = hashlib.sha1(f"{os.path.abspath(raster_path)}|{raster_stat.st_size}|{raster_stat.st_mtime_ns}".encode())
+    return raster_hash.hexdigest()[:16]
+
+def get_window_array(window):
+    return np.array([window.col_off, window.row_off, window.width, window.height], dtype=np.int64)
+
+class RasterTileCache:
+    """Size-bounded, least recently used raster tile store"""
+
+    def __init__(self, cache_dir, max_mb=1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size_bytes = sum(size for _, _, size in self.list_tiles())
+
+    def list_tiles(self):
+        """(path, last use, size) of every stored tile"""
+        tile_list = []
+        for dir_path, _, file_names in os.walk(self.cache_dir):
+            for file_name in file_names:
+                if not file_name.endswith(".npz"):
+                    continue
+                try:
+                    file_stat = os.stat(os.path.join(dir_path, file_name))
+                except FileNotFoundError:
+                    # Evicted since listed
+                    continue
+                tile_list.append((os.path.join(dir_path, file_name), file_stat.st_mtime, file_stat.st_size))
+        return tile_list
+
+    def get_path(self, raster_id, depth, ix, iy):
+        return os.path.join(self.cache_dir, raster_id, f"{depth:02d}", f"{ix}_{iy}.npz")
+
+    def contains(self, raster_id, tile_address):
+        return os.path.exists(self.get_path(raster_id, *tile_address))
+
+    def record_miss(self):
+        with self.lock:
+            self.misses += 1
+
+    def get(self, raster_id, tile_address, window):
+        """Cached pixels of tile {tile_address} read over {window}, or None"""
+        tile_path = self.get_path(raster_id, *tile_address)
+        try:
+            with np.load(tile_path) as tile_npz:
+                if np.array_equal(tile_npz['window'], get_window_array(window)):
+                    data = tile_npz['data']
+                else:
+                    data = None
+        except (OSError, ValueError, KeyError):
+            data = None
+
+        with self.lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # Mark as recently used, under the lock so put() cannot evict it in between
+            try:
+                os.utime(tile_path)
+            except FileNotFoundError:
+                # Evicted by another process sharing the store, the data is already read
+                pass
+        return data
+
+    def put(self, raster_id, tile_address, window, data):
+        tile_path = self.get_path(raster_id, *tile_address)
+        os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+        tmp_path = f"{tile_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as tile_fh:
+            np.savez_compressed(tile_fh, data=data, window=get_window_array(window))
+        tile_size = os.path.getsize(tmp_path)
+
+        with self.lock:
+            # Count only the growth when overwriting a stored tile
+            try:
+                old_size = os.path.getsize(tile_path)
+            except FileNotFoundError:
+                old_size = 0
+            os.replace(tmp_path, tile_path)
+            self.size_bytes += tile_size - old_size
+            if self.size_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used tiles until under 90% of the bound
+        #NOTE: rescans the store, other processes may share it"""
+        tile_list = sorted(self.list_tiles(), key=lambda tile: tile[1])
+        self.size_bytes = sum(size for _, _, size in tile_list)
+        for tile_path, _, size in tile_list:
+            if self.size_bytes <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(tile_path)
+            except FileNotFoundError:
+                pass
+            self.size_bytes -= size
+            self.evictions += 1
+
+    def get_hit_rate(self):
+        return self.hits / max(1, self.hits + self.misses)
+
+    def log_stats(self, label="RASTER_TILE_CACHE"):
+        print(f"CACHE|{label}|hits={self.hits}|misses={self.misses}|evictions={self.evictions}"
+              f"|{self.get_hit_rate():.4f}|hit_rate|{self.size_bytes / (1024 * 1024):.2f}|megabytes")
+
+    def __str__(self):
+        return f"RasterTileCache[{self.cache_dir}] hits={self.hits} misses={self.misses} evictions={self.evictions}"
@@ -0,0 +1,164 @@
+import os, argparse
+import numpy as np
+import rasterio as rio
+from rasterio import windows
+
+from raster_tile_cache import get_raster_id
+import tile_raster_rio
+
+from datetime import datetime
+
+"""
+    Per-block validity summary of a raster, for pruning nodata tiles
+
+    The raster is scanned once, a strip of blocks at a time, through its
+    dataset mask. Every block keeps whether it holds any valid pixel and the
+    bounding box of its valid pixels. Tile windows over only empty blocks are
+    dropped before any read, windows over partly empty blocks are shrunk to
+    the valid boxes they overlap. The summary is cached as an npz keyed by the
+    raster id, so a replaced raster is rescanned.
+
+    {cache_dir}/{raster_id}.npz
+        block_size  rows, cols of the scan grid
+        has_valid   blocks with at least one valid pixel
+        valid_box   col_start, row_start, col_stop, row_stop of the valid
+                    pixels of every block, in raster pixels
+"""
+
+SCAN_BLOCK = 256
+
+def log_time_diff(start_time, end_time, label="EXEC_TIME"):
+    time_diff = (end_time - start_time)
+    exec_time_millis = time_diff.total_seconds() * 1000
+    print(f"EXECTIME|{label}|{exec_time_millis:.2f}|milliseconds")
+
+def get_scan_block_size(raster_ds):
+    """Raster blocks when tiled, else SCAN_BLOCK square"""
+    block_rows, block_cols = tile_raster_rio.get_block_size(raster_ds)
+    return (block_rows if block_rows > 1 else SCAN_BLOCK, block_cols if block_cols > 1 else SCAN_BLOCK)
+
+def scan_valid_blocks(raster_ds, block_size):
+    """
+    Validity of every block of {block_size} over the raster
+    Returns has_valid (blocks_y, blocks_x) and valid_box (blocks_y, blocks_x, 4)"""
+    block_rows, block_cols = block_size
+    blocks_y, blocks_x = -(-raster_ds.height // block_rows), -(-raster_ds.width // block_cols)
+    has_valid = np.zeros((blocks_y, blocks_x), dtype=bool)
+    valid_box = np.zeros((blocks_y, blocks_x, 4), dtype=np.int64)
+    col_starts = np.arange(blocks_x, dtype=np.int64) * block_cols
+
+    for block_y in range(blocks_y):
+        row_off = block_y * block_rows
+        strip_window = windows.Window(0, row_off, raster_ds.width, min(block_rows, raster_ds.height - row_off))
+        # Valid where any band is valid
+        strip_valid = np.any(raster_ds.read_masks(window=strip_window) > 0, axis=0)
+        strip_valid = np.pad(strip_valid, ((0, 0), (0, blocks_x * block_cols - raster_ds.width)))
+        strip_valid = strip_valid.reshape(strip_valid.shape[0], blocks_x, block_cols)
+
+        row_any = strip_valid.any(axis=2)    # rows, blocks_x
+        col_any = strip_valid.any(axis=0)    # blocks_x, block_cols
+        has_valid[block_y] = row_any.any(axis=0)
+        valid_box[block_y, :, 0] = col_starts + np.argmax(col_any, axis=1)
+        valid_box[block_y, :, 1] = row_off + np.argmax(row_any, axis=0)
+        valid_box[block_y, :, 2] = col_starts + block_cols - np.argmax(col_any[:, ::-1], axis=1)
+        valid_box[block_y, :, 3] = row_off + row_any.shape[0] - np.argmax(row_any[::-1], axis=0)
+    return has_valid, valid_box
+
+class RasterValidity:
+    """Block validity summary of one raster, built once and cached"""
+
+    def __init__(self, raster_ds, cache_dir=None):
+        self.itemsize = raster_ds.count * np.dtype(raster_ds.dtypes[0]).itemsize
+        self.raster_window = windows.Window(0, 0, raster_ds.width, raster_ds.height)
+        self.pruned = 0
+        self.shrunk = 0
+        self.saved_bytes = 0
+
+        cache_path = None
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            cache_path = os.path.join(cache_dir, f"{get_raster_id(raster_ds.name)}.npz")
+        if cache_path is not None and os.path.exists(cache_path):
+            with np.load(cache_path) as summary_npz:
+                self.block_size = tuple(int(size) for size in summary_npz['block_size'])
+                self.has_valid = summary_npz['has_valid']
+                self.valid_box = summary_npz['valid_box']
+            return
+
+        start_time = datetime.now()
+        self.block_size = get_scan_block_size(raster_ds)
+        self.has_valid, self.valid_box = scan_valid_blocks(raster_ds, self.block_size)
+        log_time_diff(start_time, datetime.now(), label="RASTER-VALIDITY_SCAN")
+        if cache_path is not None:
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as summary_fh:
+                np.savez_compressed(summary_fh, block_size=np.array(self.block_size, dtype=np.int64),
+                                    has_valid=self.has_valid, valid_box=self.valid_box)
+            os.replace(tmp_path, cache_path)
+
+    def get_valid_window(self, window):
+        """
+        {window} shrunk to the valid boxes of the blocks under it, or None
+        when those blocks hold no valid pixel"""
+        row_start, col_start, row_stop, col_stop = tile_raster_rio.get_window_blocks(window, self.block_size)
+        row_start, col_start = max(row_start, 0), max(col_start, 0)
+        block_valid = self.has_valid[row_start:row_stop, col_start:col_stop]
+        if not block_valid.any():
+            return None
+        block_box = self.valid_box[row_start:row_stop, col_start:col_stop][block_valid]
+        col_off, row_off = int(window.col_off), int(window.row_off)
+        valid_col_start = max(col_off, int(block_box[:, 0].min()))
+        valid_row_start = max(row_off, int(block_box[:, 1].min()))
+        valid_col_stop = min(col_off + int(window.width), int(block_box[:, 2].max()))
+        valid_row_stop = min(row_off + int(window.height), int(block_box[:, 3].max()))
+        if valid_col_stop <= valid_col_start or valid_row_stop <= valid_row_start:
+            return None
+        return windows.Window(valid_col_start, valid_row_start,
+                              valid_col_stop - valid_col_start, valid_row_stop - valid_row_start)
+
+    def get_read_pixels(self, window):
+        """Pixels of {window} inside the raster, the ones a read would fetch"""
+        try:
+            read_window = window.intersection(self.raster_window)
+        except windows.WindowError:
+            return 0
+        return int(read_window.width) * int(read_window.height)
+
+    def prune(self, tile_window_list, shrink=True):
+        """
+        Drop the (qtile, window) pairs of {tile_window_list} without valid
+        pixels, and with {shrink} fit the rest to their valid pixels"""
+        pruned_list = []
+        for qtile, tile_window in tile_window_list:
+            valid_window = self.get_valid_window(tile_window)
+            tile_pixels = self.get_read_pixels(tile_window)
+            if valid_window is None:
+                self.pruned += 1
+                self.saved_bytes += tile_pixels * self.itemsize
+                continue
+            if shrink and valid_window != tile_window:
+                self.shrunk += 1
+                self.saved_bytes += (tile_pixels - self.get_read_pixels(valid_window)) * self.itemsize
+                tile_window = valid_window
+            pruned_list.append((qtile, tile_window))
+        return pruned_list
+
+    def get_valid_fraction(self):
+        return self.has_valid.mean() if self.has_valid.size else 0.0
+
+    def log_stats(self, label="RASTER_VALIDITY"):
+        print(f"PRUNE|{label}|pruned={self.pruned}|shrunk={self.shrunk}"
+              f"|{self.saved_bytes / (1024 * 1024):.2f}|megabytes_saved")
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Scan a raster's valid blocks for quadtree_tile_rio.py --prune_nodata",
+                                     epilog="Example: raster_validity.py dem.tif validity_cache/")
+    parser.add_argument("in_raster", help="Input raster")
+    parser.add_argument("cache_dir", help="Directory of cached validity summaries")
+    args = parser.parse_args()
+
+    with rio.open(args.in_raster) as raster_ds:
+        raster_validity = RasterValidity(raster_ds, args.cache_dir)
+    print(f"VALID BLOCKS: {int(raster_validity.has_valid.sum())} of {raster_validity.has_valid.size}"
+          f" ({raster_validity.get_valid_fraction():.2%}), block size {raster_validity.block_size}")
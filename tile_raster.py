@@ -1,9 +1,9 @@
 import logging
+import math
 import numpy
 import os
 import random
 import sys
-import gdalconst
 
 _BUFFER = 50  # meters
 
@@ -114,6 +114,118 @@ def write_raster(path, driver_name, new_band_array, data_type, geotransform,
     # Flush data
     del raster_dataset
 
+def get_grid_bounds(gt, min_x, min_y, max_x, max_y):
+    """
+    Extents grown outward to the pixel grid of geotransform {gt}
+    #NOTE: assumes a north-up raster"""
+    col_start = math.floor((min_x - gt[0]) / gt[1])
+    col_stop = math.ceil((max_x - gt[0]) / gt[1])
+    row_start = math.floor((max_y - gt[3]) / gt[5])
+    row_stop = math.ceil((min_y - gt[3]) / gt[5])
+    return (gt[0] + col_start * gt[1], gt[3] + row_stop * gt[5],
+            gt[0] + col_stop * gt[1], gt[3] + row_start * gt[5])
+
+def check_query_srs(query_prj, raster_prj):
+    """
+    Raise when the query CRS {query_prj} is not the raster CRS {raster_prj}
+    #NOTE: an empty {query_prj} is taken to be in the raster CRS"""
+    if not query_prj:
+        return
+    query_srs = osr.SpatialReference()
+    query_srs.ImportFromWkt(query_prj)
+    raster_srs = osr.SpatialReference()
+    raster_srs.ImportFromWkt(raster_prj)
+    if not query_srs.IsSame(raster_srs):
+        raise Exception(f"Query CRS [{query_srs.GetName()}] is not the raster CRS [{raster_srs.GetName()}]!")
+
+def clamp_grid_bounds(gt, cols, rows, grid_bounds):
+    """
+    {grid_bounds} cut to the extent of a {cols} x {rows} raster with
+    geotransform {gt}, or None when they do not overlap
+    #NOTE: assumes a north-up raster"""
+    min_x, min_y = max(grid_bounds[0], gt[0]), max(grid_bounds[1], gt[3] + rows * gt[5])
+    max_x, max_y = min(grid_bounds[2], gt[0] + cols * gt[1]), min(grid_bounds[3], gt[3])
+    if max_x <= min_x or max_y <= min_y:
+        return None
+    return min_x, min_y, max_x, max_y
+
+def write_vsimem_cutline(cutline_path, geom_wkt_list, raster_prj):
+    """
+    Write the query geometries to an in-memory GeoJSON cutline
+    #NOTE: the geometries must be in the raster CRS, see check_query_srs()"""
+    cutline_srs = osr.SpatialReference()
+    cutline_srs.ImportFromWkt(raster_prj)
+    cutline_ds = ogr.GetDriverByName("GeoJSON").CreateDataSource(cutline_path)
+    cutline_layer = cutline_ds.CreateLayer("cutline", cutline_srs, ogr.wkbMultiPolygon)
+    for geom_wkt in geom_wkt_list:
+        cutline_feature = ogr.Feature(cutline_layer.GetLayerDefn())
+        cutline_feature.SetGeometry(ogr.CreateGeometryFromWkt(geom_wkt))
+        cutline_layer.CreateFeature(cutline_feature)
+        cutline_feature = None
+    # Flush data
+    del cutline_ds
+
+def warp_clip_raster(raster_path, out_path, cutline_path, grid_bounds, raster_band_nodata,
+                     num_threads="ALL_CPUS", warp_memory_mb=512):
+    """
+    Warp {raster_path} cut to {cutline_path} over {grid_bounds} straight into
+    a tiled, compressed GeoTIFF at {out_path}
+    Same resolution and grid as the source, so nearest neighbour copies
+    pixels unchanged; pixels whose centre is outside the cutline are nodata.
+    #NOTE: warps into GTiff, a VRT output would drop multithread (-multi)"""
+    raster_ds = gdal.Open(raster_path)
+    raster_gt = raster_ds.GetGeoTransform()
+    warp_options = gdal.WarpOptions(format="GTiff",
+                                    outputBounds=grid_bounds,
+                                    xRes=raster_gt[1], yRes=abs(raster_gt[5]),
+                                    resampleAlg="near",
+                                    cutlineDSName=cutline_path,
+                                    srcNodata=raster_band_nodata, dstNodata=raster_band_nodata,
+                                    multithread=True,
+                                    warpMemoryLimit=warp_memory_mb,
+                                    warpOptions=[f"NUM_THREADS={num_threads}"],
+                                    creationOptions=["TILED=YES", "COMPRESS=DEFLATE", "BIGTIFF=IF_SAFER",
+                                                     f"NUM_THREADS={num_threads}"])
+    out_ds = gdal.Warp(out_path, raster_ds, options=warp_options)
+    if out_ds is None:
+        raise Exception(f"Cannot write clipped raster [{out_path}]!")
+    del raster_ds
+    # Flush data
+    del out_ds
+
+def clip_raster_vsimem(raster_path, geom_wkt_list, query_bounds, out_path, query_prj=None, num_threads="ALL_CPUS"):
+    """
+    Clip {raster_path} to the query geometries in one GDAL warp
+    The cutline lives in /vsimem/, only {out_path} touches disk.
+    The output covers {query_bounds} on the source pixel grid, cut to the raster.
+    #NOTE: {query_bounds} are (min_x, min_y, max_x, max_y) in {query_prj},
+    which must be the raster CRS"""
+    cutline_path = f"/vsimem/{os.path.basename(out_path)}.{os.getpid()}_cutline.geojson"
+
+    raster_ds = gdal.Open(raster_path)
+    if raster_ds is None:
+        raise Exception(f"Cannot open raster in path [{raster_path}]!")
+    raster_prj = raster_ds.GetProjection()
+    raster_gt = raster_ds.GetGeoTransform()
+    raster_cols, raster_rows = raster_ds.RasterXSize, raster_ds.RasterYSize
+    raster_band_nodata = raster_ds.GetRasterBand(1).GetNoDataValue()
+    if raster_band_nodata is None:
+        raster_band_nodata = 0
+    del raster_ds
+    check_query_srs(query_prj, raster_prj)
+
+    # Same extent as the quadtree_tile_rio.py writers, the query window cut to the raster
+    grid_bounds = clamp_grid_bounds(raster_gt, raster_cols, raster_rows, get_grid_bounds(raster_gt, *query_bounds))
+    if grid_bounds is None:
+        print(f"Query does not overlap raster [{raster_path}], skipping")
+        return
+
+    try:
+        write_vsimem_cutline(cutline_path, geom_wkt_list, raster_prj)
+        warp_clip_raster(raster_path, out_path, cutline_path, grid_bounds, raster_band_nodata, num_threads)
+    finally:
+        gdal.Unlink(cutline_path)
+
 def isexists(path):
     normpath = os.path.normpath(path)
     # Check if path exists
@@ -1,11 +1,17 @@
 import os, argparse, math
+import xml.etree.ElementTree as ET
 from itertools import product
 from pprint import pprint
 
+import numpy as np
 import rasterio as rio
+import rasterio.shutil
 from rasterio import windows
+from rasterio.enums import Resampling
 from affine import Affine
 
+import local_config
+
 def get_tiles(ds, width=256, height=256):
     ncols, nrows = ds.meta['width'], ds.meta['height']
     offsets = product(range(0, ncols, width), range(0, nrows, height))
@@ -53,6 +59,231 @@ def get_tile_window_from_extents(raster_ds, min_x, min_y, max_x, max_y, tile_siz
     window = rio.windows.Window(ul_col-5, ul_row-5, win_size+10, win_size+10)
     return window
 
+def get_tile_windows_from_extents(raster_transform, extents):
+    """
+    Exact pixel windows of all tile {extents}, rows of (min_x, min_y, max_x, max_y)
+    A pixel belongs to the tile holding its centre, so adjacent tiles share no
+    pixels and leave no gaps, without padding. Tiles need not be square.
+    Returns an (N, 4) array of col_off, row_off, width, height"""
+    extents = np.asarray(extents, dtype=np.float64).reshape(-1, 4)
+    inv_transform = ~raster_transform
+    ul_col, ul_row = inv_transform * (extents[:,0], extents[:,3])
+    lr_col, lr_row = inv_transform * (extents[:,2], extents[:,1])
+    col_start = np.floor(np.minimum(ul_col, lr_col) + 0.5).astype(np.int64)
+    col_stop = np.floor(np.maximum(ul_col, lr_col) + 0.5).astype(np.int64)
+    row_start = np.floor(np.minimum(ul_row, lr_row) + 0.5).astype(np.int64)
+    row_stop = np.floor(np.maximum(ul_row, lr_row) + 0.5).astype(np.int64)
+    return np.stack([col_start, row_start, col_stop - col_start, row_stop - row_start], axis=1)
+
+def to_windows(window_array):
+    return [ windows.Window(*map(int, window_row)) for window_row in window_array ]
+
+def get_nodata_mask(data, nodata):
+    """Pixels of {data} that are {nodata}, which may be NaN"""
+    if nodata is not None and math.isnan(nodata):
+        return np.isnan(data)
+    return data == nodata
+
+def get_block_size(raster_ds):
+    """
+    (rows, cols) to align reads to
+    #NOTE: a block spanning the whole raster (e.g. strips) is not aligned on"""
+    block_rows, block_cols = raster_ds.block_shapes[0]
+    if block_rows >= raster_ds.height:
+        block_rows = 1
+    if block_cols >= raster_ds.width:
+        block_cols = 1
+    return block_rows, block_cols
+
+def get_window_blocks(window, block_size):
+    """Block index extents (row_start, col_start, row_stop, col_stop) covering {window}"""
+    block_rows, block_cols = block_size
+    return (int(window.row_off) // block_rows, int(window.col_off) // block_cols,
+            -(-int(window.row_off + window.height) // block_rows), -(-int(window.col_off + window.width) // block_cols))
+
+def plan_coalesced_reads(raster_ds, window_list, max_waste=0.25, max_pixels=4096*4096):
+    """
+    Group {window_list} into block-aligned rectangles, each read once
+    Windows are merged greedily into a group while the blocks of the group's
+    bounding rectangle not needed by any of its windows stay under {max_waste}
+    and the rectangle stays under {max_pixels}. Windows outside the raster
+    are left ungrouped (None).
+    Returns (list of group windows, group index of every window)"""
+    block_size = get_block_size(raster_ds)
+    raster_window = windows.Window(0, 0, raster_ds.width, raster_ds.height)
+    group_blocks = []       # [row_start, col_start, row_stop, col_stop] per group
+    group_needed = []       # set of needed (row, col) blocks per group
+    window_groups = []
+
+    for window in window_list:
+        if window.col_off < 0 or window.row_off < 0 or \
+            window.col_off + window.width > raster_ds.width or window.row_off + window.height > raster_ds.height:
+            window_groups.append(None)
+            continue
+
+        row_start, col_start, row_stop, col_stop = get_window_blocks(window, block_size)
+        needed = set(product(range(row_start, row_stop), range(col_start, col_stop)))
+        for group_idx, blocks in enumerate(group_blocks):
+            union = (min(blocks[0], row_start), min(blocks[1], col_start),
+                     max(blocks[2], row_stop), max(blocks[3], col_stop))
+            union_count = (union[2] - union[0]) * (union[3] - union[1])
+            union_pixels = union_count * block_size[0] * block_size[1]
+            needed_count = len(group_needed[group_idx] | needed)
+            if union_pixels <= max_pixels and union_count - needed_count <= max_waste * union_count:
+                group_blocks[group_idx] = list(union)
+                group_needed[group_idx] |= needed
+                window_groups.append(group_idx)
+                break
+        else:
+            group_blocks.append([row_start, col_start, row_stop, col_stop])
+            group_needed.append(needed)
+            window_groups.append(len(group_blocks) - 1)
+
+    group_windows = []
+    for row_start, col_start, row_stop, col_stop in group_blocks:
+        group_window = windows.Window(col_start * block_size[1], row_start * block_size[0],
+                                      (col_stop - col_start) * block_size[1], (row_stop - row_start) * block_size[0])
+        group_windows.append(group_window.intersection(raster_window))
+    return group_windows, window_groups
+
+def read_coalesced(raster_ds, window_list, max_waste=0.25, max_pixels=4096*4096):
+    """
+    Yield the data of every window of {window_list}, in order, sliced from
+    coalesced group reads. A group is read when first needed and released
+    after its last window."""
+    group_windows, window_groups = plan_coalesced_reads(raster_ds, window_list, max_waste, max_pixels)
+    print(f"COALESCED READS: {len(window_list)} windows in {len(group_windows)} reads")
+    last_use = { group_idx: win_idx for win_idx, group_idx in enumerate(window_groups) }
+    group_data = dict()
+    for win_idx, (window, group_idx) in enumerate(zip(window_list, window_groups)):
+        if group_idx is None:
+            yield raster_ds.read(window=window)
+            continue
+
+        if group_idx not in group_data:
+            group_data[group_idx] = raster_ds.read(window=group_windows[group_idx])
+        group_window = group_windows[group_idx]
+        row_off = int(window.row_off - group_window.row_off)
+        col_off = int(window.col_off - group_window.col_off)
+        clip = group_data[group_idx][:, row_off:row_off+int(window.height), col_off:col_off+int(window.width)].copy()
+        if last_use[group_idx] == win_idx:
+            del group_data[group_idx]
+        yield clip
+
+OUT_FORMATS = ["gtiff", "cog"]
+COG_COMPRESS = "deflate"
+COG_MIN_BLOCK, COG_MAX_BLOCK = 16, 512
+
+def get_cog_block_size(raster_transform, tile_size=1024):
+    """
+    Internal block size for a quadtree tile of {tile_size} map units
+    The largest power of two (16 to 512) that fits in one tile, so blocks
+    line up with tiles whenever a tile spans a power of two pixels"""
+    tile_pixels = tile_size / abs(raster_transform.a)
+    block_size = COG_MIN_BLOCK
+    while block_size * 2 <= min(tile_pixels, COG_MAX_BLOCK):
+        block_size *= 2
+    return block_size
+
+def get_cog_overview_levels(width, height, block_size):
+    """Overview factors 2, 4, 8... one per coarser quadtree depth, down to a single block"""
+    overview_levels = []
+    factor = 2
+    while max(width, height) / (factor // 2) > block_size:
+        overview_levels.append(factor)
+        factor *= 2
+    return overview_levels
+
+def align_window_to_quadtree(raster_transform, window, tile_size=1024):
+    """
+    Grow {window} so its upper-left corner is on the BASE_QUADTREE tile grid
+    #NOTE: rounded to whole pixels when tile corners fall between pixels"""
+    base_min_x, base_max_y = local_config.BASE_QUADTREE["min_x"], local_config.BASE_QUADTREE["max_y"]
+    ul_x, ul_y = raster_transform * (window.col_off, window.row_off)
+    grid_x = base_min_x + math.floor((ul_x - base_min_x) / tile_size) * tile_size
+    grid_y = base_max_y - math.floor((base_max_y - ul_y) / tile_size) * tile_size
+    grid_col, grid_row = ~raster_transform * (grid_x, grid_y)
+    grid_col, grid_row = math.floor(grid_col + 0.5), math.floor(grid_row + 0.5)
+    return windows.Window(grid_col, grid_row,
+                          window.width + (window.col_off - grid_col), window.height + (window.row_off - grid_row))
+
+def get_cog_options(dtype, block_size):
+    return {
+        'tiled': True,
+        'blockxsize': block_size,
+        'blockysize': block_size,
+        'compress': COG_COMPRESS,
+        'predictor': 3 if dtype.startswith('float') else 2,
+        'num_threads': 'ALL_CPUS',
+    }
+
+def write_cog(src_path, dst_path, tile_size=1024, resampling="average"):
+    """
+    Copy the GeoTIFF {src_path} to a cloud-optimized GeoTIFF at {dst_path}
+    Tiled and compressed with blocks and overviews following the quadtree,
+    overviews first then copied with COPY_SRC_OVERVIEWS for the COG layout"""
+    with rio.Env(GDAL_NUM_THREADS='ALL_CPUS', COMPRESS_OVERVIEW=COG_COMPRESS.upper()):
+        with rio.open(src_path, 'r+') as src_ds:
+            block_size = get_cog_block_size(src_ds.transform, tile_size)
+            overview_levels = get_cog_overview_levels(src_ds.width, src_ds.height, block_size)
+            if overview_levels:
+                src_ds.build_overviews(overview_levels, Resampling[resampling])
+                src_ds.update_tags(ns='rio_overview', resampling=resampling)
+            dtype = src_ds.dtypes[0]
+        rio.shutil.copy(src_path, dst_path, driver='GTiff', copy_src_overviews=True,
+                        **get_cog_options(dtype, block_size))
+
+GDAL_TYPE_NAMES = {
+    'uint8': 'Byte', 'int8': 'Int8', 'uint16': 'UInt16', 'int16': 'Int16', 'uint32': 'UInt32', 'int32': 'Int32',
+    'float32': 'Float32', 'float64': 'Float64',
+}
+
+def write_vrt(vrt_path, meta, source_list):
+    """
+    Write a VRT mosaic described by {meta} (width, height, count, dtype,
+    nodata, crs, transform) over {source_list} of
+    (source path, source window, destination window) tuples
+    Sources are painted in list order and skip their nodata pixels, so where
+    sources overlap the last one listed with data wins.
+    #NOTE: paths under the VRT's directory are written relative to it"""
+    vrt_dir = os.path.dirname(os.path.abspath(vrt_path))
+    vrt_root = ET.Element("VRTDataset", rasterXSize=str(meta['width']), rasterYSize=str(meta['height']))
+    if meta.get('crs') is not None:
+        ET.SubElement(vrt_root, "SRS").text = meta['crs'].to_wkt()
+    ET.SubElement(vrt_root, "GeoTransform").text = ", ".join(repr(float(value)) for value in meta['transform'].to_gdal())
+
+    for band in range(1, meta['count'] + 1):
+        vrt_band = ET.SubElement(vrt_root, "VRTRasterBand", dataType=GDAL_TYPE_NAMES[meta['dtype']], band=str(band))
+        if meta.get('nodata') is not None:
+            ET.SubElement(vrt_band, "NoDataValue").text = repr(meta['nodata'])
+        for source_path, src_window, dst_window in source_list:
+            source_path = os.path.abspath(source_path)
+            relative = source_path.startswith(vrt_dir + os.sep)
+            vrt_source = ET.SubElement(vrt_band, "ComplexSource")
+            ET.SubElement(vrt_source, "SourceFilename", relativeToVRT="1" if relative else "0").text = \
+                os.path.relpath(source_path, vrt_dir) if relative else source_path
+            ET.SubElement(vrt_source, "SourceBand").text = str(band)
+            for rect_name, rect_window in (("SrcRect", src_window), ("DstRect", dst_window)):
+                ET.SubElement(vrt_source, rect_name, xOff=str(int(rect_window.col_off)), yOff=str(int(rect_window.row_off)),
+                              xSize=str(int(rect_window.width)), ySize=str(int(rect_window.height)))
+            if meta.get('nodata') is not None:
+                ET.SubElement(vrt_source, "NODATA").text = repr(meta['nodata'])
+
+    ET.ElementTree(vrt_root).write(vrt_path)
+
+def write_raster(out_path, data, meta, out_format="gtiff", tile_size=1024):
+    """Write {data} to {out_path} as a plain GeoTIFF or a COG"""
+    if out_format != "cog":
+        with rio.open(out_path, 'w', **meta) as raster_out_ds:
+            raster_out_ds.write(data)
+        return
+
+    tmp_path = f"{out_path}.{os.getpid()}.tmp.tif"
+    with rio.open(tmp_path, 'w', **dict(meta, driver="GTiff")) as raster_out_ds:
+        raster_out_ds.write(data)
+    write_cog(tmp_path, out_path, tile_size)
+    os.remove(tmp_path)
+
 
 if __name__ == "__main__":
     #Parse CLI arguments
@@ -62,6 +293,8 @@ if __name__ == "__main__":
     
     parser.add_argument("in_raster", help="Input raster")
     parser.add_argument("out_raster_dir", help="Output directory")
+    parser.add_argument("--out_format", choices=OUT_FORMATS, default="gtiff", help="Plain GeoTIFF or cloud-optimized GeoTIFF tiles")
+    parser.add_argument("--exact_windows", action="store_true", help="Exact pixel windows by pixel centre, without the 5-pixel pad")
     args = parser.parse_args()
 
     quadtree_tile_list = [
@@ -90,11 +323,17 @@ if __name__ == "__main__":
             
 
         # Create rasterio windows
+        if args.exact_windows:
+            exact_window_list = to_windows(get_tile_windows_from_extents(
+                raster_ds.transform, [ qtile_row[4:8] for qtile_row in quadtree_tile_list ]))
         #for test_tile in test_tile_list:
         for tile_num in range(len(quadtree_tile_list)):
             width, height, cx, cy, min_x, min_y, max_x, max_y = quadtree_tile_list[tile_num]
             #tile_window = get_tile_window(raster_ds, cx, cy, tile_size=width)
-            tile_window = get_tile_window_from_extents(raster_ds, min_x, min_y, max_x, max_y, tile_size=1024)
+            if args.exact_windows:
+                tile_window = exact_window_list[tile_num]
+            else:
+                tile_window = get_tile_window_from_extents(raster_ds, min_x, min_y, max_x, max_y, tile_size=1024)
             # print(f"TILE WINDOW: {tile_window}") 
             tile_window_list.append(tile_window)
 
@@ -123,8 +362,7 @@ if __name__ == "__main__":
             # pprint(raster_meta['transform'])
             # pprint(meta['transform'])
 
-            with rio.open(tile_output_path, 'w', **meta) as raster_out_ds:
-                raster_out_ds.write(clip)
+            write_raster(tile_output_path, clip, meta, out_format=args.out_format, tile_size=width)
 
     
         
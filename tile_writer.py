@@ -0,0 +1,127 @@
+import os
+import numpy as np
+import fiona
+from fiona.crs import from_epsg
+
+from quadtree import Rect, get_tile_address, get_tile_code
+
+"""
+    Batched, format-selectable writer of tile records
+
+    A drop-in for the fiona collection handed to write_rect_to_shp() and
+    friends: records are buffered and written with one writerecords() call
+    per batch. Vector formats keep the full records; the compact formats keep
+    only the BASE_QUADTREE address of each tile, which tile_rect() inverts.
+
+    shp     ESRI Shapefile, string fields narrowed to {str_width}
+    gpkg    GeoPackage, batches are written in one transaction each
+    fgb     FlatGeobuf, streamed, no spatial index
+    npy     structured array of COMPACT_DTYPE
+    csv     COMPACT_DTYPE columns with a header row
+    #NOTE: the compact formats only hold tiles aligned to BASE_QUADTREE
+"""
+
+TILE_FORMATS = {
+    "shp"  : ("ESRI Shapefile", ".shp"),
+    "gpkg" : ("GPKG", ".gpkg"),
+    "fgb"  : ("FlatGeobuf", ".fgb"),
+    "npy"  : (None, ".npy"),
+    "csv"  : (None, ".csv"),
+}
+
+COMPACT_DTYPE = np.dtype([('TILE_CODE', np.uint64), ('DEPTH', np.uint8),
+                          ('IX', np.int64), ('IY', np.int64), ('TYPE', np.int8)])
+
+def get_rect_geojson(min_x, min_y, max_x, max_y):
+    """GeoJSON-like polygon of a tile, nw-sw-se-ne as mapping(Polygon(...)) gives"""
+    return {'type': 'Polygon',
+            'coordinates': [[(min_x, max_y), (min_x, min_y), (max_x, min_y), (max_x, max_y), (min_x, max_y)]]}
+
+def get_tile_path(out_path, tile_format):
+    """{out_path} with the extension of {tile_format}"""
+    return os.path.splitext(out_path)[0] + TILE_FORMATS[tile_format][1]
+
+def narrow_str_fields(schema, str_width):
+    """Copy of {schema} with string fields at most {str_width} wide"""
+    properties = dict()
+    for name, field_type in schema['properties'].items():
+        if field_type.startswith('str'):
+            width = int(field_type.split(':')[1]) if ':' in field_type else 254
+            field_type = f"str:{min(width, str_width)}"
+        properties[name] = field_type
+    return {**schema, 'properties': properties}
+
+def get_geojson_bounds(geometry):
+    ring = geometry['coordinates'][0]
+    x_list = [ x for x, _ in ring ]
+    y_list = [ y for _, y in ring ]
+    return min(x_list), min(y_list), max(x_list), max(y_list)
+
+class TileWriter:
+    """Buffering tile record writer with the write() of a fiona collection"""
+
+    def __init__(self, out_path, schema, tile_format="shp", crs=None, batch_size=10000, str_width=32):
+        if tile_format not in TILE_FORMATS:
+            raise ValueError(f"Unknown tile format [{tile_format}], one of {list(TILE_FORMATS)}")
+        self.tile_format = tile_format
+        self.out_path = get_tile_path(out_path, tile_format)
+        self.batch_size = batch_size
+        self.record_buffer = []
+        self.count = 0
+
+        driver = TILE_FORMATS[tile_format][0]
+        if driver is not None:
+            if tile_format == "shp":
+                schema = narrow_str_fields(schema, str_width)
+            layer_options = {"SPATIAL_INDEX": "NO"} if tile_format == "fgb" else {}
+            self.out_fh = fiona.open(self.out_path, 'w', driver, schema,
+                                     crs=crs if crs is not None else from_epsg(32651), **layer_options)
+            self.compact_list = None
+        else:
+            self.out_fh = None
+            self.compact_list = []
+
+    def write(self, record):
+        # Callers reuse one properties dict for every tile, keep a copy
+        self.record_buffer.append({'geometry': record['geometry'], 'properties': dict(record['properties'])})
+        if len(self.record_buffer) >= self.batch_size:
+            self.flush()
+
+    def writerecords(self, record_list):
+        for record in record_list:
+            self.write(record)
+
+    def flush(self):
+        if not self.record_buffer:
+            return
+        if self.out_fh is not None:
+            self.out_fh.writerecords(self.record_buffer)
+        else:
+            compact_rows = np.empty(len(self.record_buffer), dtype=COMPACT_DTYPE)
+            for row, record in enumerate(self.record_buffer):
+                depth, ix, iy = get_tile_address(Rect.from_extents(*get_geojson_bounds(record['geometry'])))
+                compact_rows[row] = (get_tile_code(depth, ix, iy), depth, ix, iy, record['properties'].get('TYPE', 0))
+            self.compact_list.append(compact_rows)
+        self.count += len(self.record_buffer)
+        self.record_buffer = []
+
+    def close(self):
+        self.flush()
+        if self.out_fh is not None:
+            self.out_fh.close()
+            return
+        compact_rows = np.concatenate(self.compact_list) if self.compact_list else np.empty(0, dtype=COMPACT_DTYPE)
+        if self.tile_format == "npy":
+            np.save(self.out_path, compact_rows)
+        else:
+            np.savetxt(self.out_path, compact_rows, fmt="%d", delimiter=",",
+                       header=",".join(COMPACT_DTYPE.names), comments="")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __str__(self):
+        return f"TileWriter[{self.out_path}] format={self.tile_format} records={self.count}"